@@ -0,0 +1,121 @@
+import os
+import queue
+import threading
+
+# 'svg' is written directly as text (no matplotlib), 'png' is rendered with matplotlib
+CHART_FORMATS = ['svg', 'png']
+SVG_WIDTH = 640
+SVG_HEIGHT = 480
+SVG_MARGIN = 40
+
+
+def write_bar_svg(values, path, title=''):
+    """
+    Bar chart of values (e.g. ACF by lag) as a small standalone SVG file, bars start from the zero line.
+    """
+    values = [float(v) for v in values]
+    top = max(max(values), 0)
+    bottom = min(min(values), 0)
+    span = (top - bottom) or 1.0
+    plot_width = SVG_WIDTH - 2 * SVG_MARGIN
+    plot_height = SVG_HEIGHT - 2 * SVG_MARGIN
+    bar_width = plot_width / max(len(values), 1)
+
+    def y_of(v):
+        return SVG_MARGIN + (top - v) / span * plot_height
+
+    zero_y = y_of(0)
+    lines = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">' % (SVG_WIDTH, SVG_HEIGHT),
+             '<rect width="100%" height="100%" fill="white"/>']
+    if title != '':
+        lines.append('<text x="%d" y="%d" text-anchor="middle" font-size="14">%s</text>'
+                     % (SVG_WIDTH / 2, SVG_MARGIN / 2, title))
+    for i, v in enumerate(values):
+        x = SVG_MARGIN + i * bar_width
+        lines.append('<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" fill="#1f77b4"/>'
+                     % (x + bar_width * 0.1, min(y_of(v), zero_y), bar_width * 0.8, abs(y_of(v) - zero_y)))
+        lines.append('<text x="%.2f" y="%d" text-anchor="middle" font-size="10">%d</text>'
+                     % (x + bar_width / 2, SVG_HEIGHT - SVG_MARGIN / 2, i))
+    lines.append('<line x1="%d" y1="%.2f" x2="%d" y2="%.2f" stroke="black"/>'
+                 % (SVG_MARGIN, zero_y, SVG_WIDTH - SVG_MARGIN, zero_y))
+    lines.append('<text x="%d" y="%.2f" text-anchor="end" font-size="10">%.2f</text>'
+                 % (SVG_MARGIN - 4, y_of(top), top))
+    lines.append('<text x="%d" y="%.2f" text-anchor="end" font-size="10">%.2f</text>'
+                 % (SVG_MARGIN - 4, y_of(bottom), bottom))
+    lines.append('</svg>')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def render_bar_png(values, path, title=''):
+    """
+    Same chart as a PNG with matplotlib. Uses a Figure and its Agg canvas instead of pyplot, so it can run in the
+    background render thread.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.bar(range(len(values)), values)
+    if title != '':
+        ax.set_title(title)
+    fig.savefig(path)
+
+
+def render_bar_chart(values, path_without_ext, chart_format='svg', title=''):
+    """
+    :return: path of the written chart
+    """
+    if chart_format not in CHART_FORMATS:
+        raise ValueError('[render_bar_chart] chart_format must be one of %s' % CHART_FORMATS)
+    path = path_without_ext + '.' + chart_format
+    if chart_format == 'svg':
+        write_bar_svg(values, path, title)
+    else:
+        render_bar_png(values, path, title)
+    return path
+
+
+class ChartRenderQueue:
+    """
+    Background worker rendering the queued charts, so the caller doesn't wait for figure creation / saving. Call
+    join() (or use it as a context manager) before reading the charts; errors of the worker are raised there.
+    """
+    def __init__(self):
+        self.tasks = queue.Queue()
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            try:
+                render_bar_chart(*task)
+            except Exception as e:
+                self.errors.append(e)
+
+    def submit(self, values, path_without_ext, chart_format='svg', title=''):
+        if not self.thread.is_alive():
+            raise ValueError('[ChartRenderQueue.submit] the queue is already joined')
+        self.tasks.put((list(values), path_without_ext, chart_format, title))
+
+    def join(self):
+        if self.thread.is_alive():
+            self.tasks.put(None)
+            self.thread.join()
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.join()
+
+
+def chart_path(output_path, output_file_prefix, name):
+    return os.path.join(output_path, ((output_file_prefix + '_') if output_file_prefix != '' else '') + name)
@@ -0,0 +1,156 @@
+import os
+import json
+import hashlib
+import numpy as np
+import statsmodels.tsa.stattools as ts
+
+
+def as_series_list(series):
+    """
+    :param series: one 1-D series, a 2-D array (one series per row), or a list of 1-D series of any lengths
+    :return: list of float arrays
+    """
+    if hasattr(series, 'ndim'):
+        if series.ndim == 1:
+            return [np.asarray(series, dtype=float)]
+    elif len(series) > 0 and np.ndim(series[0]) == 0:
+        return [np.asarray(series, dtype=float)]
+    return [np.asarray(s, dtype=float) for s in series]
+
+
+def autocovariance_sums(series_list, nlags):
+    """
+    sum_t x_t * x_t+k of every demeaned series for k = 0..nlags, all series at once through one FFT: each series is
+    zero padded to a common length >= 2 * the longest one, so the circular correlation equals the linear one.
+    :return: (n_series, nlags + 1) array
+    """
+    max_len = max(len(s) for s in series_list)
+    n_fft = 1 << int(np.ceil(np.log2(2 * max_len - 1))) if max_len > 1 else 2
+    padded = np.zeros((len(series_list), n_fft))
+    if all(len(s) == max_len for s in series_list):
+        values = np.array(series_list)
+        padded[:, :max_len] = values - values.mean(axis=1, keepdims=True)
+    else:
+        for i, s in enumerate(series_list):
+            padded[i, :len(s)] = s - s.mean()
+    spectrum = np.fft.rfft(padded, axis=1)
+    return np.fft.irfft(spectrum * np.conj(spectrum), n=n_fft, axis=1)[:, :nlags + 1]
+
+
+def batch_acf(series, nlags=10):
+    """
+    ACF of many series (same as statsmodels acf, adjusted=False).
+    :param series: see as_series_list
+    :return: (n_series, nlags + 1) array
+    """
+    sums = autocovariance_sums(as_series_list(series), nlags)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums / sums[:, :1]
+
+
+def durbin_levinson(autocov):
+    """
+    Partial autocorrelations from autocovariances with the Durbin-Levinson recursion, vectorized over the series.
+    :param autocov: (n_series, nlags + 1) array
+    :return: (n_series, nlags + 1) array, lag 0 is 1
+    """
+    n_series, n = autocov.shape
+    pacf = np.ones((n_series, n))
+    phi = np.zeros((n_series, n))
+    variance = autocov[:, 0].copy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for k in range(1, n):
+            reflection = (autocov[:, k] - (phi[:, 1:k] * autocov[:, k - 1:0:-1]).sum(axis=1)) / variance
+            phi[:, 1:k] = phi[:, 1:k] - reflection[:, None] * phi[:, k - 1:0:-1]
+            phi[:, k] = reflection
+            variance = variance * (1 - reflection ** 2)
+            pacf[:, k] = reflection
+    return pacf
+
+
+def batch_pacf(series, nlags=10):
+    """
+    PACF of many series, same as statsmodels pacf with its default method 'ywadjusted' (Yule-Walker with the lag k
+    autocovariance divided by n - k).
+    :param series: see as_series_list
+    :return: (n_series, nlags + 1) array
+    """
+    series_list = as_series_list(series)
+    lengths = np.array([len(s) for s in series_list], dtype=float)[:, None]
+    divisor = lengths - np.arange(nlags + 1)
+    divisor[:, 0] = lengths[:, 0]
+    return durbin_levinson(autocovariance_sums(series_list, nlags) / divisor)
+
+
+class AdfCache:
+    """
+    ADF test results (statistic, p value) keyed by the sha256 of the series values and the test parameters, kept in
+    memory and, if cache_dir is given, in one small json file per key. The same pnl series is then tested only once,
+    whichever step / strategy asks for it.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.results = {}
+
+    @staticmethod
+    def make_key(series, maxlag, regression, autolag):
+        h = hashlib.sha256()
+        h.update(np.ascontiguousarray(np.asarray(series, dtype=np.float64)).tobytes())
+        h.update(json.dumps([maxlag, regression, autolag]).encode('utf-8'))
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def get(self, key):
+        if key in self.results:
+            return self.results[key]
+        if self.cache_dir is None or not os.path.exists(self.entry_path(key)):
+            return None
+        try:
+            with open(self.entry_path(key)) as f:
+                result = tuple(json.load(f))
+        except (OSError, ValueError):
+            return None
+        self.results[key] = result
+        return result
+
+    def put(self, key, result):
+        self.results[key] = result
+        if self.cache_dir is not None:
+            path = self.entry_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.%d.tmp' % os.getpid()
+            with open(tmp_path, 'w') as f:
+                json.dump(list(result), f)
+            os.replace(tmp_path, path)
+
+    def adfuller(self, series, maxlag=None, regression='c', autolag='AIC'):
+        """
+        :return: (ADF statistic, p value), from the cache or statsmodels adfuller
+        """
+        key = AdfCache.make_key(series, maxlag, regression, autolag)
+        result = self.get(key)
+        if result is None:
+            res = ts.adfuller(np.asarray(series, dtype=float), maxlag, regression=regression, autolag=autolag)
+            result = (float(res[0]), float(res[1]))
+            self.put(key, result)
+        return result
+
+
+# in-memory cache shared by the calls that don't pass their own
+DEFAULT_ADF_CACHE = AdfCache()
+
+
+def batch_acf_pacf(series, nlags=10, adf_p_max=0.05, adf_cache=None):
+    """
+    ACF, PACF and ADF test of many series at once (see CalculateCustomMetrics.cal_acf_pacf for a single one).
+    :param series: see as_series_list
+    :param adf_cache: AdfCache, None for DEFAULT_ADF_CACHE
+    :return: (acf (n_series, nlags + 1), pacf (n_series, nlags + 1), ADF p values (n_series,),
+        pass_adf (n_series,) bool, True when the p value < adf_p_max)
+    """
+    adf_cache = DEFAULT_ADF_CACHE if adf_cache is None else adf_cache
+    series_list = as_series_list(series)
+    adf_p_values = np.array([adf_cache.adfuller(s, nlags)[1] for s in series_list])
+    return batch_acf(series_list, nlags), batch_pacf(series_list, nlags), adf_p_values, adf_p_values < adf_p_max
@@ -1,23 +1,41 @@
 import pandas as pd
 import numpy as np
 import os
-import math
 import time
 from tqdm import tqdm
-import datetime
 from bs4 import BeautifulSoup
 import multiprocessing
+from multiprocessing import shared_memory
 import re
-import random
-import statsmodels.tsa.stattools as ts
-from matplotlib import pyplot as plt
+import json
+import hashlib
 from shutil import copyfile
+from date_utils import parse_date_column
+from price_store import get_price_store
+from session_calendar import SessionCalendar
+from mc_cache import MonteCarloCache
+from drawdown import cal_max_drawdown
+from metrics_kernel import cal_regression_sums, slope_from_sums, k_ratio_from_sums, cal_monthly_pnl, \
+    gpr_from_monthly
+from rolling_metrics import cal_rolling_metrics, cal_rolling_gpr
+from metrics_registry import BATCH_METRICS, compute_metrics, compute_metrics_table, required_inputs
+from acf_charts import ChartRenderQueue, chart_path, render_bar_chart
+from autocorrelation import batch_acf_pacf
+from monte_carlo_kernel import MC_COLUMNS, MC_FREQ_CODES, MC_MIN_TIMES, ONE_YEAR_PERIOD, \
+    MC_SEGMENTED_SEED_KEY, simulate_monte_carlo, simulate_monte_carlo_adaptive, simulate_monte_carlo_segments, \
+    simulate_sizing_scenarios, simulate_portfolio_monte_carlo, cal_percentile_table, percentile_labels
 pd.set_option('display.max_columns', 500)
 
 
+# metrics of each strategy computed by generate_summary from its daily_pnl.csv / trades.csv (see metrics_registry)
+SUMMARY_METRICS = ['Daily WinRate', 'Weekly WinRate', 'Monthly WinRate', 'Yearly WinRate',
+                   'HHI Daily 5', 'HHI Daily 10', 'HHI Trade 5', 'HHI Trade 10', 'K Ratio', 'Max DD Period', 'Slope']
+
+
 class CalculateCustomMetrics:
     def __init__(self, strategy_root_path, HSI_price_path,
-                 monte_carlo=False, run_monte_carlo=False):
+                 monte_carlo=False, run_monte_carlo=False, mc_seed=0, mc_cache_dir=None, render_charts=False,
+                 chart_format='svg'):
         # strategy_root_path should contain a list of strategies. E.g.
         """
                 strategy_root_path
@@ -41,6 +59,11 @@ class CalculateCustomMetrics:
         self.HSI_price_path = HSI_price_path
         self.monte_carlo = monte_carlo  # if do the Monte Carlo
         self.run_monte_carlo = run_monte_carlo  # suppose to substitute the above one
+        self.mc_seed = mc_seed  # fixed seed, so that Monte Carlo results are reproducible and can be cached
+        self.mc_cache = MonteCarloCache(mc_cache_dir)
+        # ACF / PACF bar charts of generate_my_metrics, only the csv files are written by default
+        self.render_charts = render_charts
+        self.chart_format = chart_format
         self.get_step1_summary = True
 
     def generate_my_metrics(self):
@@ -58,43 +81,41 @@ class CalculateCustomMetrics:
                                                       )
 
         daily_pnl = pd.read_csv(self.daily_pnl_path, parse_dates=['Date'])
-        trades = pd.read_csv(self.trades_path, parse_dates=['Date', 'Ex.Date'],
-                             date_parser=lambda x: pd.datetime.strptime(x, '%m/%d/%Y %I:%M:%S %p'))
-        equity_curve = daily_pnl['PnL'].cumsum()
-        daily_pnl.loc[:, 'month'] = daily_pnl['Date'].apply(lambda x: x.month)
-        daily_pnl.loc[:, 'year'] = daily_pnl['Date'].apply(lambda x: x.year)
-        monthly_pnl = daily_pnl.groupby(by=['year', 'month']).sum()
-
-        k_ratio = CalculateCustomMetrics.cal_k_ratio(equity_curve)
-        slope = CalculateCustomMetrics.cal_slope(equity_curve)
-        gpr = CalculateCustomMetrics.cal_GPR(daily_pnl, method=1)
+        trades = pd.read_csv(self.trades_path)
+        trades['Date'] = parse_date_column(trades['Date'], self.trades_path, 'Date')
+        trades['Ex.Date'] = parse_date_column(trades['Ex.Date'], self.trades_path, 'Ex.Date')
+        metrics = compute_metrics(
+            ['K Ratio', 'Slope', 'GPR', 'HHI Trade 10', 'HHI Trade 5', 'HHI Daily 10', 'HHI Daily 5', 'Max DD Period',
+             'Expectancy', 'monthly_pnl'],
+            daily_pnl=daily_pnl['PnL'].values, dates=daily_pnl['Date'].values, trade_pnl=trades['Profit'].values)
+        monthly_pnl = metrics['monthly_pnl'].to_frame()
         avg_hold_min = CalculateCustomMetrics.cal_avg_hold_min(trade_data=trades)
-        hhi_daily_10, hhi_trade_10, hhi_daily_5, hhi_trade_5 = CalculateCustomMetrics.cal_pnl_hhi(daily_pnl, trades)
-        _, max_dd_days = CalculateCustomMetrics.cal_mdd_n_mdd_period(equity_curve)
-        expectancy = CalculateCustomMetrics.cal_expectancy(trades['Profit'])
-
-        my_metrics = pd.DataFrame({'Name': [], 'Value': []})
-        my_metrics = my_metrics.append(pd.DataFrame({'Name': ['K Ratio (Zephyr)'], 'Value': [k_ratio]}))
-        my_metrics = my_metrics.append(pd.DataFrame({'Name': ['Slope'], 'Value': [slope]}))
-        my_metrics = my_metrics.append(pd.DataFrame({'Name': ['GPR'], 'Value': [gpr]}))
-        my_metrics = my_metrics.append(pd.DataFrame({'Name': ['Average Hold Minutes'], 'Value': [avg_hold_min]}))
-        my_metrics = my_metrics.append(pd.DataFrame({'Name': ['HHI Trade 10'], 'Value': [hhi_trade_10]}))
-        my_metrics = my_metrics.append(pd.DataFrame({'Name': ['HHI Trade 5'], 'Value': [hhi_trade_5]}))
-        my_metrics = my_metrics.append(pd.DataFrame({'Name': ['HHI Daily 10'], 'Value': [hhi_daily_10]}))
-        my_metrics = my_metrics.append(pd.DataFrame({'Name': ['HHI Daily 5'], 'Value': [hhi_daily_5]}))
-        my_metrics = my_metrics.append(pd.DataFrame({'Name': ['Max. DD Days'], 'Value': [max_dd_days]}))
-        my_metrics = my_metrics.append(pd.DataFrame({'Name': ['Expectancy'], 'Value': [expectancy]}))
+        k_ratio, slope, gpr = metrics['K Ratio'], metrics['Slope'], metrics['GPR']
+        hhi_daily_10, hhi_trade_10 = metrics['HHI Daily 10'], metrics['HHI Trade 10']
+        hhi_daily_5, hhi_trade_5 = metrics['HHI Daily 5'], metrics['HHI Trade 5']
+        max_dd_days, expectancy = metrics['Max DD Period'], metrics['Expectancy']
+
+        my_metrics = pd.DataFrame({
+            'Name': ['K Ratio (Zephyr)', 'Slope', 'GPR', 'Average Hold Minutes', 'HHI Trade 10', 'HHI Trade 5',
+                     'HHI Daily 10', 'HHI Daily 5', 'Max. DD Days', 'Expectancy'],
+            'Value': [k_ratio, slope, gpr, avg_hold_min, hhi_trade_10, hhi_trade_5, hhi_daily_10, hhi_daily_5,
+                      max_dd_days, expectancy]
+        })
         my_metrics.to_csv(os.path.join(self.strategy_root_path, 'my_metrics.csv'), index=None)
 
         # CalculateCustomMetrics.cal_monte_carlo_one_strategy(
         #     self.strategy_root_path, mc_times=20, use_daily_pnl=True, use_trade_pnl=True)
         acf_path = os.path.join(self.strategy_root_path, 'acf_pacf')
-        [trades_acf, trades_pacf, trades_pass_adf] = \
-            CalculateCustomMetrics.cal_acf_pacf(trades['Profit'], output_path=acf_path, output_file_prefix='trade')
-        [daily_pnl_acf, daily_pnl_pacf, daily_pnl_pass_adf] = \
-            CalculateCustomMetrics.cal_acf_pacf(daily_pnl['PnL'], output_path=acf_path, output_file_prefix='daily')
-        [monthly_pnl_acf, monthly_pnl_pacf, monthly_pnl_pass_adf] = \
-            CalculateCustomMetrics.cal_acf_pacf(monthly_pnl['PnL'], output_path=acf_path, output_file_prefix='monthly')
+        # the charts are drawn in the background while the html is generated
+        render_queue = ChartRenderQueue() if self.render_charts else None
+        chart_kwargs = {'render_charts': self.render_charts, 'chart_format': self.chart_format,
+                        'render_queue': render_queue}
+        [trades_acf, trades_pacf, trades_pass_adf] = CalculateCustomMetrics.cal_acf_pacf(
+            trades['Profit'], output_path=acf_path, output_file_prefix='trade', **chart_kwargs)
+        [daily_pnl_acf, daily_pnl_pacf, daily_pnl_pass_adf] = CalculateCustomMetrics.cal_acf_pacf(
+            daily_pnl['PnL'], output_path=acf_path, output_file_prefix='daily', **chart_kwargs)
+        [monthly_pnl_acf, monthly_pnl_pacf, monthly_pnl_pass_adf] = CalculateCustomMetrics.cal_acf_pacf(
+            monthly_pnl['PnL'], output_path=acf_path, output_file_prefix='monthly', **chart_kwargs)
 
         # first make a copy
         html_raw_path = os.path.join(self.strategy_root_path, 'stats_raw.html')
@@ -124,11 +145,15 @@ class CalculateCustomMetrics:
         inside_table_line += get_inside_table_line('Max Drawdown Days', 'Max. DD Days', "{:.2f}".format(max_dd_days))
         inside_table_line += get_inside_table_line('Expectancy (>0.1 good)', 'Expectancy', "{:.2f}".format(expectancy))
 
-        # monte carlo results
-        mc_daily_path = os.path.join(self.strategy_root_path, 'MonteCarlo2', 'daily.xls')
-        mc_daily_data = pd.read_excel(mc_daily_path, sheet_name='All year')
-        mc_trade_path = os.path.join(self.strategy_root_path, 'MonteCarlo2', 'trades.xls')
-        mc_trade_data = pd.read_excel(mc_trade_path, sheet_name='All year')
+        # monte carlo results, (re)run if they are missing or older than the pnl (unchanged sheets come from the cache)
+        mc_daily_path = os.path.join(self.strategy_root_path, 'MonteCarlo2', 'daily.xlsx')
+        mc_trade_path = os.path.join(self.strategy_root_path, 'MonteCarlo2', 'trades.xlsx')
+        pnl_mtime = max(os.path.getmtime(self.daily_pnl_path), os.path.getmtime(self.trades_path))
+        if any(not os.path.exists(p) or os.path.getmtime(p) < pnl_mtime for p in [mc_daily_path, mc_trade_path]):
+            CalculateCustomMetrics.cal_monte_carlo_one_strategy(
+                self.strategy_root_path, use_daily_pnl=True, use_trade_pnl=True, seed=self.mc_seed, cache=self.mc_cache)
+        mc_daily_data = pd.read_excel(mc_daily_path, sheet_name='All year', index_col=0)
+        mc_trade_data = pd.read_excel(mc_trade_path, sheet_name='All year', index_col=0)
         mc_table = '</br><hr size=1>My Monte Carlo Results (Daily)</br><TABLE  id="table_content">\n'
 
         use_trade_data = False
@@ -224,6 +249,9 @@ class CalculateCustomMetrics:
         with open(os.path.join(self.strategy_root_path, 'stats.html'), 'w') as f:
             f.write(new_html)
 
+        if render_queue is not None:
+            render_queue.join()
+
     def generate_summary(self):
         strategy_list = []
         strategy_df = pd.DataFrame()
@@ -298,47 +326,17 @@ class CalculateCustomMetrics:
                     ]
 
                     daily_pnl = pd.read_csv(os.path.join(s_path, 'daily_pnl.csv'), parse_dates=['Date'])
-                    total_pnl = daily_pnl['PnL'].sum()
-                    # print(CalculateCustomMetrics.cal_k_ratio(daily_pnl['PnL'].cumsum()))
-
-                    # win rate
-                    weekly_winrate, monthly_winrate, yearly_winrate, weekly_pnl, monthly_pnl, yearly_pnl = \
-                        CalculateCustomMetrics.cal_profit_calendar_matrix(daily_pnl, s_path)
-                    daily_winrate = len(daily_pnl[daily_pnl['PnL'] > 0]) / (
-                        len(daily_pnl[daily_pnl['PnL'] > 0]) + len(daily_pnl[daily_pnl['PnL'] < 0])
-                    )
-                    stats_table_new.loc['Daily WinRate'] = [daily_winrate]
-                    stats_table_new.loc['Weekly WinRate'] = [weekly_winrate]
-                    stats_table_new.loc['Monthly WinRate'] = [monthly_winrate]
-                    stats_table_new.loc['Yearly WinRate'] = [yearly_winrate]
-
-                    # Herfindahl-Hirschman Index (HHI)
-                    hhi_daily_10 = 0
-                    hhi_daily_5 = 0
-                    if len(daily_pnl) > 10:
-                        daily_pnl_sorted = daily_pnl['PnL'].sort_values(ascending=False) / total_pnl * 100
-                        daily_pnl_sorted_sq = daily_pnl_sorted ** 2
-                        hhi_daily_10 = daily_pnl_sorted_sq[0:10].sum()
-                        hhi_daily_5 = daily_pnl_sorted_sq[0:5].sum()
-                    stats_table_new.loc['HHI Daily 5'] = [hhi_daily_5]
-                    stats_table_new.loc['HHI Daily 10'] = [hhi_daily_10]
-
                     trade_data = pd.read_csv(os.path.join(s_path, 'trades.csv'))
-                    trade_pnl = trade_data['Profit']
-                    hhi_trade_5 = hhi_trade_10 = 0
-                    if len(trade_pnl) > 10:
-                        trade_pnl_sorted_sq = (trade_pnl.sort_values(ascending=False) / total_pnl * 100) ** 2
-                        hhi_trade_5 = trade_pnl_sorted_sq[0:5].sum()
-                        hhi_trade_10 = trade_pnl_sorted_sq[0:10].sum()
-                    stats_table_new.loc['HHI Trade 5'] = [hhi_trade_5]
-                    stats_table_new.loc['HHI Trade 10'] = [hhi_trade_10]
-
-                    # recovering period & slope
-                    equity_curve = daily_pnl['PnL'].cumsum()
-                    stats_table_new.loc['K Ratio'] = [CalculateCustomMetrics.cal_k_ratio(equity_curve)]
-                    stats_table_new.loc['Max DD Period'] = [
-                        CalculateCustomMetrics.cal_mdd_n_mdd_period(equity_curve)[1]]
-                    stats_table_new.loc['Slope'] = [CalculateCustomMetrics.cal_slope(equity_curve)]
+                    metrics = compute_metrics(
+                        SUMMARY_METRICS + ['weekly_pnl', 'monthly_pnl', 'yearly_pnl'],
+                        daily_pnl=daily_pnl['PnL'].values, dates=daily_pnl['Date'].values,
+                        trade_pnl=trade_data['Profit'].values)
+                    metrics['yearly_pnl'].to_csv(os.path.join(s_path, 'yearly_pnl.csv'))
+                    metrics['monthly_pnl'].to_csv(os.path.join(s_path, 'monthly_pnl.csv'))
+                    metrics['weekly_pnl'].to_csv(os.path.join(s_path, 'weekly_pnl.csv'))
+                    monthly_pnl = metrics['monthly_pnl']
+                    for name in SUMMARY_METRICS:
+                        stats_table_new.loc[name] = [metrics[name]]
 
                     # monte carlo
                     if self.monte_carlo:
@@ -354,7 +352,8 @@ class CalculateCustomMetrics:
                     if self.run_monte_carlo:
                         # print(monthly_pnl)
                         # print(isinstance(monthly_pnl, pd.Series))
-                        res = CalculateCustomMetrics.cal_monte_carlo(monthly_pnl, freq='monthly')
+                        res = CalculateCustomMetrics.cal_monte_carlo(monthly_pnl, freq='monthly', seed=self.mc_seed,
+                                                                     cache=self.mc_cache)
                         stats_table_new.loc['MC_Monthly_MDD_90%'] = res[0][0]
                         stats_table_new.loc['MC_Monthly_MDD_Period_90%'] = res[0][1]
                         stats_table_new.loc['MC_Monthly_CAR_MDD_90%'] = res[0][4]
@@ -456,40 +455,22 @@ class CalculateCustomMetrics:
         else:
             efg = pd.DataFrame(data_list)
 
-            def recog_date_format(date_str, date_format):
-                if '00:00:00' in date_str:
-                    date_format = date_format.replace(' %p', '').replace('%I', '%H')
-                try:
-                    parsed_date = pd.Timestamp(
-                        datetime.datetime.strptime(date_str, date_format)
-                    )
-                    return 1
-                except Exception:
-                    return 0
-
-            def convert_date_format(date_str, date_format):
-                if '00:00:00' in date_str:
-                    date_format = date_format.replace(' %p', '').replace('%I', '%H')
-                # print(date_str)
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date.strftime('%m/%d/%Y %I:%M:%S %p')
-
-            potential_date_format = ['%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %H:%M', '%m/%d/%Y %H:%M:%S',
-                                     '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %I:%M:%S %p', '%d/%m/%Y %H:%M']
-            for date_format in potential_date_format:
-                res = efg['Date'].apply(recog_date_format, args=(date_format,))
-                if res.sum() == len(efg):
-                    efg.loc[:, 'Date'] = efg['Date'].apply(convert_date_format, args=(date_format,))
-                    efg.loc[:, 'Ex.Date'] = efg['Ex.Date'].apply(convert_date_format, args=(date_format,))
-                    continue
+            # detect the format once per column and convert everything to '%m/%d/%Y %I:%M:%S %p'
+            html_path = os.path.join(Path, "trades.html")
+            for col in ['Date', 'Ex.Date']:
+                parsed_date = parse_date_column(efg[col], html_path, col)
+                if parsed_date.notna().all():
+                    efg.loc[:, col] = parsed_date.dt.strftime('%m/%d/%Y %I:%M:%S %p')
 
         efg = efg[['Symbol', 'Trade', 'Date', 'Price', 'Ex.Date', 'Ex. Price', '% chg', 'Profit', '% Profit'
             , 'Shares', 'Position value', 'Cum.profit', '# bars', 'Profit/bar', 'MAE', 'MFE', 'Scale In/Out']]
         efg.to_csv(Path + "\\trades.csv", index=None)
 
-    def generate_daily_pnl_strategy_root(self):
+    def generate_daily_pnl_strategy_root(self, incremental=False, processes=1):
+        # build the binary price store once here, worker processes then only map it
+        get_price_store(self.HSI_price_path)
+        pool = multiprocessing.Pool(processes=processes) if processes > 1 else None
+        results = []
         for s in tqdm(os.listdir(self.strategy_root_path)):
             s_path = os.path.join(self.strategy_root_path, s)
             # print(s_path)
@@ -497,186 +478,492 @@ class CalculateCustomMetrics:
                 trade_file_path = os.path.join(s_path, 'trades.csv')
                 price_data_path = self.HSI_price_path
                 output_path = os.path.join(s_path, 'daily_pnl.csv')
-                CalculateCustomMetrics.generate_daily_pnl(trade_file_path, price_data_path, output_path)
+                if pool is None:
+                    CalculateCustomMetrics.generate_daily_pnl(trade_file_path, price_data_path, output_path,
+                                                              incremental=incremental)
+                else:
+                    results.append(pool.apply_async(CalculateCustomMetrics.generate_daily_pnl,
+                                                    args=(trade_file_path, price_data_path, output_path, incremental)))
+        if pool is not None:
+            pool.close()
+            for r in results:
+                r.get()
+            pool.join()
+
+    def generate_daily_pnl_matrix(self, output_path=None):
+        """
+        Daily pnl of every strategy folder under strategy_root_path in one pass: all trades.csv are loaded into one
+        table tagged with a strategy id, cut into day slices together, and summed into a dense days x strategies
+        matrix with one bincount. The matrix is saved as a compressed .npz (see load_daily_pnl_matrix).
+        Strategies have pnl 0 on days outside their own first trade / last exit window (stored as start / end).
+        :return: DataFrame, index = Date, one column per strategy
+        """
+        if output_path is None:
+            output_path = os.path.join(self.strategy_root_path, 'daily_pnl_matrix.npz')
+
+        strategy_list = []
+        trade_data_list = []
+        for s in sorted(os.listdir(self.strategy_root_path)):
+            trade_file_path = os.path.join(self.strategy_root_path, s, 'trades.csv')
+            if not os.path.isfile(trade_file_path):
+                continue
+            trade_data = CalculateCustomMetrics.read_trade_data(trade_file_path)
+            if len(trade_data) == 0:
+                continue
+            trade_data.loc[:, 'Strategy'] = len(strategy_list)
+            strategy_list.append(s)
+            trade_data_list.append(trade_data)
+        if len(trade_data_list) == 0:
+            raise ValueError('[generate_daily_pnl_matrix] no trades.csv found under %s' % self.strategy_root_path)
+        trade_data = pd.concat(trade_data_list, ignore_index=True)
+        strategy_id = trade_data['Strategy'].values
+
+        price_store = get_price_store(self.HSI_price_path)
+        index_dates = price_store.dates
+        slices = CalculateCustomMetrics.cal_daily_pnl_slices(trade_data, index_dates, price_store.closes)
+        n_strategy = len(strategy_list)
+        pnl = np.bincount(slices['day_idx'] * n_strategy + strategy_id[slices['trade_idx']],
+                          weights=slices['pnl'], minlength=len(index_dates) * n_strategy)
+        pnl = pnl.reshape(len(index_dates), n_strategy)
+
+        # same window as generate_daily_pnl: first entry date to the exit date of the last entered trade
+        start = np.array([d['Date'].iloc[0].normalize() for d in trade_data_list], dtype='datetime64[D]')
+        end = np.array([d['Ex.Date'].iloc[-1].normalize() for d in trade_data_list], dtype='datetime64[D]')
+        dates = index_dates.astype('datetime64[D]')
+        in_range = (dates >= start.min()) & (dates <= end.max())
+        dates = dates[in_range]
+        pnl = pnl[in_range] * ((dates[:, None] >= start[None, :]) & (dates[:, None] <= end[None, :]))
+
+        np.savez_compressed(output_path, dates=dates, strategies=np.array(strategy_list), pnl=pnl,
+                            start=start, end=end)
+        return pd.DataFrame(pnl, index=pd.DatetimeIndex(dates, name='Date'), columns=strategy_list)
 
     @staticmethod
-    def generate_daily_pnl(trade_file_path, price_data_path, output_path):
+    def load_daily_pnl_matrix(matrix_path):
         """
-        This function will first read a file containing all trades (this file comes from the html produced by AmiBroker)
-        Then it will  compute the day-end pnl each day (daily close data should be provided via price_data_path)
-        It will finally produce a list of daily pnl.
+        Read the matrix saved by generate_daily_pnl_matrix.
+        :return: DataFrame, index = Date, one column per strategy
         """
-        trade_data = pd.read_csv(trade_file_path)
+        with np.load(matrix_path) as f:
+            return pd.DataFrame(f['pnl'], index=pd.DatetimeIndex(f['dates'].astype('datetime64[ns]'), name='Date'),
+                                columns=list(f['strategies']))
 
-        # print(trade_data.columns)
+    @staticmethod
+    def read_trade_data(trade_file_path, rows=None):
+        """
+        Read trades.csv into the columns used by the daily pnl engine: Trade (1 / -1), Date, Price, Ex.Date, Ex. Price,
+        Profit, Shares. The index keeps the row number of each trade in the file.
+        :param rows: row numbers to keep (None -> all rows). Only these rows get their dates parsed.
+        """
+        trade_data = pd.read_csv(trade_file_path)
+        if rows is not None:
+            trade_data = trade_data.iloc[rows]
 
         # deal with date & time
-        # print(trade_data)
-        def get_datetime(date_str):
-            date_format = '%m/%d/%Y %I:%M:%S %p'
-            parsed_date = pd.Timestamp(2000, 1, 1)
-            try:
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date
-            except Exception:
-                pass
-
-            date_format = '%m/%d/%Y %H:%M'
-            parsed_date = pd.Timestamp(2000, 1, 1)
-            try:
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date
-            except Exception:
-                pass
-
-            date_format = '%d/%m/%Y %I:%M:%S %p'
-            try:
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date
-            except Exception:
-                pass
-
-            date_format = '%m/%d/%Y %H:%M:%S'
-            try:
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date
-            except Exception:
-                pass
-
-            date_format = '%d/%m/%Y %H:%M:%S'
-            try:
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date
-            except Exception:
-                pass
-
-            date_format = '%d/%m/%Y %I:%M:%S %p'
-            try:
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date
-            except Exception:
-                pass
-
-            date_format = '%Y-%m-%d %H:%M:%S'
-            try:
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date
-            except Exception:
-                pass
-
-            print("%s can't be converted!" % date_str)
-
         def judge_direction(row):
             if 'LONG' in row['Trade'].upper():
                 return 1
             if 'SHORT' in row['Trade'].upper():
                 return -1
 
-        trade_data['Date'] = trade_data.apply(lambda x: get_datetime(x['Date']), axis=1)
+        trade_data['Date'] = parse_date_column(trade_data['Date'], trade_file_path, 'Date')
         trade_data = trade_data.rename({'Ex. Date': 'Ex.Date'}, axis=1)
         # print(trade_data)
-        trade_data['Ex.Date'] = trade_data.apply(lambda x: get_datetime(x['Ex.Date']), axis=1)
+        trade_data['Ex.Date'] = parse_date_column(trade_data['Ex.Date'], trade_file_path, 'Ex.Date')
         trade_data['Trade'] = trade_data.apply(judge_direction, axis=1)
-        trade_data = trade_data.sort_values(by=['Date'], ascending=True)
-        trade_data = trade_data[['Trade', 'Date', 'Price', 'Ex.Date', 'Ex. Price', 'Profit', 'Shares']]
-        # print(trade_data)
+        trade_data = trade_data.sort_values(by=['Date'], ascending=True, kind='stable')
+        columns = ['Trade', 'Date', 'Price', 'Ex.Date', 'Ex. Price', 'Profit', 'Shares']
+        if 'Symbol' in trade_data.columns:
+            columns = ['Symbol'] + columns
+        trade_data = trade_data[columns]
+        return trade_data
 
-        # read index day-end data
-        index_data = pd.read_csv(price_data_path,
-                                 parse_dates=['Dates'],
-                                 date_parser=lambda x: pd.datetime.strptime(x, '%d/%m/%Y'))
-        index_data = index_data.sort_values(by=['Dates'], ascending=True)
-        index_data = index_data.rename({'Dates': 'Date'}, axis=1)
-        # index_data will have two columns: Date, PX_LAST
+    @staticmethod
+    def generate_daily_pnl(trade_file_path, price_data_path, output_path, incremental=False, session_calendar=None,
+                           split_trade_ledger=True):
+        """
+        This function will first read a file containing all trades (this file comes from the html produced by AmiBroker)
+        Then it will  compute the day-end pnl each day (daily close data should be provided via price_data_path)
+        It will finally produce a list of daily pnl.
+
+        incremental: if True, a checkpoint is kept in daily_pnl_checkpoint.json next to output_path. When trades.csv
+        has only been appended to since the last run, only the days from the checkpoint's last day on are recomputed
+        (from the trades still open on that day plus the new trades) and appended to the existing output.
+
+        session_calendar: SessionCalendar giving the trading day boundaries (default: HSI sessions, trades after 16:30:01
+        belong to the next trading day). Its sessions are applied to the trading days of the price file.
+
+        split_trade_ledger: if True, the trades split at the day boundaries are also written to split_trades.npz next to
+        output_path (see cal_split_trade_ledger / load_split_trades).
+        """
+        # index day-end data, memory-mapped and shared by all processes
+        price_store = get_price_store(price_data_path)
+        index_dates = price_store.dates
+        index_close = price_store.closes
+        session_calendar = SessionCalendar(index_dates) if session_calendar is None else \
+            session_calendar.with_days(index_dates)
+
+        checkpoint_path = os.path.join(os.path.dirname(output_path), 'daily_pnl_checkpoint.json')
+        ledger_path = os.path.join(os.path.dirname(output_path), 'split_trades.npz') if split_trade_ledger else None
+        if incremental and CalculateCustomMetrics.update_daily_pnl_from_checkpoint(
+                trade_file_path, price_data_path, output_path, checkpoint_path, index_dates, index_close,
+                session_calendar, ledger_path):
+            return
+
+        trade_data = CalculateCustomMetrics.read_trade_data(trade_file_path)
+        # print(trade_data)
 
         # extract relevant data
-        start_date = pd.Timestamp(trade_data['Date'][0].date())  # Timestamp('2015-01-06 00:00:00')
+        start_date = pd.Timestamp(trade_data['Date'].iloc[0].date())  # Timestamp('2015-01-06 00:00:00')
         end_date = pd.Timestamp(trade_data['Ex.Date'].iloc[-1].date())
-        pnl_data = pd.DataFrame({'Date': [], 'PnL': []})
+        pnl_data, slices = CalculateCustomMetrics.cal_daily_pnl_sweep(
+            trade_data, index_dates, index_close, start_date, end_date, session_calendar, return_slices=True)
+        pnl_data.to_csv(output_path, index=None)
+        if ledger_path is not None:
+            CalculateCustomMetrics.save_split_trade_ledger(ledger_path, CalculateCustomMetrics.cal_split_trade_ledger(
+                trade_data, slices, index_dates, start_date, end_date))
 
-        IMAGINARY_TRADES = pd.DataFrame({'Symbol':[], 'Trade':[], 'Date':[], 'Price': [],
-                                         'Ex.Date': [], 'Ex.Price':[], 'Profit':[]})
-        for d in index_data['Date']:
-            if d < start_date or d > end_date:
-                continue
-            yest_close = index_data.iloc[list(index_data[index_data['Date'] == d].index)[0] - 1][1]
-            yest = index_data.iloc[list(index_data[index_data['Date'] == d].index)[0] - 1][0]
-            today_close = list(index_data[index_data['Date'] == d]['PX_LAST'])[0]
-            # print('Today date = %s, yest=%s, yest_close=%.1f, today_close=%.1f' % (d, yest, yest_close, today_close))
-            # e.g. d = 2018-09-16
-            day_end = pd.Timestamp(
-                datetime.datetime.strptime(
-                    d.date().strftime('%Y-%m-%d') + " 16:30:01", '%Y-%m-%d %H:%M:%S'
-                ))  # e.g.  2018-09-16 23:59:59
-            day_start = pd.Timestamp(
-                datetime.datetime.strptime(
-                    yest.date().strftime('%Y-%m-%d') + " 16:30:01", '%Y-%m-%d %H:%M:%S'
-                ))  # e.g.  2018-09-16 00:00:00
-            # print('day_start=%s, day_end=%s' % (day_start, day_end))
-            cond1 = trade_data['Date'] <= day_end
-            cond2 = trade_data['Ex.Date'] >= day_start
-            today_trade_data = trade_data[cond1 & cond2]
-            # print(today_trade_data)
-            # time.sleep(10000)
-
-            # print('today_trade_data (before) = \n%s\n' % today_trade_data)
-
-            # find those with open date earlier than day_start and modify their open price to be yesterday's close
-
-            def update_profit(row):
-                nonlocal IMAGINARY_TRADES
-                if row['Ex.Date'] > day_end and row['Date'] < day_start:  # a trade crosses multiple days
-                    pnl = row['Trade'] * (today_close - yest_close)
-                    return pnl * row['Shares']
-                elif row['Ex.Date'] > day_end:
-                    pnl = row['Trade'] * (today_close - row['Price']) - \
-                          0.5 * (row['Trade'] * (row['Ex. Price'] - row['Price']) - row['Profit'])
-                    day_end_str = day_end.strftime('%Y-%m-%d %I:%M:%S %p')
-                    rec = pd.DataFrame({'Symbol':[row['Symbol']], 'Trade':[row['Trade']], 'Date':[row['Date']], 'Price': [row['Price']],
-                                         'Ex.Date': [day_end_str], 'Ex.Price':[today_close], 'Profit':[pnl]})
-                    IMAGINARY_TRADES = IMAGINARY_TRADES.append(rec)
-                    return pnl * row['Shares']
-                elif row['Date'] < day_start:
-                    pnl = row['Trade'] * (row['Ex. Price'] - yest_close) - \
-                          0.5 * (row['Trade'] * (row['Ex. Price'] - row['Price']) - row['Profit'])
-                    day_start_str = day_end.strftime('%Y-%m-%d %I:%M:%S %p')
-                    rec = pd.DataFrame({'Symbol': [row['Symbol']], 'Trade': [row['Trade']], 'Date': [day_start_str],
-                                        'Price': [yest_close],
-                                        'Ex.Date': [row['Ex.Date']], 'Ex.Price': [today_close['Ex.Price']], 'Profit': [pnl]})
-                    IMAGINARY_TRADES = IMAGINARY_TRADES.append(rec)
-                    return pnl * row['Shares']
-                else:
-                    return row['Profit'] * row['Shares']
+        if incremental:
+            CalculateCustomMetrics.save_daily_pnl_checkpoint(
+                checkpoint_path, trade_file_path, price_data_path, len(trade_data), trade_data, pnl_data,
+                session_calendar)
 
-            # today_trade_data.loc[:, 'Profit'] = today_trade_data.apply(update_profit_from_open, axis=1)
-            # today_trade_data.loc[:, 'Profit'] = today_trade_data.apply(update_profit_from_close, axis=1)
-            today_trade_data.loc[:, 'Profit'] = today_trade_data.apply(update_profit, axis=1)
-            # today_trade_data['Ex. Price'] = today_trade_data.apply(assign_close_price, axis=1)
-            # print('today_trade_data (after) = \n%s\n' % today_trade_data)
+    @staticmethod
+    def get_price_file_stamp(price_data_path):
+        return {'path': os.path.abspath(price_data_path),
+                'mtime': os.path.getmtime(price_data_path),
+                'size': os.path.getsize(price_data_path)}
 
-            today_pnl = today_trade_data['Profit'].sum()
-            pnl_data = pnl_data.append(pd.DataFrame({'Date': [d], 'PnL': [today_pnl]}))
-            # print('today pnl = %.1f' % today_pnl)
-            # print('----------------------------------------------------------------------')
+    @staticmethod
+    def save_daily_pnl_checkpoint(checkpoint_path, trade_file_path, price_data_path, trade_num, trade_data, pnl_data,
+                                  session_calendar):
+        """
+        Checkpoint for the incremental mode of generate_daily_pnl:
+            last_day - last day written to daily_pnl.csv
+            trade_num, trade_bytes, trade_hash - number of trades processed and the sha1 of that prefix of trades.csv
+            carry - row numbers of the trades still open at the start of last_day (the open-position carry)
+            price - stamp of the index close file
+        """
+        with open(trade_file_path, 'rb') as f:
+            trade_bytes = f.read()
+        last_day = pd.Timestamp(pnl_data['Date'].iloc[-1])
+        last_day_idx = np.searchsorted(session_calendar.trading_days, np.datetime64(last_day))
+        last_day_start = session_calendar.day_start[last_day_idx]
+        carry = trade_data.index[trade_data['Ex.Date'] >= last_day_start]
+
+        checkpoint = {
+            'last_day': last_day.strftime('%Y-%m-%d'),
+            'trade_num': int(trade_num),
+            'trade_bytes': len(trade_bytes),
+            'trade_hash': hashlib.sha1(trade_bytes).hexdigest(),
+            'carry': sorted(int(i) for i in carry),
+            'price': CalculateCustomMetrics.get_price_file_stamp(price_data_path)
+        }
+        with open(checkpoint_path, 'w') as f:
+            json.dump(checkpoint, f, indent=1)
 
-            # time.sleep(2)
-        pnl_data.to_csv(output_path, index=None)
-        # print(pnl_data)
-        # print(output_path)
+    @staticmethod
+    def update_daily_pnl_from_checkpoint(trade_file_path, price_data_path, output_path, checkpoint_path,
+                                         index_dates, index_close, session_calendar, ledger_path=None):
+        """
+        Incremental part of generate_daily_pnl.
+        :return: True if output_path is up to date afterwards, False if a full recompute is needed
+        """
+        if not os.path.exists(checkpoint_path) or not os.path.exists(output_path):
+            return False
+        if ledger_path is not None and not os.path.exists(ledger_path):
+            return False
+        with open(checkpoint_path, 'r') as f:
+            checkpoint = json.load(f)
+        if checkpoint['price'] != CalculateCustomMetrics.get_price_file_stamp(price_data_path):
+            return False
+
+        with open(trade_file_path, 'rb') as f:
+            trade_bytes = f.read()
+        prefix = trade_bytes[:checkpoint['trade_bytes']]
+        if len(prefix) < checkpoint['trade_bytes'] or hashlib.sha1(prefix).hexdigest() != checkpoint['trade_hash']:
+            return False  # trades.csv was rewritten, not appended to
+        if len(trade_bytes) == checkpoint['trade_bytes']:
+            return True  # nothing new
+
+        trade_num = int(len(pd.read_csv(trade_file_path, usecols=[0])))
+        rows = checkpoint['carry'] + list(range(checkpoint['trade_num'], trade_num))
+        trade_data = CalculateCustomMetrics.read_trade_data(trade_file_path, rows=rows)
+
+        # the new trades must not reach back before the checkpoint's last day, otherwise trades outside the carry
+        # could share a day with them
+        last_day = pd.Timestamp(checkpoint['last_day'])
+        last_day_idx = np.searchsorted(session_calendar.trading_days, np.datetime64(last_day))
+        last_day_start = session_calendar.day_start[last_day_idx]
+        new_trades = trade_data[trade_data.index >= checkpoint['trade_num']]
+        if (new_trades['Date'] < last_day_start).any():
+            return False
+
+        end_date = pd.Timestamp(trade_data['Ex.Date'].iloc[-1].date())
+        tail_pnl, slices = CalculateCustomMetrics.cal_daily_pnl_sweep(
+            trade_data, index_dates, index_close, last_day, end_date, session_calendar, return_slices=True)
+        if ledger_path is not None:
+            CalculateCustomMetrics.save_split_trade_ledger(ledger_path, CalculateCustomMetrics.cal_split_trade_ledger(
+                trade_data, slices, index_dates, last_day, end_date), keep_before=last_day)
+
+        # keep the rows before last_day untouched and append the recomputed tail
+        with open(output_path, 'r') as f:
+            lines = f.readlines()
+        last_day_str = checkpoint['last_day']
+        kept = [lines[0]] + [l for l in lines[1:] if l[0:len(last_day_str)] < last_day_str]
+        with open(output_path, 'w') as f:
+            f.writelines(kept)
+        tail_pnl.to_csv(output_path, index=None, header=False, mode='a')
+
+        CalculateCustomMetrics.save_daily_pnl_checkpoint(
+            checkpoint_path, trade_file_path, price_data_path, trade_num, trade_data, tail_pnl, session_calendar)
+        return True
+
+    @staticmethod
+    def cal_daily_pnl_sweep(trade_data, index_dates, index_close, start_date, end_date, session_calendar=None,
+                            return_slices=False):
+        """
+        Sweep-line engine behind generate_daily_pnl.
+        Trading day k runs from (day k-1) 16:30:01 to (day k) 16:30:01 (or the boundaries of session_calendar). Every
+        trade is cut into one slice per trading day it touches (see cal_daily_pnl_slices) and the slices are summed per
+        day with one bincount.
+        :param trade_data: DataFrame with columns Trade (1 / -1), Date, Price, Ex.Date, Ex. Price, Profit, Shares
+        :param index_dates: sorted trading days of the index close file
+        :param index_close: index close of each day in index_dates
+        :param start_date: first day to report
+        :param end_date: last day to report
+        :return: DataFrame with columns Date, PnL (one row per trading day between start_date and end_date),
+            and the slices from cal_daily_pnl_slices if return_slices is True
+        """
+        index_dates = np.asarray(index_dates, dtype='datetime64[ns]')
+        slices = CalculateCustomMetrics.cal_daily_pnl_slices(trade_data, index_dates, index_close, session_calendar)
+        daily_pnl = np.bincount(slices['day_idx'], weights=slices['pnl'], minlength=len(index_dates))
+        in_range = (index_dates >= np.datetime64(start_date)) & (index_dates <= np.datetime64(end_date))
+        pnl_data = pd.DataFrame({'Date': index_dates[in_range], 'PnL': daily_pnl[in_range]})
+        if return_slices:
+            return pnl_data, slices
+        return pnl_data
+
+    @staticmethod
+    def cal_daily_pnl_slices(trade_data, index_dates, index_close, session_calendar=None):
+        """
+        Cut every trade into one slice per trading day it touches, marked to market at the day-end closes.
+        The first/last day of each trade is found by searchsorted over the day-end boundaries, so the cost is
+        O((trades + slices) * log(days)) instead of O(days * trades).
+        :return: dict of arrays, one element per slice:
+            trade_idx - row (position) of the trade in trade_data
+            day_idx - position of the trading day in index_dates
+            pnl - pnl of the slice (already multiplied by Shares)
+            date, price, ex_date, ex_price - the slice as a trade: a trade opened before the day starts at the previous
+                day end at yesterday's close, a trade still open at the day end exits there at today's close
+            split - True if the slice is not the whole trade
+        """
+        index_dates = np.asarray(index_dates, dtype='datetime64[ns]')
+        index_close = np.asarray(index_close, dtype=float)
+        if session_calendar is None:
+            session_calendar = SessionCalendar(index_dates)
+        if len(session_calendar.trading_days) != len(index_dates):
+            raise ValueError('[cal_daily_pnl_slices] session_calendar must be built on index_dates '
+                             '(use session_calendar.with_days(index_dates))')
+        day_end = session_calendar.day_end
+        day_start = session_calendar.day_start
+
+        entry = trade_data['Date'].values.astype('datetime64[ns]')
+        exit_ = trade_data['Ex.Date'].values.astype('datetime64[ns]')
+        # a trade belongs to day k iff entry <= day_end[k] and exit >= day_start[k] (= day_end[k-1])
+        first_day = np.searchsorted(day_end, entry, side='left')
+        last_day = np.minimum(np.searchsorted(day_end, exit_, side='right'), len(day_end) - 1)
+        slice_num = np.maximum(last_day - first_day + 1, 0)
+
+        trade_idx = np.repeat(np.arange(len(trade_data)), slice_num)
+        offset = np.arange(slice_num.sum()) - np.repeat(np.cumsum(slice_num) - slice_num, slice_num)
+        day_idx = first_day[trade_idx] + offset
+
+        direction = trade_data['Trade'].values.astype(float)[trade_idx]
+        price = trade_data['Price'].values.astype(float)[trade_idx]
+        ex_price = trade_data['Ex. Price'].values.astype(float)[trade_idx]
+        profit = trade_data['Profit'].values.astype(float)[trade_idx]
+        shares = trade_data['Shares'].values.astype(float)[trade_idx]
+        today_close = index_close[day_idx]
+        yest_close = index_close[np.maximum(day_idx - 1, 0)]
+
+        open_before = entry[trade_idx] < day_start[day_idx]
+        close_after = exit_[trade_idx] > day_end[day_idx]
+        half_cost = 0.5 * (direction * (ex_price - price) - profit)  # half of the commission on each leg
+        pnl = np.select(
+            [open_before & close_after, close_after, open_before],
+            [direction * (today_close - yest_close),  # a trade crosses multiple days
+             direction * (today_close - price) - half_cost,  # opened today, marked to today's close
+             direction * (ex_price - yest_close) - half_cost],  # opened before, marked from yesterday's close
+            default=profit
+        ) * shares
+
+        return {'trade_idx': trade_idx, 'day_idx': day_idx, 'pnl': pnl,
+                'date': np.where(open_before, day_start[day_idx], entry[trade_idx]),
+                'price': np.where(open_before, yest_close, price),
+                'ex_date': np.where(close_after, day_end[day_idx], exit_[trade_idx]),
+                'ex_price': np.where(close_after, today_close, ex_price),
+                'split': open_before | close_after}
+
+    @staticmethod
+    def cal_split_trade_ledger(trade_data, slices, index_dates, start_date, end_date):
+        """
+        Columnar ledger of the trades split at the day boundaries, built straight from the slice arrays of
+        cal_daily_pnl_slices (only the days between start_date and end_date, like daily_pnl.csv).
+        Profit is per share, Shares is kept separately. TradeNo is the row of the original trade in trades.csv.
+        :return: dict of typed numpy arrays
+        """
+        day = np.asarray(index_dates, dtype='datetime64[ns]')[slices['day_idx']]
+        keep = (day >= np.datetime64(start_date)) & (day <= np.datetime64(end_date))
+        trade_idx = slices['trade_idx'][keep]
+        shares = trade_data['Shares'].values.astype(float)[trade_idx]
+        if 'Symbol' in trade_data.columns:
+            symbols, symbol_code = np.unique(np.asarray(trade_data['Symbol'].astype(str), dtype=str),
+                                             return_inverse=True)
+        else:
+            symbols, symbol_code = np.array([''], dtype=str), np.zeros(len(trade_data), dtype=int)
+        return {
+            'TradeNo': np.asarray(trade_data.index, dtype=np.int32)[trade_idx],
+            'SymbolCode': symbol_code.astype(np.int16)[trade_idx],
+            'Symbols': symbols,
+            'Day': day[keep].astype('datetime64[D]'),
+            'Trade': trade_data['Trade'].values.astype(np.int8)[trade_idx],
+            'Date': slices['date'][keep].astype('datetime64[s]'),
+            'Price': slices['price'][keep],
+            'Ex.Date': slices['ex_date'][keep].astype('datetime64[s]'),
+            'Ex.Price': slices['ex_price'][keep],
+            'Profit': slices['pnl'][keep] / np.where(shares == 0, 1, shares),
+            'Shares': shares,
+            'Split': slices['split'][keep]
+        }
+
+    @staticmethod
+    def save_split_trade_ledger(ledger_path, ledger, keep_before=None):
+        """
+        Write the ledger as a compressed .npz. If keep_before is given, the rows of the existing file with Day earlier than
+        keep_before are kept in front of the new rows (incremental mode).
+        """
+        if keep_before is not None and os.path.exists(ledger_path):
+            with np.load(ledger_path) as f:
+                old = {k: f[k] for k in f.files}
+            keep = old['Day'] < np.datetime64(pd.Timestamp(keep_before).date())
+            # symbol codes of the new rows refer to their own symbol list, re-map both to the union
+            symbols = np.union1d(old['Symbols'], ledger['Symbols'])
+            old_code = np.searchsorted(symbols, old['Symbols'])[old['SymbolCode'][keep]]
+            new_code = np.searchsorted(symbols, ledger['Symbols'])[ledger['SymbolCode']]
+            ledger = {k: np.concatenate([old[k][keep], v]) for k, v in ledger.items() if k not in ['Symbols', 'SymbolCode']}
+            ledger['SymbolCode'] = np.concatenate([old_code, new_code]).astype(np.int16)
+            ledger['Symbols'] = symbols
+        np.savez_compressed(ledger_path, **ledger)
+
+    @staticmethod
+    def load_split_trades(ledger_path):
+        """
+        Read split_trades.npz written by generate_daily_pnl.
+        :return: DataFrame with columns TradeNo, Symbol, Day, Trade, Date, Price, Ex.Date, Ex.Price, Profit, Shares, Split
+        """
+        with np.load(ledger_path) as f:
+            ledger = pd.DataFrame({k: f[k] for k in f.files if k not in ['Symbols', 'SymbolCode']})
+            ledger.insert(1, 'Symbol', f['Symbols'][f['SymbolCode']])
+        return ledger
+
+    def generate_intraday_equity_strategy_root(self, bar_price_path, price_column='Close'):
+        """
+        Bar-resolution equity curve (intraday_equity.csv) for every strategy folder. The bar file is read once.
+        """
+        bar_times, bar_close = CalculateCustomMetrics.read_bar_data(bar_price_path, price_column)
+        max_dd = {}
+        for s in tqdm(os.listdir(self.strategy_root_path)):
+            s_path = os.path.join(self.strategy_root_path, s)
+            if os.path.isdir(s_path):
+                trade_data = CalculateCustomMetrics.read_trade_data(os.path.join(s_path, 'trades.csv'))
+                equity = CalculateCustomMetrics.cal_intraday_equity(trade_data, bar_times, bar_close)
+                equity.to_csv(os.path.join(s_path, 'intraday_equity.csv'), index=None)
+                max_dd[s] = equity['Drawdown'].max()
+        return pd.Series(max_dd, name='Max Intraday DD')
+
+    @staticmethod
+    def generate_intraday_equity(trade_file_path, bar_price_path, output_path, price_column='Close'):
+        """
+        Mark open trades to every bar of an intraday (3/5/15-minute) price file instead of the 16:30:01 daily close.
+        :return: max intraday drawdown (in points x shares, like daily_pnl.csv)
+        """
+        bar_times, bar_close = CalculateCustomMetrics.read_bar_data(bar_price_path, price_column)
+        trade_data = CalculateCustomMetrics.read_trade_data(trade_file_path)
+        equity = CalculateCustomMetrics.cal_intraday_equity(trade_data, bar_times, bar_close)
+        equity.to_csv(output_path, index=None)
+        return equity['Drawdown'].max()
+
+    @staticmethod
+    def read_bar_data(bar_price_path, price_column='Close'):
+        """
+        Read an intraday bar file. The bar time is taken from a 'Date/Time' or 'DateTime' column, or from 'Date' + 'Time'.
+        :return: (bar times as numpy datetime64 array sorted ascending, bar close as numpy float array)
+        """
+        msg_head = '[read_bar_data]'
+        bar_data = pd.read_csv(bar_price_path)
+        if 'Date/Time' in bar_data.columns:
+            date_strs = bar_data['Date/Time']
+        elif 'DateTime' in bar_data.columns:
+            date_strs = bar_data['DateTime']
+        elif 'Date' in bar_data.columns and 'Time' in bar_data.columns:
+            date_strs = bar_data['Date'].astype(str) + ' ' + bar_data['Time'].astype(str)
+        else:
+            raise ValueError('%s %s should have a "Date/Time", "DateTime" or "Date" + "Time" column'
+                             % (msg_head, bar_price_path))
+        if price_column not in bar_data.columns:
+            raise ValueError('%s "%s" must be in the columns' % (msg_head, price_column))
+
+        bar_times = parse_date_column(date_strs, bar_price_path, 'Date/Time').values.astype('datetime64[ns]')
+        bar_close = bar_data[price_column].values.astype(float)
+        valid = ~np.isnat(bar_times)
+        bar_times, bar_close = bar_times[valid], bar_close[valid]
+        order = np.argsort(bar_times, kind='stable')
+        return bar_times[order], bar_close[order]
+
+    @staticmethod
+    def cal_intraday_equity(trade_data, bar_times, bar_close):
+        """
+        Bar-level equity curve from position-state arrays, without looping over bars or trades.
+        A trade is open on the bars with entry time <= bar time < exit time and is marked to the bar close (less half of
+        its commission, as in generate_daily_pnl); from its exit bar on its Profit is realized. So
+            equity = realized + position * close - cost
+        where position, cost (sum of direction * shares * entry price + half commission) and realized are cumulative
+        sums of changes scattered to the entry / exit bars.
+        :param trade_data: DataFrame from read_trade_data
+        :return: DataFrame with columns DateTime, Position, Equity, Drawdown (from the first entry bar to the last exit bar)
+        """
+        bar_times = np.asarray(bar_times, dtype='datetime64[ns]')
+        bar_close = np.asarray(bar_close, dtype=float)
+        n = len(bar_times)
+
+        direction = trade_data['Trade'].values.astype(float)
+        shares = trade_data['Shares'].values.astype(float)
+        price = trade_data['Price'].values.astype(float)
+        profit = trade_data['Profit'].values.astype(float)
+        half_cost = 0.5 * (direction * (trade_data['Ex. Price'].values.astype(float) - price) - profit)
+        entry_bar = np.searchsorted(bar_times, trade_data['Date'].values.astype('datetime64[ns]'), side='left')
+        exit_bar = np.searchsorted(bar_times, trade_data['Ex.Date'].values.astype('datetime64[ns]'), side='left')
+
+        size = direction * shares
+        cost = size * price + half_cost * shares
+        # index n collects the changes of trades entering / exiting after the last bar
+        position = np.cumsum(np.bincount(entry_bar, weights=size, minlength=n + 1) -
+                             np.bincount(exit_bar, weights=size, minlength=n + 1))[:n]
+        open_cost = np.cumsum(np.bincount(entry_bar, weights=cost, minlength=n + 1) -
+                              np.bincount(exit_bar, weights=cost, minlength=n + 1))[:n]
+        realized = np.cumsum(np.bincount(exit_bar, weights=profit * shares, minlength=n + 1))[:n]
+        equity = realized + position * bar_close - open_cost
+
+        first = entry_bar.min() if len(entry_bar) > 0 else 0
+        last = min(exit_bar.max() + 1, n) if len(exit_bar) > 0 else 0
+        equity = equity[first:last]
+        return pd.DataFrame({
+            'DateTime': bar_times[first:last],
+            'Position': position[first:last],
+            'Equity': equity,
+            'Drawdown': np.maximum.accumulate(equity) - equity if len(equity) > 0 else equity
+        })
 
     @staticmethod
     def equity_curve_type_check(equity_curve, msg_head=''):
@@ -693,54 +980,35 @@ class CalculateCustomMetrics:
 
     @staticmethod
     def cal_profit_calendar_matrix(daily_pnl_data, current_path=None, ignore_zero_winrate=True, to_csv=True):
-        # pnl_data should be a pandas.DataFrame from 'daily_pnl.csv'
-        # pnl_data = pd.read_csv(pnl_path, parse_dates=['Date'],
-        #                        date_parser=lambda x: pd.datetime.strptime(x, '%Y-%m-%d'))
-        daily_pnl_data.loc[:, 'year'] = daily_pnl_data['Date'].apply(lambda x: x.year)
-        daily_pnl_data.loc[:, 'month'] = daily_pnl_data['Date'].apply(lambda x: x.month)
-        daily_pnl_data.loc[:, 'week'] = daily_pnl_data['Date'].apply(lambda x: x.week)
-
-        pnl_data_year = daily_pnl_data.groupby(by=['year'])['PnL'].sum()
-        pnl_data_year_month = daily_pnl_data.groupby(by=['year', 'month'])['PnL'].sum()
-        pnl_data_year_week = daily_pnl_data.groupby(by=['year', 'week'])['PnL'].sum()
+        """
+        Weekly / monthly / yearly pnl and win rates of a DataFrame from 'daily_pnl.csv' (see metrics_registry).
+        :param ignore_zero_winrate: win rates among the buckets with a non zero pnl, else among all the buckets
+        :param to_csv: write yearly_pnl.csv, monthly_pnl.csv and weekly_pnl.csv in current_path
+        :return: weekly_win_rate, monthly_win_rate, yearly_win_rate, weekly pnl, monthly pnl, yearly pnl
+        """
+        if to_csv and current_path is None:
+            raise ValueError('[cal_profit_calendar_matrix] if to_csv=True, current_path must not be None')
+        bucket_names = ['weekly_pnl', 'monthly_pnl', 'yearly_pnl']
+        rate_names = ['Weekly WinRate', 'Monthly WinRate', 'Yearly WinRate']
+        metrics = compute_metrics(bucket_names + (rate_names if ignore_zero_winrate else []),
+                                  daily_pnl=daily_pnl_data['PnL'].values, dates=daily_pnl_data['Date'].values)
 
         if to_csv:
-            if current_path is None:
-                raise ValueError('[cal_profit_calendar_matrix] if to_csv=True, current_path must not be None')
-            pnl_data_year.to_csv(os.path.join(current_path, 'yearly_pnl.csv'))
-            pnl_data_year_month.to_csv(os.path.join(current_path, 'monthly_pnl.csv'))
-            pnl_data_year_week.to_csv(os.path.join(current_path, 'weekly_pnl.csv'))
+            for name in reversed(bucket_names):
+                metrics[name].to_csv(os.path.join(current_path, name + '.csv'))
 
         if ignore_zero_winrate:
-            weekly_win_rate = pnl_data_year_week.apply(lambda x: 1 if x > 0 else 0).sum() / \
-                              len(pnl_data_year_week[pnl_data_year_week != 0])
-            monthly_win_rate = pnl_data_year_month.apply(lambda x: 1 if x > 0 else 0).sum() / \
-                               len(pnl_data_year_month[pnl_data_year_month != 0])
-            yearly_win_rate = pnl_data_year.apply(lambda x: 1 if x > 0 else 0).sum() / \
-                              len(pnl_data_year[pnl_data_year != 0])
+            win_rates = [metrics[name] for name in rate_names]
         else:
-            weekly_win_rate = pnl_data_year_week.apply(lambda x: 1 if x > 0 else 0).sum() / len(pnl_data_year_week)
-            monthly_win_rate = pnl_data_year_month.apply(lambda x: 1 if x > 0 else 0).sum() / len(pnl_data_year_month)
-            yearly_win_rate = pnl_data_year.apply(lambda x: 1 if x > 0 else 0).sum() / len(pnl_data_year)
-
-        return weekly_win_rate, monthly_win_rate, yearly_win_rate, pnl_data_year_week, pnl_data_year_month, pnl_data_year
+            win_rates = [(metrics[name] > 0).sum() / len(metrics[name]) for name in bucket_names]
+        return win_rates + [metrics[name] for name in bucket_names]
 
     @staticmethod
     def cal_slope(equity_curve):
         msg_head = '[cal_slope]'
         CalculateCustomMetrics.equity_curve_type_check(equity_curve, msg_head)
 
-        equity_curve = np.array(equity_curve)
-        y = equity_curve
-        x = np.array(list(range(len(y)))) + 1
-
-        x_bar = x.mean()
-        y_bar = y.mean()
-
-        v1 = ((x - x_bar) * (y - y_bar)).sum()
-        v2 = ((x - x_bar) ** 2).sum()
-
-        return v1 / v2
+        return float(slope_from_sums(*cal_regression_sums(np.array(equity_curve))))
 
     @staticmethod
     def cal_k_ratio(equity_curve):
@@ -752,26 +1020,7 @@ class CalculateCustomMetrics:
         msg_head = '[cal_k_ratio]'
         CalculateCustomMetrics.equity_curve_type_check(equity_curve, msg_head)
 
-        equity_curve = np.array(equity_curve)
-        y = equity_curve
-        x = np.array(list(range(len(y)))) + 1
-
-        x_bar = x.mean()
-        y_bar = y.mean()
-
-        v1 = (((x - x_bar) * (y - y_bar)).sum()) ** 2
-        v2 = ((x - x_bar)**2).sum()
-        v3 = ((y - y_bar)**2).sum()
-
-        steyx_v1 = math.sqrt(
-            1/(len(y) - 2) * (v3 - v1 / v2)
-        )
-        steyx_v2 = math.sqrt(v2)
-        steyx = steyx_v1 / steyx_v2
-
-        slope = math.sqrt(v1) / v2
-
-        return slope / steyx
+        return float(k_ratio_from_sums(*cal_regression_sums(np.array(equity_curve))))
 
     @staticmethod
     def cal_GPR(daily_pnl, method=1):
@@ -789,277 +1038,500 @@ class CalculateCustomMetrics:
             raise ValueError('%s \"Date\" and \"PnL\" must be in the columns' % msg_head)
 
         if method == 1:
-            daily_pnl.loc[:, 'month'] = daily_pnl['Date'].apply(lambda x: x.month)
-            daily_pnl.loc[:, 'year'] = daily_pnl['Date'].apply(lambda x: x.year)
-            monthly_pnl = daily_pnl.groupby(by=['year', 'month']).sum()
-            # print(monthly_pnl)
-            total_pnl = monthly_pnl['PnL'].sum()
-            total_loss = monthly_pnl[monthly_pnl['PnL'] < 0]['PnL'].sum() * -1
-            if total_loss == 0:
-                return 99999
-            else:
-                return total_pnl / total_loss
+            _, monthly_pnl = cal_monthly_pnl(daily_pnl['Date'].values, daily_pnl['PnL'].values.astype(float))
+            return float(gpr_from_monthly(monthly_pnl))
 
     @staticmethod
     def cal_mdd_n_mdd_period(equity_curve):
         msg_head = '[cal_mdd_n_mdd_period]'
         CalculateCustomMetrics.equity_curve_type_check(equity_curve, msg_head)
+        if isinstance(equity_curve, pd.DataFrame):
+            equity_curve = equity_curve.iloc[:, 0]
+        return cal_max_drawdown(equity_curve)
 
-        mdd = 0
-        mdd_period = 0
-        dd_period = 0
-        peak = equity_curve[0]
-        for x in equity_curve:
-            if x > peak:
-                peak = x
-                dd_period = 0
-            else:
-                dd_period += 1
-            if peak == 0:
-                peak = 1
-            dd = float(peak - x) / peak
-            if dd > mdd:
-                mdd = dd
-            if dd_period > mdd_period:
-                mdd_period = dd_period
-        return mdd, mdd_period
+    @staticmethod
+    def cal_metrics_strategies(pnl_matrix, metrics=None, trade_pnl_matrix=None):
+        """
+        Metrics of many strategies in one vectorized call (see metrics_registry).
+        :param pnl_matrix: DataFrame days x strategies (read_daily_pnl_matrix / load_daily_pnl_matrix), or a list of
+            strategy folders to read with read_daily_pnl_matrix (and read_trade_pnl_matrix if the metrics need trades)
+        :param metrics: names of metrics_registry, None for BATCH_METRICS
+        :param trade_pnl_matrix: DataFrame trades x strategies (read_trade_pnl_matrix), for the trade metrics
+        :return: DataFrame, one row per strategy
+        """
+        metrics = BATCH_METRICS if metrics is None else metrics
+        if not isinstance(pnl_matrix, pd.DataFrame):
+            if trade_pnl_matrix is None and 'trade_pnl' in required_inputs(metrics):
+                trade_pnl_matrix = CalculateCustomMetrics.read_trade_pnl_matrix(pnl_matrix)
+            pnl_matrix = CalculateCustomMetrics.read_daily_pnl_matrix(pnl_matrix)
+        return compute_metrics_table(metrics, pnl_matrix, trade_pnl_matrix)
+
+    @staticmethod
+    def cal_rolling_metrics_strategies(strategy_paths, windows=(None, 250), gpr_windows=(None, 12)):
+        """
+        Rolling / expanding K-ratio, slope, MDD, MDD period (daily) and GPR (monthly) of many strategies at once, to
+        follow the decay of live strategies (see rolling_metrics).
+        :param windows: window lengths in days, None for the expanding window
+        :param gpr_windows: window lengths in months, None for the expanding window
+        :return: (daily DataFrame, columns (Window, Metric, Strategy), monthly GPR DataFrame, columns (Window, Strategy))
+        """
+        pnl_matrix = CalculateCustomMetrics.read_daily_pnl_matrix(strategy_paths)
+        monthly_pnl = pnl_matrix.groupby(pnl_matrix.index.to_period('M')).sum()
+        return cal_rolling_metrics(pnl_matrix, windows), cal_rolling_gpr(monthly_pnl, gpr_windows)
 
     @staticmethod
     def cal_monte_carlo(pnl, initial_equity=50000, multiplier=10, times=10000, freq='daily',
-                        use_tqdm=False):
+                        use_tqdm=False, seed=None, seed_key=(), tolerance=None, return_times=False, percentiles=None,
+                        use_sketch=False, processes=1, method='shuffle', block_length=None, cache=None):
         """
                 Apply Monte Carlo method to a series of daily PnL and calculate the 90%, 70%, 50%, 30%, and 10% values for different metrics.
+                All paths are resampled and evaluated in chunks by monte_carlo_kernel (numpy reductions, no per-path
+                loop).
+                seed / seed_key: see simulate_monte_carlo, the same seed always gives the same table
+                tolerance: if given, paths are run in batches until the confidence interval of every percentile of
+                    MC_CONVERGENCE_METRICS is within tolerance (relative half width, e.g. 0.01), times is the maximum
+                return_times: if True, also return the number of paths used
+                percentiles: rows of the table, MC_PERCENTILES by default; add e.g. 0.99, 0.999 for the tails
+                use_sketch: keep the metrics in streaming quantile sketches (constant memory, for 1M+ paths)
+                processes: share the paths over a process pool (results don't depend on it)
+                method: 'shuffle' (default, random order of the days), 'block' (moving-block bootstrap) or 'stationary'
+                    (stationary bootstrap). The block methods keep the autocorrelation of pnl (see cal_acf_pacf)
+                block_length: (mean) block length of the block methods, None to choose it automatically (Politis-White)
+                cache: MonteCarloCache, the result of the same pnl and parameters is read from it instead of computed.
+                    Only used when a seed is given (a run without seed is meant to be random)
+                :return: list of rows (one per percentile, 90%, 70%, 50%, 30%, 10% by default), values in the order
+                    of MC_COLUMNS
                 """
         msg_head = '[cal_monte_carlo]'
         CalculateCustomMetrics.equity_curve_type_check(pnl, msg_head)
 
-        one_year_period_dict = {'daily': 356, 'quarterly': 4, 'monthly': 12, 'weekly': 52, 'trades':1000}
-        one_year_period = one_year_period_dict[freq.lower()]
-
-        pnl = np.array(pnl)
-        equity_curve_raw = pnl
-        MDD = []
-        MDD_PERIOD = []
-        MAX_EQUITY = []
-        MIN_EQUITY = []
-        CAR_MDD = []
-        END_EQUITY = []
-        CAR = []
-        INIT_EQUITY = []
-        MONTHLY_WINRATE = []
-        WEEKLY_WINRATE = []
-        QUARTERLY_WINRATE = []
-
-        ra = tqdm(range(times)) if use_tqdm else range(times)
-        for i in ra:
-            # print(i)
-            random.shuffle(pnl)
-            cum_pnl = pnl.cumsum()
-            cum_pnl = initial_equity + multiplier * cum_pnl
-            # print(type(cum_pnl))
-            mdd, mdd_period = CalculateCustomMetrics.cal_mdd_n_mdd_period(cum_pnl)
-            car = math.log(cum_pnl[-1] / initial_equity) / (len(pnl) / one_year_period)
-
-            MDD.append(abs(mdd))
-            MDD_PERIOD.append(mdd_period)
-            MAX_EQUITY.append(max(cum_pnl))
-            MIN_EQUITY.append(min(cum_pnl))
-            CAR_MDD.append(car / abs(mdd) if mdd > 0 else 9999)
-            END_EQUITY.append(cum_pnl[-1])
-            CAR.append(car)
-            INIT_EQUITY.append(initial_equity)
-
-            temp_pnl = pd.DataFrame({'pnl': pnl, 'ind': list(range(len(pnl)))})
-            temp_pnl.loc[:, 'week'] = temp_pnl['ind'].apply(lambda x: (x - x % 5) / 5)
-            temp_pnl.loc[:, 'month'] = temp_pnl['ind'].apply(lambda x: (x - x % 20) / 20)
-            temp_pnl.loc[:, 'quarter'] = temp_pnl['ind'].apply(lambda x: (x - x % 60) / 60)
-
-            weekly_pnl = temp_pnl.groupby(by=['week']).sum()
-            weekly_winrate = len(weekly_pnl[weekly_pnl['pnl'] > 0]) / len(weekly_pnl)
-            monthly_pnl = temp_pnl.groupby(by=['month']).sum()
-            monthly_winrate = len(monthly_pnl[monthly_pnl['pnl'] > 0]) / len(monthly_pnl)
-            quarterly_pnl = temp_pnl.groupby(by=['quarter']).sum()
-            quarterly_winrate = len(quarterly_pnl[quarterly_pnl['pnl'] > 0]) / len(quarterly_pnl)
-            WEEKLY_WINRATE.append(weekly_winrate)
-            MONTHLY_WINRATE.append(monthly_winrate)
-            QUARTERLY_WINRATE.append(quarterly_winrate)
-
-            # WEEKLY_WINRATE.append(0)
-            # MONTHLY_WINRATE.append(0)
-
-            pnl = equity_curve_raw
-
-        MDD = sorted(MDD)  # ascending
-        MDD_PERIOD = sorted(MDD_PERIOD)  # ascending
-        MAX_EQUITY = sorted(MAX_EQUITY, reverse=True)  # descending
-        MIN_EQUITY = sorted(MIN_EQUITY, reverse=True)  # descending
-        CAR_MDD = sorted(CAR_MDD, reverse=True)  # descending
-        WEEKLY_WINRATE = sorted(WEEKLY_WINRATE, reverse=True)  # descending
-        MONTHLY_WINRATE = sorted(MONTHLY_WINRATE, reverse=True)  # descending
-        QUARTERLY_WINRATE = sorted(QUARTERLY_WINRATE, reverse=True)  # descending
-
-        n_90 = int(math.floor(len(MDD)*0.9))
-        n_70 = int(math.floor(len(MDD)*0.7))
-        n_50 = int(math.floor(len(MDD)*0.5))
-        n_30 = int(math.floor(len(MDD)*0.3))
-        n_10 = int(math.floor(len(MDD)*0.1))
-
-        # print(MDD[0:10])
-        # print(MDD_PERIOD[0:10])
-        # print(MAX_EQUITY[0:10])
-        # print(MIN_EQUITY[0:10])
-        # print(CAR_MDD[0:10])
-
-        return [
-            [MDD[n_90], MDD_PERIOD[n_90], MAX_EQUITY[n_90], MIN_EQUITY[n_90], CAR_MDD[n_90],
-             CAR[n_90], END_EQUITY[n_90], INIT_EQUITY[n_90],
-             WEEKLY_WINRATE[n_90], MONTHLY_WINRATE[n_90], QUARTERLY_WINRATE[n_90]],
-            [MDD[n_70], MDD_PERIOD[n_70], MAX_EQUITY[n_70], MIN_EQUITY[n_70], CAR_MDD[n_70],
-             CAR[n_70], END_EQUITY[n_70], INIT_EQUITY[n_70],
-             WEEKLY_WINRATE[n_70], MONTHLY_WINRATE[n_70], QUARTERLY_WINRATE[n_70]],
-            [MDD[n_50], MDD_PERIOD[n_50], MAX_EQUITY[n_50], MIN_EQUITY[n_50], CAR_MDD[n_50],
-             CAR[n_50], END_EQUITY[n_50], INIT_EQUITY[n_50],
-             WEEKLY_WINRATE[n_50], MONTHLY_WINRATE[n_50], QUARTERLY_WINRATE[n_50]],
-            [MDD[n_30], MDD_PERIOD[n_30], MAX_EQUITY[n_30], MIN_EQUITY[n_30], CAR_MDD[n_30],
-             CAR[n_30], END_EQUITY[n_30], INIT_EQUITY[n_30],
-             WEEKLY_WINRATE[n_30], MONTHLY_WINRATE[n_30], QUARTERLY_WINRATE[n_30]],
-            [MDD[n_10], MDD_PERIOD[n_10], MAX_EQUITY[n_10], MIN_EQUITY[n_10], CAR_MDD[n_10],
-             CAR[n_10], END_EQUITY[n_10], INIT_EQUITY[n_10],
-             WEEKLY_WINRATE[n_10], MONTHLY_WINRATE[n_10], QUARTERLY_WINRATE[n_10]]
-            ]
+        if tolerance is not None and use_sketch:
+            raise ValueError(msg_head + ' tolerance (adaptive mode) can not be used with use_sketch.')
+        one_year_period = ONE_YEAR_PERIOD[freq.lower()]
+
+        def run():
+            if tolerance is None:
+                metrics = simulate_monte_carlo(pnl, initial_equity=initial_equity, multiplier=multiplier, times=times,
+                                               one_year_period=one_year_period, seed=seed, seed_key=seed_key,
+                                               use_tqdm=use_tqdm, use_sketch=use_sketch, processes=processes,
+                                               method=method, block_length=block_length)
+                return cal_percentile_table(metrics, percentiles), times
+            metrics, times_used = simulate_monte_carlo_adaptive(
+                pnl, initial_equity=initial_equity, multiplier=multiplier, one_year_period=one_year_period,
+                tolerance=tolerance, min_times=min(MC_MIN_TIMES, times), max_times=times, percentiles=percentiles,
+                seed=seed, seed_key=seed_key, use_tqdm=use_tqdm, method=method, block_length=block_length)
+            return cal_percentile_table(metrics, percentiles), times_used
+
+        if cache is not None and seed is not None:
+            params = {'initial_equity': initial_equity, 'multiplier': multiplier, 'times': times,
+                      'freq': freq.lower(), 'seed': seed, 'seed_key': list(seed_key), 'tolerance': tolerance,
+                      'percentiles': percentiles, 'use_sketch': use_sketch, 'method': method,
+                      'block_length': block_length}
+            table, times_used = cache.get_or_compute(np.asarray(pnl, dtype=float), params, run)
+        else:
+            table, times_used = run()
+        if return_times:
+            return table, times_used
+        return table
 
     @staticmethod
-    def cal_monte_carlo_one_strategy(strategy_path, mc_times=10000, use_daily_pnl=True, use_trade_pnl=False):
-        # ignore_zero_winrate - if to ignore zero when calculate win rate
-        # must ensure that 'daily_pnl.csv' is in place
-        mc_root = os.path.join(strategy_path, 'MonteCarlo2')
-        if not os.path.exists(mc_root):
-            os.mkdir(mc_root)
-
-        year_list = None
-        daily_pnl_data = None
-        pnl_data_year_daily = None
+    def read_monte_carlo_pnl(strategy_path, use_daily_pnl=True, use_trade_pnl=False):
+        """
+        PnL series used by the Monte Carlo of one strategy, summed per date and sorted by date.
+        :return: dict freq ('daily' / 'trades') -> (pnl numpy array, numpy array with the year of each value)
+        """
+        pnl_data = {}
         if use_daily_pnl:
             daily_pnl_data = pd.read_csv(os.path.join(strategy_path, 'daily_pnl.csv'), parse_dates=['Date'])
-            daily_pnl_data.loc[:, 'year'] = daily_pnl_data['Date'].apply(lambda x: x.year)
-            daily_pnl_data.loc[:, 'month'] = daily_pnl_data['Date'].apply(lambda x: x.month)
-            daily_pnl_data.loc[:, 'week'] = daily_pnl_data['Date'].apply(lambda x: x.week)
+            daily_pnl = daily_pnl_data.groupby(by=['Date'])['PnL'].sum()
+            pnl_data['daily'] = (daily_pnl.values.astype(float), daily_pnl.index.year.values)
+        if use_trade_pnl:
+            trade_file_path = os.path.join(strategy_path, 'trades.csv')
+            trade_pnl_data = pd.read_csv(trade_file_path)
+            trade_pnl_data['Date'] = parse_date_column(trade_pnl_data['Date'], trade_file_path, 'Date')
+            trade_pnl = trade_pnl_data.groupby(by=['Date'])['Profit'].sum()
+            pnl_data['trades'] = (trade_pnl.values.astype(float), trade_pnl.index.year.values)
+        return pnl_data
 
-            year_list = daily_pnl_data['Date'].apply(lambda x: x.year).unique()
-            year_list = np.insert(year_list, 0, 0)
+    @staticmethod
+    def monte_carlo_year_ranges(years):
+        """
+        :param years: year of each value of a pnl series sorted by date
+        :return: list of (year, start, end), the first one (year 0) is the whole series
+        """
+        if len(years) == 0:
+            return []
+        uniq, starts = np.unique(years, return_index=True)
+        ends = np.append(starts[1:], len(years))
+        return [(0, 0, len(years))] + [(int(y), int(s), int(e)) for y, s, e in zip(uniq, starts, ends)]
 
-            pnl_data_year_daily = daily_pnl_data.groupby(by=['year', 'Date'])['PnL'].sum()
-            pnl_data_year_month = daily_pnl_data.groupby(by=['year', 'month'])['PnL'].sum()
-            pnl_data_year_week = daily_pnl_data.groupby(by=['year', 'week'])['PnL'].sum()
+    @staticmethod
+    def cal_monte_carlo_sizing(pnl, scenarios, times=10000, freq='daily', use_tqdm=False, seed=None, seed_key=(),
+                               percentiles=None, method='shuffle', block_length=None):
+        """
+        Sizing study: Monte Carlo of pnl under several (initial_equity, multiplier, rule) scenarios, all evaluated on one
+        shared set of resampled paths (see simulate_sizing_scenarios), e.g.
+            [(50000, 10, 'fixed'), (100000, 10, 'fixed'), (50000, 10, 'fractional')]
+        rule is 'fixed' (default if omitted) or 'fractional' (position resized with the equity).
+        :param seed, seed_key, percentiles, method, block_length: see cal_monte_carlo
+        :return: DataFrame, rows (scenario, metric) with scenario as 'initial_equity/multiplier/rule', one column per
+            percentile (scenario x metric x percentile cube)
+        """
+        msg_head = '[cal_monte_carlo_sizing]'
+        CalculateCustomMetrics.equity_curve_type_check(pnl, msg_head)
+        scenarios = [tuple(s) if len(s) == 3 else tuple(s) + ('fixed', ) for s in scenarios]
+        if len(scenarios) == 0 or any(len(s) != 3 for s in scenarios):
+            raise ValueError(msg_head + ' scenarios must be a non-empty list of (initial_equity, multiplier[, rule]).')
+
+        metrics = simulate_sizing_scenarios(
+            pnl, scenarios, times=times, one_year_period=ONE_YEAR_PERIOD[freq.lower()], seed=seed,
+            seed_key=seed_key, use_tqdm=use_tqdm, method=method, block_length=block_length)
+        tables = []
+        for (initial_equity, multiplier, rule), scenario_metrics in zip(scenarios, metrics):
+            table = pd.DataFrame(cal_percentile_table(scenario_metrics, percentiles), columns=MC_COLUMNS,
+                                 index=percentile_labels(percentiles)).transpose()
+            table.index = pd.MultiIndex.from_product(
+                [['%g/%g/%s' % (initial_equity, multiplier, rule)], table.index], names=['Scenario', 'Metric'])
+            tables.append(table)
+        return pd.concat(tables)
 
-        trade_pnl_data = None
-        trade_pnl_data_year_daily = None
-        if use_trade_pnl:
-            trade_pnl_data = pd.read_csv(os.path.join(strategy_path, 'trades.csv'), parse_dates=['Date'],
-                                         date_parser=lambda x: pd.datetime.strptime(x, '%m/%d/%Y %I:%M:%S %p'))
-            trade_pnl_data.loc[:, 'year'] = trade_pnl_data['Date'].apply(lambda x: x.year)
-            trade_pnl_data.loc[:, 'month'] = trade_pnl_data['Date'].apply(lambda x: x.month)
-            trade_pnl_data.loc[:, 'week'] = trade_pnl_data['Date'].apply(lambda x: x.week)
+    @staticmethod
+    def read_daily_pnl_matrix(strategy_paths):
+        """
+        daily_pnl.csv of several strategy folders as one days x strategies table (0 on the days a strategy has no pnl).
+        :return: DataFrame, index = Date, one column per strategy folder
+        """
+        pnl_list = []
+        for strategy_path in strategy_paths:
+            daily_pnl = pd.read_csv(os.path.join(strategy_path, 'daily_pnl.csv'), parse_dates=['Date'])
+            pnl_list.append(daily_pnl.groupby(by=['Date'])['PnL'].sum().rename(
+                os.path.basename(os.path.normpath(strategy_path))))
+        if len(pnl_list) == 0:
+            raise ValueError('[read_daily_pnl_matrix] strategy_paths is empty')
+        return pd.concat(pnl_list, axis=1).sort_index().fillna(0)
 
-            trade_pnl_data_year_daily = trade_pnl_data.groupby(by=['year', 'Date'])['Profit'].sum()
+    @staticmethod
+    def read_trade_pnl_matrix(strategy_paths):
+        """
+        Profit of trades.csv of several strategy folders as one trades x strategies table, padded with NaN after the
+        last trade of the strategies with fewer trades.
+        :return: DataFrame, one column per strategy folder
+        """
+        if len(strategy_paths) == 0:
+            raise ValueError('[read_trade_pnl_matrix] strategy_paths is empty')
+        profit_list = [pd.read_csv(os.path.join(strategy_path, 'trades.csv'))['Profit'].reset_index(drop=True).rename(
+            os.path.basename(os.path.normpath(strategy_path))) for strategy_path in strategy_paths]
+        return pd.concat(profit_list, axis=1)
 
-            year_list = trade_pnl_data['Date'].apply(lambda x: x.year).unique()
-            year_list = np.insert(year_list, 0, 0)
+    @staticmethod
+    def cal_portfolio_monte_carlo(pnl_matrix, weights, initial_equity=50000, multiplier=10, times=10000, freq='daily',
+                                  use_tqdm=False, seed=None, seed_key=(), percentiles=None, method='shuffle',
+                                  block_length=None):
+        """
+        Joint Monte Carlo of candidate portfolios: whole days are resampled so the cross-strategy correlation is kept,
+        and all the weight vectors are evaluated on the same paths (see simulate_portfolio_monte_carlo).
+        :param pnl_matrix: DataFrame days x strategies (e.g. from read_daily_pnl_matrix or load_daily_pnl_matrix), or a
+            list of strategy folders to read with read_daily_pnl_matrix
+        :param weights: DataFrame portfolios x strategies (index = portfolio name, columns matched to pnl_matrix), or a
+            2-D array / list of weight vectors in the column order of pnl_matrix
+        :param seed, seed_key, percentiles, method, block_length: see cal_monte_carlo
+        :return: DataFrame, rows (portfolio, metric), one column per percentile
+        """
+        msg_head = '[cal_portfolio_monte_carlo]'
+        if not isinstance(pnl_matrix, pd.DataFrame):
+            pnl_matrix = CalculateCustomMetrics.read_daily_pnl_matrix(pnl_matrix)
+        if isinstance(weights, pd.DataFrame):
+            missing = [c for c in weights.columns if c not in pnl_matrix.columns]
+            if len(missing) > 0:
+                raise ValueError(msg_head + ' no pnl for strategies %s' % missing)
+            names = [str(i) for i in weights.index]
+            weights = weights.reindex(columns=pnl_matrix.columns).fillna(0).values
+        else:
+            weights = np.atleast_2d(np.asarray(weights, dtype=float))
+            names = ['Portfolio %d' % i for i in range(len(weights))]
+        if weights.shape[1] != pnl_matrix.shape[1]:
+            raise ValueError(msg_head + ' weights must have one value per strategy (%d)' % pnl_matrix.shape[1])
+
+        metrics = simulate_portfolio_monte_carlo(
+            pnl_matrix.values, weights, initial_equity=initial_equity, multiplier=multiplier, times=times,
+            one_year_period=ONE_YEAR_PERIOD[freq.lower()], seed=seed, seed_key=seed_key, use_tqdm=use_tqdm,
+            method=method, block_length=block_length)
+        tables = []
+        for name, portfolio_metrics in zip(names, metrics):
+            table = pd.DataFrame(cal_percentile_table(portfolio_metrics, percentiles), columns=MC_COLUMNS,
+                                 index=percentile_labels(percentiles)).transpose()
+            table.index = pd.MultiIndex.from_product([[name], table.index], names=['Portfolio', 'Metric'])
+            tables.append(table)
+        return pd.concat(tables)
 
-        pnl_data = {
-            'daily': pnl_data_year_daily,
-            'trades': trade_pnl_data_year_daily
-            # 'weekly': pnl_data_year_week, 'monthly': pnl_data_year_month
-        }
-        # print(trade_pnl_data_year_daily)
-        # method 1: e.g. weekly -> random
-        initial_equity = 50000
-        for freq, data in pnl_data.items():
-            if data is None or len(data) == 0:
-                continue
-            excel_writer = pd.ExcelWriter(os.path.join(mc_root, freq + '.xls'))
-            for year in year_list:
-                print('%s: year = %d' % (freq, year))
-                this_year_data = data.loc[(year, )] if year > 0 else data
-
-                mc_res_this_year = CalculateCustomMetrics.cal_monte_carlo(
-                    this_year_data, freq=freq, use_tqdm=True, initial_equity=initial_equity, times=mc_times
-                )
-                mc_res_this_year = pd.DataFrame(
-                    mc_res_this_year,
-                    columns=['MDD', 'MDD_Period', 'Max_Equity', 'Min_Equity', 'CAR/MDD', 'CAR', 'End_Equity',
-                             'Init_Equity', 'Weekly_Win_Rate', 'Monthly_Win_Rate', 'Quarterly_Win_Rate'],
-                    index=['90%', '70%', '50%', '30%', '10%'])
-                winrate_ignore_zero = len(this_year_data[this_year_data > 0]) / (
-                        len(this_year_data[this_year_data != 0])
-                )
-                winrate_consider_zero = len(this_year_data[this_year_data > 0]) / (len(this_year_data))
-                mc_res_this_year.loc[:, 'Win_Rate_Ignore0'] = winrate_ignore_zero
-                mc_res_this_year.loc[:, 'Win_Rate_Consider0'] = winrate_consider_zero
-                # mc_res_this_year.loc[:, 'Initial_equity'] = initial_equity
-                required_columns = ['MDD', 'MDD_Period', 'Init_Equity', 'Max_Equity', 'Min_Equity', 'End_Equity']
-                if freq == 'daily':
-                    required_columns.extend(['CAR/MDD', 'Win_Rate_Ignore0', 'Win_Rate_Consider0',
-                                             'Weekly_Win_Rate', 'Monthly_Win_Rate', 'Quarterly_Win_Rate'])
-                if freq == 'trades':
-                    required_columns.extend(['Win_Rate_Ignore0', 'Win_Rate_Consider0'])
-                mc_res_this_year = mc_res_this_year[required_columns]
-                mc_res_this_year = mc_res_this_year.transpose()
-                mc_res_this_year.to_excel(excel_writer, sheet_name=str(year) if year > 0 else 'All year')
-            excel_writer.save()
-
-        # method 2: e.g. random -> weekly sampling -> random
-        for freq in []:
-        # for freq in ['weekly', 'monthly']:
-            excel_writer = pd.ExcelWriter(os.path.join(mc_root, freq + '_method2.xls'))
-            unit_days = 5 if freq == 'weekly' else 20
-            for year in year_list:
-                this_year_data = pnl_data_year_daily.loc[(year, )] if year > 0 else pnl_data_year_daily
-                random_data = this_year_data.sample(frac=1)
-                random_data = random_data.reset_index(drop=True)
-                random_data_df = pd.DataFrame({'PnL': random_data, 'ind':random_data.index})
-                random_data_df.loc[:, 'ind2'] = random_data_df['ind'].apply(lambda x: (x - x % unit_days) / unit_days)
-
-                this_year_data = random_data_df.groupby(by=['ind2'])['PnL'].sum()
-
-                mc_res_this_year = CalculateCustomMetrics.cal_monte_carlo(
-                    this_year_data, freq=freq, use_tqdm=True, initial_equity=initial_equity, times=mc_times
-                )
-                mc_res_this_year = pd.DataFrame(
-                    mc_res_this_year,
-                    columns=['MDD', 'MDD_Period', 'Max_Equity', 'Min_Equity', 'CAR/MDD', 'CAR', 'End_Equity',
-                             'Init_Equity', 'Weekly_Win_Rate', 'Monthly_Win_Rate', 'Quarterly_Win_Rate'],
-                    index=['90%', '70%', '50%', '30%', '10%'])
-                winrate_ignore_zero = len(this_year_data[this_year_data > 0]) / (
-                    len(this_year_data[this_year_data != 0])
-                )
-                winrate_consider_zero = len(this_year_data[this_year_data > 0]) / (len(this_year_data))
-                mc_res_this_year.loc[:, 'Win_Rate_Ignore0'] = winrate_ignore_zero
-                mc_res_this_year.loc[:, 'Win_Rate_Consider0'] = winrate_consider_zero
-                # mc_res_this_year.loc[:, 'Initial_equity'] = initial_equity
-                mc_res_this_year = mc_res_this_year[[
-                    'MDD', 'MDD_Period', 'Init_Equity', 'Max_Equity', 'Min_Equity', 'End_Equity',
-                    'CAR/MDD', 'Win_Rate_Ignore0', 'Win_Rate_Consider0',
-                    'Weekly_Win_Rate', 'Monthly_Win_Rate', 'Quarterly_Win_Rate'
-                ]]
-                mc_res_this_year = mc_res_this_year.transpose()
-                mc_res_this_year.to_excel(excel_writer, sheet_name=str(year) if year > 0 else 'All year')
-            excel_writer.save()
+    @staticmethod
+    def cal_monte_carlo_segments(pnl, segment_bounds, initial_equity=50000, multiplier=10, times=10000, freq='daily',
+                                 use_tqdm=False, seed=None, seed_key=(), percentiles=None, cache=None):
+        """
+        Monte Carlo of every segment of pnl (e.g. every year) in one vectorized pass, the days being permuted within
+        their segment (see simulate_monte_carlo_segments).
+        :param segment_bounds: list of (start, end) of the segments, in order and covering pnl
+        :param seed, seed_key, percentiles, cache: see cal_monte_carlo
+        :return: list of tables (one per segment), each as returned by cal_monte_carlo
+        """
+        msg_head = '[cal_monte_carlo_segments]'
+        CalculateCustomMetrics.equity_curve_type_check(pnl, msg_head)
+        one_year_period = ONE_YEAR_PERIOD[freq.lower()]
+        segment_bounds = [(int(start), int(end)) for start, end in segment_bounds]
+
+        def run():
+            metrics = simulate_monte_carlo_segments(
+                pnl, segment_bounds, initial_equity=initial_equity, multiplier=multiplier, times=times,
+                one_year_period=one_year_period, seed=seed, seed_key=seed_key, use_tqdm=use_tqdm)
+            return [cal_percentile_table(m, percentiles) for m in metrics], times
+
+        if cache is not None and seed is not None:
+            params = {'initial_equity': initial_equity, 'multiplier': multiplier, 'times': times,
+                      'freq': freq.lower(), 'seed': seed, 'seed_key': list(seed_key), 'percentiles': percentiles,
+                      'segment_bounds': segment_bounds}
+            tables, _ = cache.get_or_compute(np.asarray(pnl, dtype=float), params, run)
+            return tables
+        return run()[0]
+
+    @staticmethod
+    def format_monte_carlo_table(mc_res, pnl, freq, percentiles=None, mc_times_used=None):
+        """
+        One sheet of MonteCarlo2/<freq>.xlsx from the rows of cal_monte_carlo: adds the win rates of pnl and keeps the
+        columns relevant to freq.
+        :param mc_times_used: added as the MC_Times row if given
+        :return: DataFrame, one row per metric and one column per percentile
+        """
+        pnl = np.asarray(pnl, dtype=float)
+        mc_res = pd.DataFrame(mc_res, columns=MC_COLUMNS, index=percentile_labels(percentiles))
+        n_non_zero = np.count_nonzero(pnl)
+        mc_res.loc[:, 'Win_Rate_Ignore0'] = (pnl > 0).sum() / n_non_zero if n_non_zero > 0 else np.nan
+        mc_res.loc[:, 'Win_Rate_Consider0'] = (pnl > 0).sum() / len(pnl)
+        required_columns = ['MDD', 'MDD_Period', 'Init_Equity', 'Max_Equity', 'Min_Equity', 'End_Equity']
+        if freq == 'daily':
+            required_columns.extend(['CAR/MDD', 'Win_Rate_Ignore0', 'Win_Rate_Consider0',
+                                     'Weekly_Win_Rate', 'Monthly_Win_Rate', 'Quarterly_Win_Rate'])
+        if freq == 'trades':
+            required_columns.extend(['Win_Rate_Ignore0', 'Win_Rate_Consider0'])
+        if mc_times_used is not None:
+            mc_res.loc[:, 'MC_Times'] = mc_times_used
+            required_columns.append('MC_Times')
+        return mc_res[required_columns].transpose()
+
+    @staticmethod
+    def cal_monte_carlo_table(pnl, freq, mc_times=10000, initial_equity=50000, seed=None, year=0, use_tqdm=False,
+                              tolerance=None, percentiles=None, use_sketch=False, method='shuffle', block_length=None,
+                              cache=None):
+        """
+        One sheet of MonteCarlo2/<freq>.xlsx: the Monte Carlo percentiles of pnl plus its win rates.
+        The random stream is keyed by (freq, year), so a sheet doesn't depend on which process computed it.
+        :param tolerance: adaptive mode of cal_monte_carlo (mc_times is then the maximum), the number of paths used is
+            added as the MC_Times row
+        :param percentiles, use_sketch, method, block_length, cache: see cal_monte_carlo
+        :return: DataFrame, one row per metric and one column per percentile
+        """
+        pnl = np.asarray(pnl, dtype=float)
+        mc_res, mc_times_used = CalculateCustomMetrics.cal_monte_carlo(
+            pnl, freq=freq, use_tqdm=use_tqdm, initial_equity=initial_equity, times=mc_times, seed=seed,
+            seed_key=(MC_FREQ_CODES[freq], year), tolerance=tolerance, return_times=True, percentiles=percentiles,
+            use_sketch=use_sketch, method=method, block_length=block_length, cache=cache)
+        return CalculateCustomMetrics.format_monte_carlo_table(
+            mc_res, pnl, freq, percentiles, mc_times_used if tolerance is not None else None)
+
+    @staticmethod
+    def monte_carlo_units(years, segmented=True):
+        """
+        Units of work of the Monte Carlo of one pnl series: the whole series (year 0), then either one segmented unit
+        for all the years (year None) or one unit per year.
+        :return: list of (year, start, end, segment ranges), segment ranges being (year, start, end) for the segmented
+            unit and None otherwise
+        """
+        year_ranges = CalculateCustomMetrics.monte_carlo_year_ranges(years)
+        if len(year_ranges) == 0:
+            return []
+        if segmented:
+            return [(0, 0, len(years), None), (None, 0, len(years), year_ranges[1:])]
+        return [(year, start, end, None) for year, start, end in year_ranges]
+
+    @staticmethod
+    def run_monte_carlo_unit(pnl, freq, year, segments, mc_times=10000, seed=None, use_tqdm=False, **table_kwargs):
+        """
+        Run one unit of monte_carlo_units on its pnl.
+        :return: dict year -> sheet (DataFrame)
+        """
+        if year is not None:
+            return {year: CalculateCustomMetrics.cal_monte_carlo_table(
+                pnl, freq, mc_times=mc_times, seed=seed, year=year, use_tqdm=use_tqdm, **table_kwargs)}
+        percentiles = table_kwargs.get('percentiles')
+        mc_res = CalculateCustomMetrics.cal_monte_carlo_segments(
+            pnl, [(start, end) for _, start, end in segments], times=mc_times, freq=freq, use_tqdm=use_tqdm,
+            seed=seed, seed_key=(MC_FREQ_CODES[freq], MC_SEGMENTED_SEED_KEY), percentiles=percentiles,
+            cache=table_kwargs.get('cache'))
+        return {seg_year: CalculateCustomMetrics.format_monte_carlo_table(res, pnl[start:end], freq, percentiles)
+                for res, (seg_year, start, end) in zip(mc_res, segments)}
+
+    @staticmethod
+    def write_monte_carlo_tables(mc_root, freq, tables):
+        """
+        :param tables: dict year -> table from cal_monte_carlo_table, year 0 is written as the 'All year' sheet
+        """
+        if not os.path.exists(mc_root):
+            os.mkdir(mc_root)
+        with pd.ExcelWriter(os.path.join(mc_root, freq + '.xlsx')) as excel_writer:
+            for year in sorted(tables):
+                tables[year].to_excel(excel_writer, sheet_name=str(year) if year > 0 else 'All year')
+
+    @staticmethod
+    def cal_monte_carlo_one_strategy(strategy_path, mc_times=10000, use_daily_pnl=True, use_trade_pnl=False,
+                                     processes=1, seed=None, tolerance=None, percentiles=None, use_sketch=False,
+                                     method='shuffle', block_length=None, cache=None):
+        """
+        Monte Carlo of the whole period and of every year of one strategy, written to MonteCarlo2/daily.xlsx and
+        MonteCarlo2/trades.xlsx. Must ensure that 'daily_pnl.csv' (use_daily_pnl) / 'trades.csv' (use_trade_pnl) are in
+        place.
+        :param processes: if > 1, the years and frequencies are run in a process pool (see cal_monte_carlo_strategies)
+        :param seed: int, the results are the same for a given seed whatever processes is. None for a random seed
+        :param tolerance: adaptive number of paths (up to mc_times), see cal_monte_carlo
+        :param percentiles: columns of the sheets, see cal_monte_carlo
+        :param use_sketch: streaming quantile sketches instead of keeping every path, see cal_monte_carlo
+        :param method, block_length: resampling method ('shuffle', 'block', 'stationary'), see cal_monte_carlo
+        :param cache: MonteCarloCache, sheets already computed with the same pnl and parameters are not recomputed
+        With the default shuffle method the years are run together in one segmented pass (cal_monte_carlo_segments);
+        with tolerance, use_sketch or a block method every year is run on its own.
+        """
+        if processes > 1:
+            CalculateCustomMetrics.cal_monte_carlo_strategies(
+                [strategy_path], mc_times=mc_times, use_daily_pnl=use_daily_pnl, use_trade_pnl=use_trade_pnl,
+                processes=processes, seed=seed, tolerance=tolerance, percentiles=percentiles, use_sketch=use_sketch,
+                method=method, block_length=block_length, cache=cache)
+            return
+
+        if seed is None:
+            # a generated seed is never asked for again, its results would only fill the cache
+            cache = None
+            seed = np.random.SeedSequence().entropy
+        print('[cal_monte_carlo_one_strategy] seed = %d' % seed)
+
+        mc_root = os.path.join(strategy_path, 'MonteCarlo2')
+        segmented = tolerance is None and not use_sketch and method == 'shuffle'
+        table_kwargs = {'tolerance': tolerance, 'percentiles': percentiles, 'use_sketch': use_sketch,
+                        'method': method, 'block_length': block_length, 'cache': cache}
+        pnl_data = CalculateCustomMetrics.read_monte_carlo_pnl(strategy_path, use_daily_pnl, use_trade_pnl)
+        for freq, (pnl, years) in pnl_data.items():
+            tables = {}
+            for year, start, end, segments in CalculateCustomMetrics.monte_carlo_units(years, segmented):
+                print('%s: year = %s' % (freq, 'all segments' if year is None else year))
+                tables.update(CalculateCustomMetrics.run_monte_carlo_unit(
+                    pnl[start:end], freq, year, segments, mc_times=mc_times, seed=seed, use_tqdm=True,
+                    **table_kwargs))
+            if len(tables) > 0:
+                CalculateCustomMetrics.write_monte_carlo_tables(mc_root, freq, tables)
+
+    @staticmethod
+    def monte_carlo_unit_worker(shm_name, shm_size, start, end, freq, year, segments, mc_times, seed, table_kwargs):
+        """
+        Pool worker of cal_monte_carlo_strategies: reads pnl[start:end] from the shared memory block and runs one unit
+        (see run_monte_carlo_unit).
+        """
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            shared_pnl = np.ndarray(shm_size, dtype=np.float64, buffer=shm.buf)
+            pnl = shared_pnl[start:end].copy()
+            del shared_pnl
+        finally:
+            shm.close()
+        return CalculateCustomMetrics.run_monte_carlo_unit(pnl, freq, year, segments, mc_times=mc_times, seed=seed,
+                                                           **table_kwargs)
+
+    @staticmethod
+    def cal_monte_carlo_strategies(strategy_paths, mc_times=10000, use_daily_pnl=True, use_trade_pnl=False,
+                                   processes=None, seed=None, tolerance=None, percentiles=None, use_sketch=False,
+                                   method='shuffle', block_length=None, cache=None):
+        """
+        Monte Carlo of many strategies in parallel. Every (strategy, freq, unit of monte_carlo_units) is one unit of work
+        for a process pool.
+        The pnl series of all strategies are copied once into a shared memory block that the workers read from, and the
+        results are collected into MonteCarlo2 of each strategy as in cal_monte_carlo_one_strategy.
+        :param processes: pool size, multiprocessing.cpu_count() by default
+        :param seed: int, a strategy gets the same results for a given seed whatever the pool size and the other
+            strategies of the batch are. None for a random seed (printed, so that a run can be repeated)
+        :param tolerance: adaptive number of paths (up to mc_times), see cal_monte_carlo
+        :param percentiles, use_sketch, method, block_length, cache: see cal_monte_carlo
+        """
+        processes = multiprocessing.cpu_count() if processes is None else processes
+        if seed is None:
+            # a generated seed is never asked for again, its results would only fill the cache
+            cache = None
+            seed = np.random.SeedSequence().entropy
+        print('[cal_monte_carlo_strategies] seed = %d' % seed)
+        segmented = tolerance is None and not use_sketch and method == 'shuffle'
+        units = []  # (strategy index, freq, year, start, end, segments), start / end are positions in the shared block
+        pnl_list = []
+        offset = 0
+        for i, strategy_path in enumerate(strategy_paths):
+            pnl_data = CalculateCustomMetrics.read_monte_carlo_pnl(strategy_path, use_daily_pnl, use_trade_pnl)
+            for freq, (pnl, years) in pnl_data.items():
+                for year, start, end, segments in CalculateCustomMetrics.monte_carlo_units(years, segmented):
+                    units.append((i, freq, year, offset + start, offset + end, segments))
+                pnl_list.append(pnl)
+                offset += len(pnl)
+        if len(units) == 0:
+            return
+        # the longest units first, so that the pool doesn't end up waiting on a single big unit
+        units.sort(key=lambda u: u[4] - u[3], reverse=True)
+        table_kwargs = {'tolerance': tolerance, 'percentiles': percentiles, 'use_sketch': use_sketch,
+                        'method': method, 'block_length': block_length, 'cache': cache}
+
+        shm = shared_memory.SharedMemory(create=True, size=offset * np.dtype(np.float64).itemsize)
+        try:
+            shared_pnl = np.ndarray(offset, dtype=np.float64, buffer=shm.buf)
+            shared_pnl[:] = np.concatenate(pnl_list)
+            del shared_pnl
+
+            pool = multiprocessing.Pool(processes=processes)
+            jobs = [(unit, pool.apply_async(CalculateCustomMetrics.monte_carlo_unit_worker,
+                                            args=(shm.name, offset, unit[3], unit[4], unit[1], unit[2], unit[5],
+                                                  mc_times, seed, table_kwargs)))
+                    for unit in units]
+            pool.close()
+            tables = {}
+            for unit, job in jobs:
+                tables.setdefault((unit[0], unit[1]), {}).update(job.get())
+            pool.join()
+        finally:
+            shm.close()
+            shm.unlink()
+
+        for (i, freq), freq_tables in tables.items():
+            CalculateCustomMetrics.write_monte_carlo_tables(
+                os.path.join(strategy_paths[i], 'MonteCarlo2'), freq, freq_tables)
+
+    @staticmethod
+    def cal_acf_pacf_values(time_series, lags=10, adf_p_max=0.05, adf_cache=None):
+        """
+        Numbers of cal_acf_pacf without any file output.
+        :param adf_cache: autocorrelation.AdfCache, None for the shared in-memory one
+        :return: [acf, pacf, pass_adf]
+        """
+        # ADF test (cached by series), ACF by FFT and PACF by Durbin-Levinson (see autocorrelation)
+        acf_res, pacf_res, adf_p_values, pass_adfs = batch_acf_pacf(
+            [np.asarray(time_series, dtype=float)], lags, adf_p_max, adf_cache)
+        acf_res, pacf_res, adf_p_value, pass_adf = acf_res[0], pacf_res[0], adf_p_values[0], bool(pass_adfs[0])
+        if not pass_adf:
+            print('[cal_acf_pacf_values] The time series may have unit root. ADF p value=%f' %(adf_p_value))
+        return [acf_res, pacf_res, pass_adf]
 
     @staticmethod
     def cal_acf_pacf(time_series, lags=10, adf_p_max=0.05 ,
-                     output_path='', output_file_prefix=''):
-        # first need to do the ADF test
-        res = ts.adfuller(time_series, lags)
-        adf_p_value = res[1]
-        pass_adf = True
-        if adf_p_value >= adf_p_max:
-            print('[cal_acf_pacf] The time series may have unit root. ADF p value=%f' %(adf_p_value))
-            pass_adf = False
-
-        time_series2 = (time_series - time_series.mean()) / time_series.std()
-        acf_res = ts.acf(time_series2, nlags=lags)
-        pacf_res = ts.pacf(time_series2, nlags=lags)
+                     output_path='', output_file_prefix='', render_charts=False, chart_format='svg',
+                     render_queue=None):
+        """
+        ACF / PACF of time_series (and whether it passes the ADF test), saved to <prefix>_acf_pacf.csv.
+        :param render_charts: also draw the ACF and PACF bar charts (<prefix>_acf.<format>, <prefix>_pacf.<format>)
+        :param chart_format: 'svg' (plain text, cheap) or 'png' (matplotlib)
+        :param render_queue: ChartRenderQueue to render the charts in the background, None to render them here
+        :return: [acf, pacf, pass_adf]
+        """
+        acf_res, pacf_res, pass_adf = CalculateCustomMetrics.cal_acf_pacf_values(time_series, lags, adf_p_max)
 
         if not os.path.exists(output_path):
             os.mkdir(output_path)
@@ -1071,17 +1543,13 @@ class CalculateCustomMetrics:
                    'acf_pacf' + ('_not_pass_adf' if not pass_adf else '') + '.csv'
         res.to_csv(os.path.join(output_path, csv_name))
 
-        fig = plt.figure()
-        plt.bar(range(len(acf_res)), acf_res)
-        fig.savefig(os.path.join(output_path,
-                                 ((output_file_prefix + '_') if output_file_prefix != '' else '') + 'acf.png'))
-        plt.close()
-
-        fig = plt.figure()
-        plt.bar(range(len(pacf_res)), pacf_res)
-        fig.savefig(os.path.join(output_path,
-                                 ((output_file_prefix + '_') if output_file_prefix != '' else '') + 'pacf.png'))
-        plt.close()
+        if render_charts:
+            for name, values in [('acf', acf_res), ('pacf', pacf_res)]:
+                path = chart_path(output_path, output_file_prefix, name)
+                if render_queue is not None:
+                    render_queue.submit(values, path, chart_format)
+                else:
+                    render_bar_chart(values, path, chart_format)
 
         return [acf_res, pacf_res, pass_adf]
 
@@ -1092,8 +1560,9 @@ class CalculateCustomMetrics:
             raise ValueError(msg_head + " trade_file_path and trade_data can't be both None")
 
         if trade_file_path is not None:
-            trade_data = pd.read_csv(trade_file_path, parse_dates=['Date', 'Ex.Date'],
-                                     date_parser=lambda x: pd.datetime.strptime(x, '%m/%d/%Y %I:%M:%S %p'))
+            trade_data = pd.read_csv(trade_file_path)
+            trade_data['Date'] = parse_date_column(trade_data['Date'], trade_file_path, 'Date')
+            trade_data['Ex.Date'] = parse_date_column(trade_data['Ex.Date'], trade_file_path, 'Ex.Date')
 
         # get frequency
         arr = trade_data.iloc[0, 0].split('_')
@@ -1110,25 +1579,12 @@ class CalculateCustomMetrics:
     @staticmethod
     def cal_pnl_hhi(daily_pnl, trade_data):
         """
-        Herfindahl-Hirschman Index (HHI)
+        Herfindahl-Hirschman Index (HHI) of the 10 / 5 largest daily and trade pnl (see metrics_registry)
+        :return: [hhi_daily_10, hhi_trade_10, hhi_daily_5, hhi_trade_5]
         """
-        total_pnl = daily_pnl['PnL'].sum()
-        hhi_daily_10 = 0
-        hhi_daily_5 = 0
-        if len(daily_pnl) > 10:
-            daily_pnl_sorted = daily_pnl['PnL'].sort_values(ascending=False) / total_pnl * 100
-            daily_pnl_sorted_sq = daily_pnl_sorted ** 2
-            hhi_daily_10 = daily_pnl_sorted_sq[0:10].sum()
-            hhi_daily_5 = daily_pnl_sorted_sq[0:5].sum()
-
-        trade_pnl = trade_data['Profit']
-        hhi_trade_5 = hhi_trade_10 = 0
-        if len(trade_pnl) > 10:
-            trade_pnl_sorted_sq = (trade_pnl.sort_values(ascending=False) / total_pnl * 100) ** 2
-            hhi_trade_5 = trade_pnl_sorted_sq[0:5].sum()
-            hhi_trade_10 = trade_pnl_sorted_sq[0:10].sum()
-
-        return [hhi_daily_10, hhi_trade_10, hhi_daily_5, hhi_trade_5]
+        metrics = compute_metrics(['HHI Daily 10', 'HHI Trade 10', 'HHI Daily 5', 'HHI Trade 5'],
+                                  daily_pnl=daily_pnl['PnL'].values, trade_pnl=trade_data['Profit'].values)
+        return [metrics['HHI Daily 10'], metrics['HHI Trade 10'], metrics['HHI Daily 5'], metrics['HHI Trade 5']]
 
     @staticmethod
     def cal_expectancy(pnl_data):
@@ -1211,16 +1667,11 @@ if __name__ == '__main__':
 
     # test Monte Carlo
     ss = 'S:\\Amibroker project\\Result\\Step3\\2013'
-    for folder in os.listdir(ss):
-        if os.path.isfile(os.path.join(ss, folder)):
-            continue
-        if folder == 'HIS;15min;RSIDivergence;Test06-4m_1m2013':
-            continue
-        print('------------------ %s ---------------' % folder)
-        CalculateCustomMetrics.cal_monte_carlo_one_strategy(
-            os.path.join(ss, folder), use_trade_pnl=True, use_daily_pnl=False,
-            mc_times=10000
-        )
+    strategy_paths = [os.path.join(ss, folder) for folder in os.listdir(ss)
+                      if not os.path.isfile(os.path.join(ss, folder))
+                      and folder != 'HIS;15min;RSIDivergence;Test06-4m_1m2013']
+    CalculateCustomMetrics.cal_monte_carlo_strategies(
+        strategy_paths, use_trade_pnl=True, use_daily_pnl=False, mc_times=10000)
 
     # test GPR
     # pnl = pd.read_csv('S:\\Amibroker project\\Result\\Step3\\15min;RSIDivergenceTest06(Hsi)4m_1mStart2015\\daily_pnl.csv',
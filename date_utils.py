@@ -0,0 +1,91 @@
+import os
+import numpy as np
+import pandas as pd
+
+# date formats seen in AmiBroker / MultiCharts exports, in the order they are tried
+POTENTIAL_DATE_FORMATS = ['%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %H:%M', '%m/%d/%Y %H:%M:%S',
+                          '%d/%m/%Y %I:%M:%S %p', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M',
+                          '%Y-%m-%d %H:%M:%S']
+
+# (source file, column) -> (file mtime, detected format)
+DATE_FORMAT_CACHE = {}
+
+
+def midnight_format(date_format):
+    # AmiBroker writes midnight as "1/5/2015 00:00:00" even when the rest of the column is in 12-hour format
+    return date_format.replace(' %p', '').replace('%I', '%H')
+
+
+def parse_with_format(date_strs, date_format):
+    """
+    Parse a whole column with one vectorized pd.to_datetime call. Cells that don't match give NaT.
+    """
+    date_strs = pd.Series(date_strs).astype(object)
+    parsed = pd.to_datetime(date_strs, format=date_format, errors='coerce')
+    if '%p' in date_format:
+        midnight = parsed.isna() & date_strs.astype(str).str.contains('00:00:00', regex=False)
+        if midnight.any():
+            parsed[midnight] = pd.to_datetime(date_strs[midnight], format=midnight_format(date_format),
+                                              errors='coerce')
+    return parsed
+
+
+def detect_date_format(date_strs, formats=None, sample_size=200):
+    """
+    Find the first format in formats that parses every value of an evenly spaced sample of the column.
+    :param date_strs: list / numpy array / pandas.Series of date strings
+    :param sample_size: number of distinct values to test; None to test the whole column
+    :return: the detected format, or None if no format fits
+    """
+    formats = POTENTIAL_DATE_FORMATS if formats is None else formats
+    values = pd.Series(date_strs).dropna().astype(str).unique()
+    if len(values) == 0:
+        return None
+    if sample_size is not None and len(values) > sample_size:
+        values = values[np.linspace(0, len(values) - 1, sample_size).astype(int)]
+    for date_format in formats:
+        if parse_with_format(values, date_format).notna().all():
+            return date_format
+    return None
+
+
+def parse_date_column(date_strs, source_path=None, column=None, formats=None, sample_size=200):
+    """
+    Detect the date format of a column once (on a sample) and parse the whole column with it.
+    If source_path is given, the detected format is cached per (source file, column) and reused until the file changes.
+    :return: pandas.Series of datetime64. Values that can't be converted are NaT.
+    """
+    date_strs = pd.Series(date_strs)
+    if pd.api.types.is_datetime64_any_dtype(date_strs):
+        return date_strs
+
+    cache_key = None
+    mtime = None
+    date_format = None
+    if source_path is not None:
+        cache_key = (os.path.abspath(source_path), column)
+        mtime = os.path.getmtime(source_path) if os.path.exists(source_path) else None
+        if cache_key in DATE_FORMAT_CACHE and DATE_FORMAT_CACHE[cache_key][0] == mtime:
+            date_format = DATE_FORMAT_CACHE[cache_key][1]
+
+    if date_format is None:
+        date_format = detect_date_format(date_strs, formats, sample_size)
+    if date_format is None:
+        print("[parse_date_column] date format of column %s can't be recognized!" % column)
+        return pd.Series(pd.NaT, index=date_strs.index, dtype='datetime64[ns]')
+
+    parsed = parse_with_format(date_strs, date_format)
+    failed = parsed.isna() & date_strs.notna()
+    if failed.any():
+        # the sample (or a stale cache entry) picked the wrong format, e.g. m/d vs d/m, so check the whole column
+        full_format = detect_date_format(date_strs, formats, sample_size=None)
+        if full_format is not None and full_format != date_format:
+            date_format = full_format
+            parsed = parse_with_format(date_strs, date_format)
+            failed = parsed.isna() & date_strs.notna()
+        for date_str in date_strs[failed].head(10):
+            print("%s can't be converted!" % date_str)
+
+    if cache_key is not None:
+        DATE_FORMAT_CACHE[cache_key] = (mtime, date_format)
+    return parsed
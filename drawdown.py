@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+EPISODE_COLUMNS = ['Path', 'Start', 'Trough', 'Recovery', 'Depth', 'Length']
+
+
+def as_equity_2d(equity, msg_head=''):
+    """
+    :return: (float array (n_paths, n_days), True if the input was 1-D)
+    """
+    if isinstance(equity, pd.DataFrame):
+        equity = equity.values.T
+    equity = np.asarray(equity, dtype=float)
+    if equity.ndim not in (1, 2):
+        raise ValueError(msg_head + ' equity must be 1-D or 2-D (paths x time)')
+    if equity.shape[-1] == 0:
+        raise ValueError(msg_head + ' equity is empty')
+    return np.atleast_2d(equity), equity.ndim == 1
+
+
+def cal_drawdown(equity):
+    """
+    Running peak, drawdown and new highs of a batch of equity curves, with the semantics of the loop in
+    CalculateCustomMetrics.cal_mdd_n_mdd_period: once the running peak has been 0, it is treated as 1 from then on, and
+    a new high is a value strictly above the previous (guarded) peak.
+    :param equity: (n_paths, n_days) float array
+    :return: (peak, dd, new_high), all (n_paths, n_days)
+    """
+    peak = np.maximum.accumulate(equity, axis=1)
+    was_zero = np.logical_or.accumulate(peak == 0, axis=1)
+    peak = np.where(was_zero, np.maximum(peak, 1), peak)
+    dd = (peak - equity) / peak
+    new_high = np.zeros(equity.shape, dtype=bool)
+    new_high[:, 1:] = equity[:, 1:] > peak[:, :-1]
+    return peak, dd, new_high
+
+
+def cal_max_drawdown(equity):
+    """
+    Max drawdown (fraction of the peak) and longest underwater period (number of periods since the last new high, the
+    first period counts as 1) of one or many equity curves.
+    :param equity: 1-D array / list / Series, or 2-D array (paths x time) / DataFrame (one column per path)
+    :return: (mdd, mdd_period), floats for a 1-D input, arrays of n_paths values for a 2-D input
+    """
+    equity, is_1d = as_equity_2d(equity, '[cal_max_drawdown]')
+    n_days = equity.shape[1]
+    _, dd, new_high = cal_drawdown(equity)
+    mdd = np.maximum(dd.max(axis=1), 0)
+    steps = np.arange(n_days)
+    last_high = np.maximum.accumulate(np.where(new_high, steps, -1), axis=1)
+    mdd_period = np.maximum((steps - last_high).max(axis=1), 0)
+    if is_1d:
+        return float(mdd[0]), int(mdd_period[0])
+    return mdd, mdd_period
+
+
+def cal_drawdown_episodes(equity):
+    """
+    Table of the drawdown episodes of one or many equity curves. An episode runs from a peak to the next new high
+    (Recovery, -1 if the curve never recovers), Trough is the first period of its max drawdown, Depth that drawdown and
+    Length the number of periods from the peak to the recovery (or to the end). Periods that never go below the peak
+    are not episodes.
+    :param equity: see cal_max_drawdown
+    :return: DataFrame with EPISODE_COLUMNS (Path is always 0 for a 1-D input)
+    """
+    equity, _ = as_equity_2d(equity, '[cal_drawdown_episodes]')
+    n_paths, n_days = equity.shape
+    _, dd, new_high = cal_drawdown(equity)
+
+    # one segment per (path, peak): a segment starts at each path's first period and at each new high
+    segment_start = new_high.copy()
+    segment_start[:, 0] = True
+    flat_dd = dd.ravel()
+    starts = np.flatnonzero(segment_start.ravel())
+    segment_id = np.cumsum(segment_start.ravel()) - 1
+    depth = np.maximum.reduceat(flat_dd, starts)
+
+    # first period of each segment where its max drawdown is reached
+    at_depth = np.flatnonzero(flat_dd == depth[segment_id])
+    _, first = np.unique(segment_id[at_depth], return_index=True)
+    trough = at_depth[first]
+
+    ends = np.append(starts[1:], n_paths * n_days)
+    path = starts // n_days
+    # a segment recovers at the start of the next one, if that one is on the same path
+    recovered = np.append(path[1:] == path[:-1], False)
+    underwater = depth > 0
+    return pd.DataFrame({
+        'Path': path,
+        'Start': starts - path * n_days,
+        'Trough': trough - path * n_days,
+        'Recovery': np.where(recovered, ends - path * n_days, -1),
+        'Depth': depth,
+        'Length': ends - starts
+    }, columns=EPISODE_COLUMNS)[underwater].reset_index(drop=True)
@@ -0,0 +1,68 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+# default location of the cache, next to this file (the strategy folders are scanned by generate_summary, so the cache
+# must not be created inside them)
+MC_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mc_cache')
+# bump when a change of the Monte Carlo kernel changes its results, so that old entries are not reused
+MC_CACHE_VERSION = 1
+
+
+class MonteCarloCache:
+    """
+    Content-addressed on-disk cache of Monte Carlo results. The key is the sha256 of the pnl values (float64 bytes) and
+    of the run parameters (initial_equity, multiplier, times, freq, seed, method, ...), so the same simulation of the
+    same series is never computed twice, whichever folder or process asks for it.
+    Each entry is a small .npz (the percentile table and the number of paths used) under <cache_dir>/<key[:2]>/.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = MC_CACHE_DIR if cache_dir is None else cache_dir
+
+    @staticmethod
+    def make_key(pnl, params):
+        h = hashlib.sha256()
+        h.update(np.ascontiguousarray(np.asarray(pnl, dtype=np.float64)).tobytes())
+        h.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+        h.update(str(MC_CACHE_VERSION).encode('utf-8'))
+        return h.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npz')
+
+    def get(self, key):
+        """
+        :return: (table as a list of rows, number of paths used), None if the key is not in the cache
+        """
+        path = self.entry_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as f:
+                return f['table'].tolist(), int(f['times'])
+        except (OSError, ValueError, KeyError):
+            # a broken entry is just a miss, it is overwritten by the next put
+            return None
+
+    def put(self, key, table, times):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write under a temporary name then rename, workers may put the same key at the same time
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, table=np.asarray(table, dtype=np.float64), times=np.int64(times))
+        os.replace(tmp_path, path)
+
+    def get_or_compute(self, pnl, params, compute):
+        """
+        :param compute: function without arguments returning (table, times), called on a miss
+        :return: (table, times)
+        """
+        key = MonteCarloCache.make_key(pnl, params)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        table, times = compute()
+        self.put(key, table, times)
+        return table, times
@@ -0,0 +1,87 @@
+import numpy as np
+
+# GPR when there is no losing month, as in CalculateCustomMetrics.cal_GPR
+GPR_NO_LOSS = 99999
+# number of largest pnl summed by the HHI metrics, and min number of pnl for them to be computed
+HHI_TOPS = [10, 5]
+HHI_MIN_COUNT = 10
+
+
+def cal_regression_sums(y):
+    """
+    Centered sums of the regression of y on x = 1..n, shared by the slope and the K-ratio.
+    :param y: (n,) array, or (n, n_series) to regress every column at once
+    :return: (n, sxx, sxy, syy), sxy / syy have one value per column for a 2-D input
+    """
+    y = np.asarray(y, dtype=float)
+    n = y.shape[0]
+    x = np.arange(1, n + 1, dtype=float)
+    dx = x - x.mean()
+    dy = y - y.mean(axis=0)
+    sxx = (dx ** 2).sum()
+    sxy = np.tensordot(dx, dy, axes=(0, 0))
+    syy = (dy ** 2).sum(axis=0)
+    return n, sxx, sxy, syy
+
+
+def slope_from_sums(n, sxx, sxy, syy):
+    return sxy / sxx
+
+
+def k_ratio_from_sums(n, sxx, sxy, syy):
+    """
+    Zephyr K-ratio: |slope| / standard error of the slope.
+    """
+    steyx = np.sqrt((syy - sxy ** 2 / sxx) / (n - 2)) / np.sqrt(sxx)
+    return np.abs(sxy) / sxx / steyx
+
+
+def cal_monthly_pnl(dates, pnl):
+    """
+    :param dates: datetime64 array (or anything np.asarray turns into one), one per pnl
+    :param pnl: (n_days,) array, or (n_days, n_series)
+    :return: (months as datetime64[M] sorted ascending, pnl summed per month, (n_months,) or (n_months, n_series))
+    """
+    months, month_index = np.unique(np.asarray(dates, dtype='datetime64[M]'), return_inverse=True)
+    month_index = month_index.ravel()
+    if np.ndim(pnl) == 1:
+        return months, np.bincount(month_index, weights=pnl, minlength=len(months))
+    monthly_pnl = np.zeros((len(months),) + np.shape(pnl)[1:])
+    np.add.at(monthly_pnl, month_index, pnl)
+    return months, monthly_pnl
+
+
+def gpr_from_monthly(monthly_pnl):
+    """
+    Total pnl / total loss of the losing months along axis 0, GPR_NO_LOSS without losing month.
+    """
+    total_loss = -np.minimum(monthly_pnl, 0).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total_loss == 0, GPR_NO_LOSS, monthly_pnl.sum(axis=0) / total_loss)
+
+
+def hhi_from_sorted(sorted_pnl, total_pnl):
+    """
+    :param sorted_pnl: pnl sorted descending along axis 0, NaN (padding of the shorter columns) at the end
+    :param total_pnl: total pnl (one per column for a 2-D sorted_pnl)
+    :return: [HHI of the 10 largest, HHI of the 5 largest] (% of total_pnl squared), 0 if there are not more than
+        HHI_MIN_COUNT pnl
+    """
+    count = (~np.isnan(sorted_pnl)).sum(axis=0)
+    share_sq = (sorted_pnl[:max(HHI_TOPS)] / total_pnl * 100) ** 2
+    return [np.where(count > HHI_MIN_COUNT, np.nansum(share_sq[:top], axis=0), 0) for top in HHI_TOPS]
+
+
+def cal_expectancy_array(pnl):
+    """
+    (average win * win rate + average loss * loss rate) / |average loss| along axis 0, zero and NaN pnl are not counted
+    (NaN without any non zero pnl).
+    """
+    win_num = (pnl > 0).sum(axis=0)
+    loss_num = (pnl < 0).sum(axis=0)
+    count = win_num + loss_num
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avg_win = np.where(pnl > 0, pnl, 0).sum(axis=0) / win_num
+        avg_loss = np.where(pnl < 0, pnl, 0).sum(axis=0) / loss_num
+        return (avg_win * win_num / count + avg_loss * loss_num / count) / np.abs(avg_loss)
+
@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+from drawdown import cal_max_drawdown
+from metrics_kernel import cal_regression_sums, slope_from_sums, k_ratio_from_sums, gpr_from_monthly, \
+    hhi_from_sorted, cal_expectancy_array
+
+# values given to compute_metrics, everything else is computed from them. daily_pnl (and trade_pnl) may be 1-D for one
+# strategy or 2-D (days x strategies, trades padded with NaN) to compute every column at once
+INPUTS = ['daily_pnl', 'dates', 'trade_pnl']
+# name -> (names of the inputs / intermediates / metrics it is computed from, function of their values)
+REGISTRY = {}
+
+
+def register(name, *dependencies):
+    def wrapper(func):
+        REGISTRY[name] = (dependencies, func)
+        return func
+    return wrapper
+
+
+def bucket_pnl(daily_pnl, keys, names):
+    """
+    pnl summed per calendar bucket, indexed by the bucket keys (year, and month or week).
+    :return: Series 'PnL' for a 1-D daily_pnl, DataFrame one column per strategy for a 2-D one
+    """
+    grouped = pd.DataFrame(daily_pnl.reshape(len(daily_pnl), -1)).groupby(keys).sum()
+    grouped.index.names = names
+    return grouped.iloc[:, 0].rename('PnL') if daily_pnl.ndim == 1 else grouped
+
+
+def win_rate(pnl):
+    """
+    Fraction of the non zero pnl that are positive, along axis 0.
+    """
+    pnl = np.asarray(pnl)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (pnl > 0).sum(axis=0) / (pnl != 0).sum(axis=0)
+
+
+# ---------------------------------------- intermediates ----------------------------------------
+@register('equity_curve', 'daily_pnl')
+def equity_curve(daily_pnl):
+    return np.cumsum(daily_pnl, axis=0)
+
+
+@register('regression_sums', 'equity_curve')
+def regression_sums(equity):
+    return cal_regression_sums(equity)
+
+
+@register('drawdown', 'equity_curve')
+def drawdown(equity):
+    return cal_max_drawdown(equity.T)
+
+
+@register('total_pnl', 'daily_pnl')
+def total_pnl(daily_pnl):
+    return daily_pnl.sum(axis=0)
+
+
+@register('calendar', 'dates')
+def calendar(dates):
+    dates = pd.DatetimeIndex(dates)
+    return {'year': dates.year.values, 'month': dates.month.values,
+            'week': dates.isocalendar()['week'].values.astype(int)}
+
+
+@register('weekly_pnl', 'daily_pnl', 'calendar')
+def weekly_pnl(daily_pnl, calendar):
+    return bucket_pnl(daily_pnl, [calendar['year'], calendar['week']], ['year', 'week'])
+
+
+@register('monthly_pnl', 'daily_pnl', 'calendar')
+def monthly_pnl(daily_pnl, calendar):
+    return bucket_pnl(daily_pnl, [calendar['year'], calendar['month']], ['year', 'month'])
+
+
+@register('yearly_pnl', 'daily_pnl', 'calendar')
+def yearly_pnl(daily_pnl, calendar):
+    return bucket_pnl(daily_pnl, [calendar['year']], ['year'])
+
+
+@register('hhi_daily', 'daily_pnl', 'total_pnl')
+def hhi_daily(daily_pnl, total):
+    return hhi_from_sorted(-np.sort(-daily_pnl, axis=0), total)
+
+
+@register('hhi_trade', 'trade_pnl', 'total_pnl')
+def hhi_trade(trade_pnl, total):
+    return hhi_from_sorted(-np.sort(-trade_pnl, axis=0), total)
+
+
+# ---------------------------------------- metrics ----------------------------------------
+register('K Ratio', 'regression_sums')(lambda sums: k_ratio_from_sums(*sums))
+register('Slope', 'regression_sums')(lambda sums: slope_from_sums(*sums))
+register('MDD', 'drawdown')(lambda dd: dd[0])
+register('Max DD Period', 'drawdown')(lambda dd: dd[1])
+register('GPR', 'monthly_pnl')(lambda monthly: gpr_from_monthly(np.asarray(monthly)))
+register('HHI Daily 10', 'hhi_daily')(lambda hhi: hhi[0])
+register('HHI Daily 5', 'hhi_daily')(lambda hhi: hhi[1])
+register('HHI Trade 10', 'hhi_trade')(lambda hhi: hhi[0])
+register('HHI Trade 5', 'hhi_trade')(lambda hhi: hhi[1])
+register('Expectancy', 'trade_pnl')(cal_expectancy_array)
+register('Daily Expectancy', 'daily_pnl')(cal_expectancy_array)
+register('Daily WinRate', 'daily_pnl')(win_rate)
+register('Weekly WinRate', 'weekly_pnl')(win_rate)
+register('Monthly WinRate', 'monthly_pnl')(win_rate)
+register('Yearly WinRate', 'yearly_pnl')(win_rate)
+
+
+# metrics of CalculateCustomMetrics.cal_metrics_strategies by default, all computed from the daily pnl and dates
+BATCH_METRICS = ['K Ratio', 'Slope', 'MDD', 'Max DD Period', 'GPR', 'HHI Daily 10', 'HHI Daily 5', 'Daily Expectancy']
+
+
+def required_inputs(names):
+    """
+    :return: set of the INPUTS the metrics (or intermediates) names are computed from
+    """
+    inputs = set()
+    for name in names:
+        if name in INPUTS:
+            inputs.add(name)
+        elif name in REGISTRY:
+            inputs |= required_inputs(REGISTRY[name][0])
+    return inputs
+
+
+def to_scalar(value):
+    # a 0-d numpy result of a single strategy as a plain float
+    if isinstance(value, np.generic) or (isinstance(value, np.ndarray) and value.ndim == 0):
+        return float(value)
+    return value
+
+
+def compute_metrics(names, daily_pnl=None, dates=None, trade_pnl=None):
+    """
+    Compute the requested metrics (or intermediates, e.g. 'monthly_pnl') and only what they depend on, each
+    intermediate exactly once.
+    :param names: names in REGISTRY
+    :param daily_pnl: (n_days,) or (n_days, n_strategies) array
+    :param dates: dates of the daily_pnl rows, needed by the calendar based metrics (GPR, weekly / monthly / yearly)
+    :param trade_pnl: (n_trades,) or (n_trades, n_strategies) array, needed by the trade metrics (HHI Trade, Expectancy)
+    :return: dict name -> value (float for a single strategy, one value per column for 2-D inputs)
+    """
+    values = {}
+    for name, value in zip(INPUTS, [daily_pnl, dates, trade_pnl]):
+        if value is not None:
+            values[name] = value if name == 'dates' else np.asarray(value, dtype=float)
+
+    def resolve(name):
+        if name not in values:
+            if name in INPUTS:
+                raise ValueError('[compute_metrics] "%s" is needed to compute the requested metrics' % name)
+            if name not in REGISTRY:
+                raise ValueError('[compute_metrics] unknown metric "%s"' % name)
+            dependencies, func = REGISTRY[name]
+            values[name] = func(*[resolve(dependency) for dependency in dependencies])
+        return values[name]
+
+    return {name: to_scalar(resolve(name)) for name in names}
+
+
+def compute_metrics_table(names, pnl_matrix, trade_pnl_matrix=None):
+    """
+    :param pnl_matrix: DataFrame days x strategies with a DatetimeIndex (e.g. read_daily_pnl_matrix)
+    :param trade_pnl_matrix: DataFrame trades x strategies, padded with NaN (e.g. read_trade_pnl_matrix), needed by the
+        trade metrics. Its columns are matched to the ones of pnl_matrix, a missing strategy has no trade
+    :return: DataFrame, one row per strategy, one column per metric
+    """
+    dates = pnl_matrix.index.values if isinstance(pnl_matrix.index, pd.DatetimeIndex) else None
+    trade_pnl = None
+    if trade_pnl_matrix is not None:
+        trade_pnl = trade_pnl_matrix.reindex(columns=pnl_matrix.columns).values
+    metrics = compute_metrics(names, daily_pnl=pnl_matrix.values, dates=dates, trade_pnl=trade_pnl)
+    return pd.DataFrame(metrics, index=pnl_matrix.columns, columns=names)
@@ -1,6 +1,7 @@
 import pandas as pd
 import datetime
 import time
+from date_utils import parse_date_column
 pd.set_option('display.max_columns', 500)
 
 def monte_carlo_byday(trade_file_path, price_data_path, output_path):
@@ -14,85 +15,16 @@ def monte_carlo_byday(trade_file_path, price_data_path, output_path):
         # print(trade_data.columns)
 
         # deal with date & time
-        # print(trade_data)
-        def get_datetime(date_str):
-            date_format = '%m/%d/%Y %I:%M:%S %p'
-            parsed_date = pd.Timestamp(2000, 1, 1)
-            try:
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date
-            except Exception:
-                pass
-
-            date_format = '%m/%d/%Y %H:%M'
-            parsed_date = pd.Timestamp(2000, 1, 1)
-            try:
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date
-            except Exception:
-                pass
-
-            date_format = '%d/%m/%Y %I:%M:%S %p'
-            try:
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date
-            except Exception:
-                pass
-
-            date_format = '%m/%d/%Y %H:%M:%S'
-            try:
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date
-            except Exception:
-                pass
-
-            date_format = '%d/%m/%Y %H:%M:%S'
-            try:
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date
-            except Exception:
-                pass
-
-            date_format = '%d/%m/%Y %I:%M:%S %p'
-            try:
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date
-            except Exception:
-                pass
-
-            date_format = '%Y-%m-%d %H:%M:%S'
-            try:
-                parsed_date = pd.Timestamp(
-                    datetime.datetime.strptime(date_str, date_format)
-                )
-                return parsed_date
-            except Exception:
-                pass
-
-            print("%s can't be converted!" % date_str)
-
         def judge_direction(row):
             if 'LONG' in row['Trade'].upper():
                 return 1
             if 'SHORT' in row['Trade'].upper():
                 return -1
 
-        trade_data['Date'] = trade_data.apply(lambda x: get_datetime(x['Date']), axis=1)
+        trade_data['Date'] = parse_date_column(trade_data['Date'], trade_file_path, 'Date')
         trade_data = trade_data.rename({'Ex. Date': 'Ex.Date'}, axis=1)
         # print(trade_data)
-        trade_data['Ex.Date'] = trade_data.apply(lambda x: get_datetime(x['Ex.Date']), axis=1)
+        trade_data['Ex.Date'] = parse_date_column(trade_data['Ex.Date'], trade_file_path, 'Ex.Date')
         trade_data['Trade'] = trade_data.apply(judge_direction, axis=1)
         trade_data = trade_data.sort_values(by=['Date'], ascending=True)
         trade_data = trade_data[['Trade', 'Date', 'Price', 'Ex.Date', 'Ex. Price', 'Profit', 'Shares']]
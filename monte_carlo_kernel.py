@@ -0,0 +1,535 @@
+import math
+import multiprocessing
+import numpy as np
+from scipy.stats import norm
+from tqdm import tqdm
+from quantile_sketch import QuantileSketch
+from drawdown import cal_max_drawdown
+
+# columns of the Monte Carlo result table, in the order returned by CalculateCustomMetrics.cal_monte_carlo
+MC_COLUMNS = ['MDD', 'MDD_Period', 'Max_Equity', 'Min_Equity', 'CAR/MDD', 'CAR', 'End_Equity', 'Init_Equity',
+              'Weekly_Win_Rate', 'Monthly_Win_Rate', 'Quarterly_Win_Rate']
+# metrics where a smaller value is the conservative one (sorted ascending), all the others are sorted descending
+MC_ASCENDING = ['MDD', 'MDD_Period']
+MC_PERCENTILES = [0.9, 0.7, 0.5, 0.3, 0.1]
+
+ONE_YEAR_PERIOD = {'daily': 356, 'quarterly': 4, 'monthly': 12, 'weekly': 52, 'trades': 1000}
+# win rate of the pnl summed over consecutive blocks of n periods (5 days ~ a week, 20 ~ a month, 60 ~ a quarter)
+WIN_RATE_BLOCKS = [('Weekly_Win_Rate', 5), ('Monthly_Win_Rate', 20), ('Quarterly_Win_Rate', 60)]
+
+MC_METHODS = ['shuffle', 'block', 'stationary']
+# 'fixed': equity = initial_equity + multiplier * cumulative pnl
+# 'fractional': the position is resized with the equity, each period returns multiplier * pnl / initial_equity
+SIZING_RULES = ['fixed', 'fractional']
+
+# stable code of each frequency, part of the seed key of a Monte Carlo run (see make_seed_sequence)
+MC_FREQ_CODES = {'daily': 0, 'weekly': 1, 'monthly': 2, 'quarterly': 3, 'trades': 4}
+
+# seed key of the year-segmented run of a frequency, (MC_FREQ_CODES[freq], MC_SEGMENTED_SEED_KEY), can't collide with the
+# (freq, year) keys of the per-year runs
+MC_SEGMENTED_SEED_KEY = 1
+
+# metrics checked by the adaptive mode by default. End equity / CAR don't depend on the order of the pnl, and the win
+# rates only take a few discrete values, so their percentiles can't get within a small relative tolerance
+MC_CONVERGENCE_METRICS = ['MDD', 'MDD_Period', 'Max_Equity', 'Min_Equity', 'CAR/MDD']
+# paths per convergence check in the adaptive mode, and paths run before the first check
+MC_BATCH_PATHS = 1000
+MC_MIN_TIMES = 2000
+
+# max number of cells (paths x days) of one chunk, keeps the temporary arrays at a few dozen MB
+MAX_CHUNK_CELLS = 2000000
+
+
+def make_seed_sequence(seed=None, seed_key=()):
+    """
+    Root of the random streams of one Monte Carlo run.
+    :param seed: int / SeedSequence, None for fresh entropy
+    :param seed_key: tuple of ints appended to the spawn key, e.g. (MC_FREQ_CODES[freq], year), so that every unit of a
+        batch gets its own independent stream from the same seed
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return np.random.SeedSequence(seed.entropy, spawn_key=tuple(seed.spawn_key) + tuple(seed_key))
+    return np.random.SeedSequence(seed, spawn_key=tuple(seed_key))
+
+
+def chunk_rng(seed_seq, chunk):
+    """
+    Generator of chunk number `chunk` of a run. It only depends on the seed, the seed key and the chunk number, so the
+    paths are the same whichever process (and in whichever order) the chunk is computed.
+    """
+    return np.random.Generator(np.random.PCG64(
+        np.random.SeedSequence(seed_seq.entropy, spawn_key=tuple(seed_seq.spawn_key) + (chunk,))))
+
+
+def permutation_matrix(n_paths, n_days, rng):
+    """
+    :return: (n_paths, n_days) int matrix, each row an independent random permutation of range(n_days)
+    """
+    idx = np.tile(np.arange(n_days), (n_paths, 1))
+    return rng.permuted(idx, axis=1, out=idx)
+
+
+def segment_permutation_matrix(n_paths, segment_codes, rng):
+    """
+    :param segment_codes: segment (0, 1, 2, ...) of each day, non-decreasing
+    :return: (n_paths, n_days) int index matrix, each row a random permutation that only moves days within their segment
+        (one argsort of random keys offset by the segment code)
+    """
+    keys = rng.random((n_paths, len(segment_codes))) + segment_codes
+    return np.argsort(keys, axis=1)
+
+
+def moving_block_matrix(n_paths, n_days, block_length, rng):
+    """
+    Moving-block bootstrap: each path is made of blocks of block_length consecutive days starting at random days,
+    cut to n_days.
+    :return: (n_paths, n_days) int index matrix
+    """
+    block_length = int(min(max(block_length, 1), n_days))
+    n_blocks = int(math.ceil(n_days / block_length))
+    starts = rng.integers(0, n_days - block_length + 1, size=(n_paths, n_blocks))
+    idx = starts[:, :, None] + np.arange(block_length)
+    return idx.reshape(n_paths, n_blocks * block_length)[:, :n_days]
+
+
+def stationary_bootstrap_matrix(n_paths, n_days, block_length, rng):
+    """
+    Stationary bootstrap (Politis & Romano): a new block starts at a random day with probability 1 / block_length,
+    otherwise the path continues with the next day (wrapping around), so block lengths are geometric with mean
+    block_length.
+    :return: (n_paths, n_days) int index matrix
+    """
+    steps = np.arange(n_days)
+    new_block = rng.random((n_paths, n_days)) < 1.0 / max(block_length, 1)
+    new_block[:, 0] = True
+    starts = rng.integers(0, n_days, size=(n_paths, n_days))
+    block_start = np.maximum.accumulate(np.where(new_block, steps, 0), axis=1)
+    return (np.take_along_axis(starts, block_start, axis=1) + steps - block_start) % n_days
+
+
+def resample_matrix(method, n_paths, n_days, rng, block_length=None):
+    """
+    :param method: 'shuffle' (permutation of the days), 'block' (moving-block bootstrap) or 'stationary'
+        (stationary bootstrap)
+    :return: (n_paths, n_days) int index matrix
+    """
+    if method == 'shuffle':
+        return permutation_matrix(n_paths, n_days, rng)
+    if method == 'block':
+        return moving_block_matrix(n_paths, n_days, block_length, rng)
+    if method == 'stationary':
+        return stationary_bootstrap_matrix(n_paths, n_days, block_length, rng)
+    raise ValueError('[resample_matrix] method must be one of %s' % MC_METHODS)
+
+
+def optimal_block_length(pnl, method='stationary'):
+    """
+    Automatic block length of Politis & White (2004), with the correction of Patton, Politis & White (2009).
+    :param method: 'stationary' or 'block' (the circular block value is used for the moving-block bootstrap)
+    :return: block length (float >= 1)
+    """
+    x = np.asarray(pnl, dtype=float)
+    n = len(x)
+    if n < 4:
+        return 1.0
+    x = x - x.mean()
+    kn = max(5, int(math.ceil(math.sqrt(math.log10(n)))))
+    m_max = min(int(math.ceil(math.sqrt(n))) + kn, n - 1)
+    b_max = math.ceil(min(3 * math.sqrt(n), n / 3))
+
+    acv = np.array([x[:n - k] @ x[k:] / n for k in range(m_max + 1)])
+    if acv[0] == 0:
+        return 1.0
+    rho = np.abs(acv[1:] / acv[0])
+    # smallest lag after which kn consecutive autocorrelations are insignificant
+    insignificant = rho < 2 * math.sqrt(math.log10(n) / n)
+    m_hat = m_max
+    for m in range(0, len(rho) - kn + 1):
+        if insignificant[m:m + kn].all():
+            m_hat = m
+            break
+    m_lag = min(2 * max(m_hat, 1), m_max)
+
+    lags = np.arange(-m_lag, m_lag + 1)
+    s = np.abs(lags / m_lag)
+    flat_top = np.where(s <= 0.5, 1.0, np.where(s <= 1, 2 * (1 - s), 0.0))
+    r = acv[np.abs(lags)]
+    g = (flat_top * np.abs(lags) * r).sum()
+    spectral = (flat_top * r).sum()
+    d = 2 * spectral ** 2 if method == 'stationary' else 4.0 / 3 * spectral ** 2
+    if d == 0:
+        return 1.0
+    b = (2 * g ** 2 / d) ** (1.0 / 3) * n ** (1.0 / 3)
+    return float(min(max(b, 1.0), b_max))
+
+
+def cal_block_win_rate(pnl_paths, block):
+    """
+    Fraction of the blocks of `block` consecutive periods (the last block may be shorter) with a positive sum.
+    """
+    n_paths, n_days = pnl_paths.shape
+    n_blocks = int(math.ceil(n_days / block))
+    padded = np.zeros((n_paths, n_blocks * block))
+    padded[:, :n_days] = pnl_paths
+    block_pnl = padded.reshape(n_paths, n_blocks, block).sum(axis=2)
+    return (block_pnl > 0).sum(axis=1) / n_blocks
+
+
+def cal_equity_metrics(equity, initial_equity=50000, one_year_period=356):
+    """
+    Drawdown / equity / CAR metrics of a batch of equity curves with numpy reductions along the day axis.
+    :param equity: (n_paths, n_days) array, one row per path
+    :return: dict metric name -> array of n_paths values (all MC_COLUMNS except the win rates)
+    """
+    n_paths, n_days = equity.shape
+    mdd, mdd_period = cal_max_drawdown(equity)
+
+    end_equity = equity[:, -1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        car = np.log(end_equity / initial_equity) / (n_days / one_year_period)
+        car_mdd = np.where(mdd > 0, car / np.where(mdd > 0, mdd, 1), 9999)
+
+    return {
+        'MDD': mdd,
+        'MDD_Period': mdd_period,
+        'Max_Equity': equity.max(axis=1),
+        'Min_Equity': equity.min(axis=1),
+        'CAR/MDD': car_mdd,
+        'CAR': car,
+        'End_Equity': end_equity,
+        'Init_Equity': np.full(n_paths, float(initial_equity))
+    }
+
+
+def cal_path_metrics(pnl_paths, initial_equity=50000, multiplier=10, one_year_period=356):
+    """
+    All metrics of a batch of pnl paths with numpy reductions along the day axis.
+    :param pnl_paths: (n_paths, n_days) array, one row per path
+    :return: dict metric name -> array of n_paths values
+    """
+    pnl_paths = np.asarray(pnl_paths, dtype=float)
+    equity = initial_equity + multiplier * np.cumsum(pnl_paths, axis=1)
+    metrics = cal_equity_metrics(equity, initial_equity, one_year_period)
+    for name, block in WIN_RATE_BLOCKS:
+        metrics[name] = cal_block_win_rate(pnl_paths, block)
+    return metrics
+
+
+def sizing_equity(pnl_paths, cum_pnl, initial_equity, multiplier, rule, log_growth_cache):
+    """
+    Equity curves of one sizing scenario, from the shared pnl paths / cumulative pnl of a chunk.
+    :param log_growth_cache: dict multiplier / initial_equity -> cumulative log growth, shared by the 'fractional'
+        scenarios of a chunk that only differ by scale
+    """
+    if rule == 'fixed':
+        return initial_equity + multiplier * cum_pnl
+    if rule == 'fractional':
+        ratio = multiplier / initial_equity
+        if ratio not in log_growth_cache:
+            with np.errstate(divide='ignore'):
+                # a period losing 100% or more ruins the path: equity stays 0 afterwards
+                log_growth_cache[ratio] = np.cumsum(np.log(np.maximum(1 + ratio * pnl_paths, 0)), axis=1)
+        return initial_equity * np.exp(log_growth_cache[ratio])
+    raise ValueError('[sizing_equity] rule must be one of %s' % SIZING_RULES)
+
+
+def simulate_sizing_scenarios(pnl, scenarios, times=10000, one_year_period=356, seed=None, seed_key=(),
+                              chunk_size=None, use_tqdm=False, method='shuffle', block_length=None):
+    """
+    Evaluate several sizing scenarios on the same resampled paths: each chunk of paths is drawn once, its cumulative
+    pnl and block win rates are computed once, and only the equity curve / drawdown reductions are repeated per
+    scenario. The paths are the ones simulate_monte_carlo draws with the same seed, seed_key and chunk_size.
+    :param scenarios: list of (initial_equity, multiplier, rule), rule in SIZING_RULES
+    :return: list (one per scenario) of dict metric name -> array of `times` values
+    """
+    pnl = np.asarray(pnl, dtype=float)
+    n_days = len(pnl)
+    for _, _, rule in scenarios:
+        if rule not in SIZING_RULES:
+            raise ValueError('[simulate_sizing_scenarios] rule must be one of %s' % SIZING_RULES)
+    if method != 'shuffle' and block_length is None:
+        block_length = optimal_block_length(pnl, method)
+    if chunk_size is None:
+        chunk_size = max(1, MAX_CHUNK_CELLS // max(n_days, 1))
+    seed_seq = make_seed_sequence(seed, seed_key)
+
+    results = [{name: [] for name in MC_COLUMNS} for _ in scenarios]
+    chunk_starts = range(0, times, chunk_size)
+    for chunk, start in enumerate(tqdm(chunk_starts) if use_tqdm else chunk_starts):
+        n_paths = min(chunk_size, times - start)
+        rng = chunk_rng(seed_seq, chunk)
+        pnl_paths = pnl[resample_matrix(method, n_paths, n_days, rng, block_length)]
+        cum_pnl = np.cumsum(pnl_paths, axis=1)
+        win_rates = {name: cal_block_win_rate(pnl_paths, block) for name, block in WIN_RATE_BLOCKS}
+        log_growth_cache = {}
+        for result, (initial_equity, multiplier, rule) in zip(results, scenarios):
+            equity = sizing_equity(pnl_paths, cum_pnl, initial_equity, multiplier, rule, log_growth_cache)
+            metrics = cal_equity_metrics(equity, initial_equity, one_year_period)
+            metrics.update(win_rates)
+            for name in MC_COLUMNS:
+                result[name].append(metrics[name])
+    return [{name: np.concatenate(values) for name, values in result.items()} for result in results]
+
+
+def simulate_monte_carlo(pnl, initial_equity=50000, multiplier=10, times=10000, one_year_period=356, seed=None,
+                         seed_key=(), chunk_size=None, use_tqdm=False, use_sketch=False, relative_accuracy=0.001,
+                         chunk_range=None, processes=1, method='shuffle', block_length=None):
+    """
+    Shuffle the order of pnl `times` times (or resample it with a block bootstrap) and compute the metrics of every
+    path. Paths are generated in chunks as an index matrix so that the memory stays bounded, each chunk with its own
+    generator (chunk_rng).
+    A given seed / seed_key gives bit-identical results.
+    :param seed: int / SeedSequence, None for fresh entropy
+    :param chunk_size: paths per chunk, by default as many as fit in MAX_CHUNK_CELLS. It is part of the result: the same
+        seed with another chunk size gives other paths
+    :param use_sketch: feed the metrics into one QuantileSketch per metric instead of keeping every value, so that the
+        memory doesn't grow with times (for runs of millions of paths)
+    :param chunk_range: (first, end) to only run the chunks first..end-1 (one share of a parallel run)
+    :param processes: split the chunks over a process pool and concatenate / merge the shares, same result as 1 process
+    :param method: 'shuffle', 'block' or 'stationary' (see resample_matrix). The block methods keep the serial
+        dependence of pnl inside each block
+    :param block_length: (mean) block length of the block methods, None for optimal_block_length
+    :return: dict metric name -> array of `times` values (or QuantileSketch if use_sketch)
+    """
+    pnl = np.asarray(pnl, dtype=float)
+    n_days = len(pnl)
+    if method != 'shuffle' and block_length is None:
+        block_length = optimal_block_length(pnl, method)
+    if chunk_size is None:
+        chunk_size = max(1, MAX_CHUNK_CELLS // max(n_days, 1))
+    n_chunks = int(math.ceil(times / chunk_size))
+    chunk_range = (0, n_chunks) if chunk_range is None else chunk_range
+
+    if processes > 1:
+        kwargs = dict(initial_equity=initial_equity, multiplier=multiplier, times=times,
+                      one_year_period=one_year_period, seed=make_seed_sequence(seed), seed_key=seed_key,
+                      chunk_size=chunk_size, use_sketch=use_sketch, relative_accuracy=relative_accuracy,
+                      method=method, block_length=block_length)
+        bounds = np.linspace(chunk_range[0], chunk_range[1], processes + 1).astype(int)
+        pool = multiprocessing.Pool(processes=processes)
+        jobs = [pool.apply_async(simulate_monte_carlo, args=(pnl, ),
+                                 kwds=dict(kwargs, chunk_range=(int(first), int(end))))
+                for first, end in zip(bounds[:-1], bounds[1:]) if end > first]
+        pool.close()
+        shares = [job.get() for job in jobs]
+        pool.join()
+        return merge_monte_carlo_results(shares)
+
+    seed_seq = make_seed_sequence(seed, seed_key)
+    if use_sketch:
+        result = {name: QuantileSketch(relative_accuracy) for name in MC_COLUMNS}
+    else:
+        result = {name: [] for name in MC_COLUMNS}
+    chunks = range(chunk_range[0], chunk_range[1])
+    for chunk in (tqdm(chunks) if use_tqdm else chunks):
+        n_paths = min(chunk_size, times - chunk * chunk_size)
+        rng = chunk_rng(seed_seq, chunk)
+        metrics = cal_path_metrics(pnl[resample_matrix(method, n_paths, n_days, rng, block_length)],
+                                   initial_equity, multiplier, one_year_period)
+        for name in MC_COLUMNS:
+            if use_sketch:
+                result[name].add(metrics[name])
+            else:
+                result[name].append(metrics[name])
+    if use_sketch:
+        return result
+    return {name: np.concatenate(values) if len(values) > 0 else np.zeros(0) for name, values in result.items()}
+
+
+def simulate_monte_carlo_segments(pnl, segment_bounds, initial_equity=50000, multiplier=10, times=10000,
+                                  one_year_period=356, seed=None, seed_key=(), chunk_size=None, use_tqdm=False):
+    """
+    Monte Carlo of every segment of pnl (e.g. every year) in one pass: each path permutes the days within their segment
+    (segment_permutation_matrix) and the metrics of each segment are computed on its columns of the path matrix.
+    :param segment_bounds: list of (start, end) of the segments, in order and covering pnl
+    :return: list (one per segment) of dict metric name -> array of `times` values
+    """
+    pnl = np.asarray(pnl, dtype=float)
+    n_days = len(pnl)
+    lengths = [end - start for start, end in segment_bounds]
+    if len(segment_bounds) == 0 or segment_bounds[0][0] != 0 or segment_bounds[-1][1] != n_days or \
+            any(segment_bounds[i][1] != segment_bounds[i + 1][0] for i in range(len(segment_bounds) - 1)) or \
+            min(lengths) <= 0:
+        raise ValueError('[simulate_monte_carlo_segments] segment_bounds must be consecutive and cover pnl')
+    segment_codes = np.repeat(np.arange(len(segment_bounds)), lengths)
+    if chunk_size is None:
+        chunk_size = max(1, MAX_CHUNK_CELLS // max(n_days, 1))
+    seed_seq = make_seed_sequence(seed, seed_key)
+
+    results = [{name: [] for name in MC_COLUMNS} for _ in segment_bounds]
+    chunk_starts = range(0, times, chunk_size)
+    for chunk, start in enumerate(tqdm(chunk_starts) if use_tqdm else chunk_starts):
+        n_paths = min(chunk_size, times - start)
+        rng = chunk_rng(seed_seq, chunk)
+        paths = pnl[segment_permutation_matrix(n_paths, segment_codes, rng)]
+        for result, (seg_start, seg_end) in zip(results, segment_bounds):
+            metrics = cal_path_metrics(paths[:, seg_start:seg_end], initial_equity, multiplier, one_year_period)
+            for name in MC_COLUMNS:
+                result[name].append(metrics[name])
+    return [{name: np.concatenate(values) for name, values in result.items()} for result in results]
+
+
+def simulate_portfolio_monte_carlo(pnl_matrix, weights, initial_equity=50000, multiplier=10, times=10000,
+                                   one_year_period=356, seed=None, seed_key=(), chunk_size=None, use_tqdm=False,
+                                   method='shuffle', block_length=None):
+    """
+    Portfolio Monte Carlo: whole days (rows of pnl_matrix) are resampled, so the correlation between strategies on the
+    same day is kept. Resampling rows commutes with weighting them, so the days x portfolios pnl is computed once with
+    one matmul and every chunk evaluates all the weight vectors on the same paths.
+    The paths only depend on the seed, n_days and chunk_size (as in simulate_monte_carlo), so the result of a portfolio
+    doesn't change with the other candidates passed along.
+    :param pnl_matrix: (n_days, n_strategies) daily pnl
+    :param weights: (n_portfolios, n_strategies) weight of each strategy in each candidate portfolio
+    :param block_length: see simulate_monte_carlo, None for the mean optimal_block_length of the strategies
+    :return: list (one per portfolio) of dict metric name -> array of `times` values
+    """
+    pnl_matrix = np.asarray(pnl_matrix, dtype=float)
+    weights = np.atleast_2d(np.asarray(weights, dtype=float))
+    if pnl_matrix.ndim != 2 or weights.shape[1] != pnl_matrix.shape[1]:
+        raise ValueError('[simulate_portfolio_monte_carlo] weights must have one column per strategy (column of '
+                         'pnl_matrix)')
+    portfolio_pnl = pnl_matrix @ weights.T
+    n_days, n_portfolios = portfolio_pnl.shape
+    if method != 'shuffle' and block_length is None:
+        block_length = np.mean([optimal_block_length(pnl_matrix[:, i], method) for i in range(pnl_matrix.shape[1])])
+    if chunk_size is None:
+        chunk_size = max(1, MAX_CHUNK_CELLS // max(n_days, 1))
+    seed_seq = make_seed_sequence(seed, seed_key)
+
+    results = [{name: [] for name in MC_COLUMNS} for _ in range(n_portfolios)]
+    chunk_starts = range(0, times, chunk_size)
+    for chunk, start in enumerate(tqdm(chunk_starts) if use_tqdm else chunk_starts):
+        n_paths = min(chunk_size, times - start)
+        rng = chunk_rng(seed_seq, chunk)
+        idx = resample_matrix(method, n_paths, n_days, rng, block_length)
+        # one portfolio at a time, so a chunk never holds more than n_paths x n_days pnl
+        for i, result in enumerate(results):
+            metrics = cal_path_metrics(portfolio_pnl[:, i][idx], initial_equity, multiplier, one_year_period)
+            for name in MC_COLUMNS:
+                result[name].append(metrics[name])
+    return [{name: np.concatenate(values) for name, values in result.items()} for result in results]
+
+
+def merge_monte_carlo_results(shares):
+    """
+    Combine the results of consecutive chunk ranges of simulate_monte_carlo (arrays are concatenated in order,
+    sketches merged).
+    """
+    merged = {}
+    for name in MC_COLUMNS:
+        if isinstance(shares[0][name], QuantileSketch):
+            merged[name] = shares[0][name]
+            for share in shares[1:]:
+                merged[name].merge(share[name])
+        else:
+            merged[name] = np.concatenate([share[name] for share in shares])
+    return merged
+
+
+def simulate_monte_carlo_adaptive(pnl, initial_equity=50000, multiplier=10, one_year_period=356, tolerance=0.01,
+                                  min_times=MC_MIN_TIMES, max_times=100000, metrics=None, percentiles=None,
+                                  confidence=0.95, seed=None, seed_key=(), use_tqdm=False, method='shuffle',
+                                  block_length=None):
+    """
+    Run paths in batches of MC_BATCH_PATHS until the confidence interval of every tracked percentile is within
+    tolerance (relative half width), or max_times paths are done.
+    :param metrics: metrics to track, MC_CONVERGENCE_METRICS by default
+    :param method, block_length: see simulate_monte_carlo
+    :return: (dict metric name -> array of values, number of paths used)
+    """
+    pnl = np.asarray(pnl, dtype=float)
+    if method != 'shuffle' and block_length is None:
+        block_length = optimal_block_length(pnl, method)
+    metrics = MC_CONVERGENCE_METRICS if metrics is None else metrics
+    percentiles = MC_PERCENTILES if percentiles is None else percentiles
+    seed_seq = make_seed_sequence(seed, seed_key)
+    n_days = len(pnl)
+    chunk_size = max(1, min(MC_BATCH_PATHS, MAX_CHUNK_CELLS // max(n_days, 1)))
+
+    results = []
+    times = 0
+    chunk = 0
+    next_check = min_times
+    progress = tqdm(total=max_times) if use_tqdm else None
+    while times < max_times:
+        n_paths = min(chunk_size, max_times - times)
+        rng = chunk_rng(seed_seq, chunk)
+        results.append(cal_path_metrics(pnl[resample_matrix(method, n_paths, n_days, rng, block_length)],
+                                        initial_equity, multiplier, one_year_period))
+        times += n_paths
+        chunk += 1
+        if progress is not None:
+            progress.update(n_paths)
+        if times >= next_check:
+            next_check = times + MC_BATCH_PATHS
+            merged = {name: np.concatenate([r[name] for r in results]) for name in metrics}
+            if all(is_percentile_converged(merged[name], percentiles, tolerance, confidence,
+                                           descending=name not in MC_ASCENDING) for name in metrics):
+                break
+    if progress is not None:
+        progress.close()
+    return {name: np.concatenate([r[name] for r in results]) for name in MC_COLUMNS}, times
+
+
+def cal_percentile_ci(values, percentile, confidence=0.95, descending=False):
+    """
+    Bootstrap confidence interval of the value at floor(n * percentile) of the sorted values. The number of resampled
+    values below the j-th order statistic is Binomial(n, j / n), so the interval is read straight from the order
+    statistics (normal approximation of the binomial) instead of resampling.
+    :return: (value, lower, upper)
+    """
+    values = np.sort(values)
+    if descending:
+        values = values[::-1]
+    n = len(values)
+    k = int(math.floor(n * percentile))
+    z = norm.ppf(0.5 + confidence / 2)
+    half = z * math.sqrt(n * percentile * (1 - percentile))
+    lo = max(0, int(math.floor(k - half)))
+    hi = min(n - 1, int(math.ceil(k + half)))
+    bounds = sorted([values[lo], values[hi]])
+    return values[k], bounds[0], bounds[1]
+
+
+def is_percentile_converged(values, percentiles, tolerance, confidence=0.95, descending=False):
+    """
+    True if the half width of the confidence interval of every percentile is within tolerance * |value|.
+    """
+    for p in percentiles:
+        value, lower, upper = cal_percentile_ci(values, p, confidence, descending)
+        if not np.isfinite(value) or (upper - lower) / 2 > tolerance * abs(value):
+            return False
+    return True
+
+
+def percentile_labels(percentiles=None):
+    """
+    e.g. [0.999, 0.9] -> ['99.9%', '90%']
+    """
+    percentiles = MC_PERCENTILES if percentiles is None else percentiles
+    return ['%g%%' % round(p * 100, 10) for p in percentiles]
+
+
+def cal_percentile_table(metrics, percentiles=None):
+    """
+    The value of each metric that a given fraction of the paths does at least as well as: MDD and MDD period are
+    sorted ascending, the others descending, and the value at floor(n * percentile) is taken.
+    :param metrics: dict metric name -> array of values or QuantileSketch
+    :param percentiles: MC_PERCENTILES by default, any other list (e.g. [0.999, 0.99, 0.9]) gives one row each
+    :return: list of rows (one per percentile), each a list of values in the order of MC_COLUMNS
+    """
+    percentiles = MC_PERCENTILES if percentiles is None else percentiles
+    table = [[] for _ in percentiles]
+    for name in MC_COLUMNS:
+        values = metrics[name]
+        if isinstance(values, QuantileSketch):
+            n = values.count
+            for row, p in zip(table, percentiles):
+                k = int(math.floor(n * p))
+                row.append(values.value_at_rank(k if name in MC_ASCENDING else n - 1 - k))
+        else:
+            values = np.sort(values)
+            values = values if name in MC_ASCENDING else values[::-1]
+            for row, p in zip(table, percentiles):
+                row.append(values[int(math.floor(len(values) * p))])
+    return table
@@ -0,0 +1,119 @@
+import os
+import datetime
+import numpy as np
+import pandas as pd
+from date_utils import parse_with_format
+
+# price file path -> IndexPriceStore, so that every process maps a price file only once
+PRICE_STORES = {}
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+class IndexPriceStore:
+    """
+    Day-end close series of an index (e.g. HI1.csv: Dates,PX_LAST with dates in %d/%m/%Y) converted once into binary
+    .npy files next to the csv, and memory-mapped read-only afterwards. All processes on the machine share the same
+    pages, and day -> close / previous close lookups are O(1) through a dense array keyed by day ordinal.
+        <price file>.prices.npy - structured array (ordinal, close) sorted by day
+        <price file>.lookup.npy - row of each day ordinal in prices.npy (-1 for non-trading days)
+    """
+    def __init__(self, price_data_path, date_format='%d/%m/%Y', cache_dir=None):
+        self.price_data_path = price_data_path
+        self.date_format = date_format
+        cache_root = price_data_path if cache_dir is None else \
+            os.path.join(cache_dir, os.path.basename(price_data_path))
+        self.prices_path = cache_root + '.prices.npy'
+        self.lookup_path = cache_root + '.lookup.npy'
+
+        if self.is_stale():
+            self.build()
+        self.prices = np.load(self.prices_path, mmap_mode='r')
+        self.lookup = np.load(self.lookup_path, mmap_mode='r')
+        self.first_ordinal = int(self.prices['ordinal'][0]) if len(self.prices) > 0 else 0
+
+    def is_stale(self):
+        if not os.path.exists(self.prices_path) or not os.path.exists(self.lookup_path):
+            return True
+        csv_mtime = os.path.getmtime(self.price_data_path)
+        return os.path.getmtime(self.prices_path) < csv_mtime or os.path.getmtime(self.lookup_path) < csv_mtime
+
+    def build(self):
+        """
+        Parse the csv (one vectorized to_datetime call) and write the binary files. Files are written under a temporary
+        name and then renamed, so a process reading them never sees a half-written file.
+        """
+        raw = pd.read_csv(self.price_data_path)
+        dates = parse_with_format(raw.iloc[:, 0], self.date_format)
+        close = pd.to_numeric(raw.iloc[:, 1], errors='coerce')
+        valid = dates.notna() & close.notna()
+        data = pd.DataFrame({'Date': dates[valid], 'Close': close[valid]}).sort_values(by=['Date'], kind='stable')
+        data = data.drop_duplicates(subset=['Date'], keep='last')
+
+        prices = np.zeros(len(data), dtype=[('ordinal', '<i8'), ('close', '<f8')])
+        prices['ordinal'] = data['Date'].values.astype('datetime64[D]').astype(np.int64) + EPOCH_ORDINAL
+        prices['close'] = data['Close'].values
+        if len(prices) > 0:
+            lookup = np.full(prices['ordinal'][-1] - prices['ordinal'][0] + 1, -1, dtype=np.int32)
+            lookup[prices['ordinal'] - prices['ordinal'][0]] = np.arange(len(prices), dtype=np.int32)
+        else:
+            lookup = np.zeros(0, dtype=np.int32)
+
+        for path, arr in [(self.prices_path, prices), (self.lookup_path, lookup)]:
+            tmp_path = path + '.%d.tmp' % os.getpid()
+            with open(tmp_path, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmp_path, path)
+
+    @property
+    def dates(self):
+        return (self.prices['ordinal'] - EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[ns]')
+
+    @property
+    def closes(self):
+        return self.prices['close']
+
+    def position(self, day):
+        """
+        Row of day in the close series, -1 if day is not a trading day in the file.
+        """
+        i = pd.Timestamp(day).toordinal() - self.first_ordinal
+        if i < 0 or i >= len(self.lookup):
+            return -1
+        return int(self.lookup[i])
+
+    def positions(self, days):
+        """
+        Vectorized position() for an array of days.
+        """
+        days = np.asarray(days, dtype='datetime64[D]').astype(np.int64) + EPOCH_ORDINAL - self.first_ordinal
+        inside = (days >= 0) & (days < len(self.lookup))
+        res = np.full(len(days), -1, dtype=np.int64)
+        res[inside] = self.lookup[days[inside]]
+        return res
+
+    def close(self, day):
+        pos = self.position(day)
+        return float(self.prices['close'][pos]) if pos >= 0 else np.nan
+
+    def prev_close(self, day):
+        """
+        Close of the trading day before day (day itself must be a trading day).
+        """
+        pos = self.position(day)
+        return float(self.prices['close'][pos - 1]) if pos > 0 else np.nan
+
+    def to_frame(self):
+        return pd.DataFrame({'Date': self.dates, 'PX_LAST': np.asarray(self.closes)})
+
+
+def get_price_store(price_data_path, date_format='%d/%m/%Y'):
+    """
+    Per-process cache of IndexPriceStore. The store is reopened if the csv changed since it was mapped.
+    """
+    key = os.path.abspath(price_data_path)
+    store = PRICE_STORES.get(key)
+    if store is None or store.is_stale():
+        store = IndexPriceStore(price_data_path, date_format=date_format)
+        PRICE_STORES[key] = store
+    return store
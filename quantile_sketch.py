@@ -0,0 +1,147 @@
+import math
+import numpy as np
+
+
+class QuantileSketch:
+    """
+    Mergeable streaming quantile sketch with a relative error guarantee (DDSketch): a value x > 0 is counted in the
+    bucket ceil(log(x) / log(gamma)), gamma = (1 + a) / (1 - a), and every bucket is read back as a value within a
+    relative error a of all the values it holds. Negative values go to a mirrored store, values close to 0 and +-inf
+    to their own counters. Memory only depends on the range of the values, not on how many are added, and two sketches
+    with the same accuracy merge exactly by adding their bucket counts.
+    """
+    def __init__(self, relative_accuracy=0.001, min_value=1e-12):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('[QuantileSketch] relative_accuracy must be in (0, 1)')
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        # dense bucket counts, bucket key = offset + position in the array
+        self.positive = np.zeros(0, dtype=np.int64)
+        self.positive_offset = 0
+        self.negative = np.zeros(0, dtype=np.int64)
+        self.negative_offset = 0
+        self.zero_count = 0
+        self.pos_inf_count = 0
+        self.neg_inf_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def key(self, values):
+        return np.ceil(np.log(values) / self.log_gamma).astype(np.int64)
+
+    def key_value(self, key):
+        # the value that is within relative_accuracy of everything in bucket `key`
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    @staticmethod
+    def add_to_store(store, offset, keys, counts):
+        """
+        :return: (store, offset) grown to hold keys, with counts added
+        """
+        if len(keys) == 0:
+            return store, offset
+        lo = int(keys.min()) if len(store) == 0 else min(offset, int(keys.min()))
+        hi = int(keys.max()) if len(store) == 0 else max(offset + len(store) - 1, int(keys.max()))
+        if len(store) == 0 or lo < offset or hi >= offset + len(store):
+            grown = np.zeros(hi - lo + 1, dtype=np.int64)
+            grown[offset - lo:offset - lo + len(store)] = store
+            store, offset = grown, lo
+        np.add.at(store, keys - offset, counts)
+        return store, offset
+
+    def add(self, values):
+        """
+        Add an array of values (NaN are ignored).
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        finite = values[np.isfinite(values)]
+        self.pos_inf_count += int((values == np.inf).sum())
+        self.neg_inf_count += int((values == -np.inf).sum())
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        if len(finite) == 0:
+            return
+        self.sum += finite.sum()
+
+        magnitude = np.abs(finite)
+        self.zero_count += int((magnitude <= self.min_value).sum())
+        for sign in [1, -1]:
+            selected = magnitude[(finite * sign > 0) & (magnitude > self.min_value)]
+            keys, counts = np.unique(self.key(selected), return_counts=True)
+            if sign > 0:
+                self.positive, self.positive_offset = QuantileSketch.add_to_store(
+                    self.positive, self.positive_offset, keys, counts)
+            else:
+                self.negative, self.negative_offset = QuantileSketch.add_to_store(
+                    self.negative, self.negative_offset, keys, counts)
+
+    def merge(self, other):
+        """
+        Add the counts of another sketch (e.g. from another worker) to this one.
+        """
+        if other.relative_accuracy != self.relative_accuracy or other.min_value != self.min_value:
+            raise ValueError('[QuantileSketch.merge] sketches must have the same relative_accuracy and min_value')
+        for name in ['positive', 'negative']:
+            store = getattr(other, name)
+            keys = np.nonzero(store)[0]
+            merged, offset = QuantileSketch.add_to_store(
+                getattr(self, name), getattr(self, name + '_offset'),
+                keys + getattr(other, name + '_offset'), store[keys])
+            setattr(self, name, merged)
+            setattr(self, name + '_offset', offset)
+        self.zero_count += other.zero_count
+        self.pos_inf_count += other.pos_inf_count
+        self.neg_inf_count += other.neg_inf_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def value_at_rank(self, rank):
+        """
+        Estimate of the value at position `rank` (0-based) of the added values sorted ascending.
+        """
+        if self.count == 0:
+            return np.nan
+        rank = min(max(int(rank), 0), self.count - 1)
+        if rank == 0:
+            return self.min
+        if rank == self.count - 1:
+            return self.max
+
+        if rank < self.neg_inf_count:
+            return -np.inf
+        rank -= self.neg_inf_count
+        # negative values, from the largest magnitude down
+        negative_cum = np.cumsum(self.negative[::-1])
+        if len(negative_cum) > 0 and rank < negative_cum[-1]:
+            key = self.negative_offset + len(self.negative) - 1 - int(np.searchsorted(negative_cum, rank, side='right'))
+            return -self.key_value(key)
+        rank -= int(negative_cum[-1]) if len(negative_cum) > 0 else 0
+        if rank < self.zero_count:
+            return 0.0
+        rank -= self.zero_count
+        positive_cum = np.cumsum(self.positive)
+        if len(positive_cum) > 0 and rank < positive_cum[-1]:
+            return self.key_value(self.positive_offset + int(np.searchsorted(positive_cum, rank, side='right')))
+        return np.inf
+
+    def quantile(self, q):
+        """
+        :param q: in [0, 1]
+        """
+        return self.value_at_rank(int(math.floor(q * (self.count - 1))))
+
+    @property
+    def mean(self):
+        finite_count = self.count - self.pos_inf_count - self.neg_inf_count
+        return self.sum / finite_count if finite_count > 0 else np.nan
@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+from drawdown import cal_drawdown, cal_max_drawdown
+from metrics_kernel import GPR_NO_LOSS, k_ratio_from_sums
+
+ROLLING_METRICS = ['Slope', 'K_Ratio', 'MDD', 'MDD_Period']
+# label of the expanding window (window=None) in the result tables
+EXPANDING = 'expanding'
+# max number of cells (windows x window length) of one chunk of the rolling drawdown
+MAX_WINDOW_CELLS = 2000000
+
+
+def window_sums(values, window=None):
+    """
+    Sums along axis 0 over the last `window` rows (all the rows so far if window is None), from one cumsum. Rows before
+    the first full window are NaN.
+    """
+    cum = np.cumsum(values, axis=0)
+    if window is None:
+        return cum
+    sums = np.full(cum.shape, np.nan)
+    if window <= len(cum):
+        sums[window - 1] = cum[window - 1]
+        sums[window:] = cum[window:] - cum[:-window]
+    return sums
+
+
+def rolling_regression(equity, window=None):
+    """
+    Slope and K-ratio of the regression of equity on time over a rolling (or expanding) window ending on each day. The
+    regression sums are window sums of t, t^2, y, t*y and y^2, so every window is updated in O(1).
+    :param equity: (n_days, n_series) array
+    :return: (slope, k_ratio), (n_days, n_series) arrays
+    """
+    n_days = equity.shape[0]
+    t = np.arange(1, n_days + 1, dtype=float)[:, None]
+    count = t if window is None else np.full((n_days, 1), float(window))
+    # shift each series by its first value, the regression doesn't change and the sums of squares lose less precision
+    y = equity - equity[:1]
+    st, stt = window_sums(t, window), window_sums(t * t, window)
+    sy, sty, syy = window_sums(y, window), window_sums(t * y, window), window_sums(y * y, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx = stt - st ** 2 / count
+        sxy = sty - st * sy / count
+        syy = np.maximum(syy - sy ** 2 / count, 0)
+        return sxy / sxx, k_ratio_from_sums(count, sxx, sxy, syy)
+
+
+def expanding_drawdown(equity):
+    """
+    Max drawdown and max drawdown period from the first day to each day, in one pass of running maxima.
+    :param equity: (n_days, n_series) array
+    :return: (mdd, mdd_period), (n_days, n_series) arrays
+    """
+    n_days = equity.shape[0]
+    _, dd, new_high = cal_drawdown(equity.T)
+    steps = np.arange(n_days)
+    last_high = np.maximum.accumulate(np.where(new_high, steps, -1), axis=1)
+    mdd = np.maximum(np.maximum.accumulate(dd, axis=1), 0)
+    mdd_period = np.maximum.accumulate(steps - last_high, axis=1)
+    return mdd.T, mdd_period.T
+
+
+def rolling_drawdown(equity, window):
+    """
+    Max drawdown and max drawdown period of the `window` days ending on each day (the peak only looks back inside the
+    window). The windows are strided views of the equity, evaluated in chunks as a batch of paths.
+    :param equity: (n_days, n_series) array
+    :return: (mdd, mdd_period), (n_days, n_series) arrays, NaN before the first full window
+    """
+    n_days, n_series = equity.shape
+    mdd = np.full((n_days, n_series), np.nan)
+    mdd_period = np.full((n_days, n_series), np.nan)
+    if window > n_days:
+        return mdd, mdd_period
+    chunk_size = max(1, MAX_WINDOW_CELLS // window)
+    for i in range(n_series):
+        windows = np.lib.stride_tricks.sliding_window_view(equity[:, i], window)
+        for start in range(0, len(windows), chunk_size):
+            chunk = windows[start:start + chunk_size]
+            rows = slice(window - 1 + start, window - 1 + start + len(chunk))
+            mdd[rows, i], mdd_period[rows, i] = cal_max_drawdown(chunk)
+    return mdd, mdd_period
+
+
+def rolling_gpr(period_pnl, window=None):
+    """
+    GPR (total pnl / total loss of the losing periods) over a rolling (or expanding) window, e.g. of monthly pnl.
+    :param period_pnl: (n_periods, n_series) array
+    """
+    period_pnl = np.asarray(period_pnl, dtype=float)
+    total_pnl = window_sums(period_pnl, window)
+    total_loss = -window_sums(np.minimum(period_pnl, 0), window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total_loss == 0, np.where(np.isnan(total_loss), np.nan, GPR_NO_LOSS), total_pnl / total_loss)
+
+
+def window_label(window):
+    return EXPANDING if window is None else window
+
+
+def cal_rolling_metrics(pnl, windows=(None,), initial_equity=0):
+    """
+    Rolling / expanding slope, K-ratio, MDD and MDD period of many pnl series at once.
+    :param pnl: DataFrame days x strategies (e.g. CalculateCustomMetrics.read_daily_pnl_matrix), or a 2-D array
+    :param windows: window lengths in days, None for the expanding window from the first day
+    :param initial_equity: the equity curve is initial_equity + cumulative pnl (0 as in generate_my_metrics)
+    :return: DataFrame with the index of pnl and columns (Window, Metric, Strategy)
+    """
+    if not isinstance(pnl, pd.DataFrame):
+        pnl = pd.DataFrame(np.asarray(pnl, dtype=float).reshape(len(pnl), -1))
+    equity = initial_equity + np.cumsum(pnl.values.astype(float), axis=0)
+    tables = {}
+    for window in windows:
+        if window is not None and window < 3:
+            raise ValueError('[cal_rolling_metrics] a window must be at least 3 days')
+        slope, k_ratio = rolling_regression(equity, window)
+        mdd, mdd_period = expanding_drawdown(equity) if window is None else rolling_drawdown(equity, window)
+        for name, values in zip(ROLLING_METRICS, [slope, k_ratio, mdd, mdd_period]):
+            tables[(window_label(window), name)] = pd.DataFrame(values, index=pnl.index, columns=pnl.columns)
+    return pd.concat(tables, axis=1, names=['Window', 'Metric', 'Strategy'])
+
+
+def cal_rolling_gpr(monthly_pnl, windows=(None,)):
+    """
+    :param monthly_pnl: DataFrame months x strategies
+    :param windows: window lengths in months, None for the expanding window
+    :return: DataFrame with the index of monthly_pnl and columns (Window, Strategy)
+    """
+    tables = {window_label(window): pd.DataFrame(rolling_gpr(monthly_pnl.values, window), index=monthly_pnl.index,
+                                                 columns=monthly_pnl.columns)
+              for window in windows}
+    return pd.concat(tables, axis=1, names=['Window', 'Strategy'])
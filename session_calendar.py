@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+
+# HSI futures: the after-hours (T+1) session that starts in the evening is traded for the next trading day.
+# Each session: (name, start time, end time, starts on the previous trading day). end < start means it runs past midnight.
+HSI_SESSIONS = [('T+1', '17:15:00', '03:00:00', True),
+                ('Day', '09:15:00', '16:30:00', False)]
+
+
+def session_deltas(start, end):
+    """
+    :return: (start, end) of a session as timedeltas from the midnight of the day it starts on
+    """
+    start_delta = np.timedelta64(pd.Timedelta(start))
+    end_delta = np.timedelta64(pd.Timedelta(end))
+    if end_delta < start_delta:
+        end_delta = end_delta + np.timedelta64(1, 'D')
+    return start_delta, end_delta
+
+
+class SessionCalendar:
+    """
+    Maps any timestamp to its trading day with precomputed boundary arrays and searchsorted, e.g. an HSI trade at
+    Friday 22:00 (after-hours session) belongs to Monday's trading day.
+    Trading day k covers (day_end[k-1], day_end[k]], where day_end[k] = trading_days[k] + day_end_time.
+    day_end_time defaults to 1s after the latest close of the sessions that start on the trading day itself.
+    """
+    def __init__(self, trading_days, sessions=None, day_end_time=None):
+        self.sessions = HSI_SESSIONS if sessions is None else sessions
+        same_day_ends = [session_deltas(start, end)[1] for _, start, end, on_prev_day in self.sessions
+                         if not on_prev_day]
+        if day_end_time is None:
+            if len(same_day_ends) == 0:
+                raise ValueError('[SessionCalendar] day_end_time is needed when every session starts on the previous '
+                                 'trading day')
+            day_end_time = pd.Timedelta(max(same_day_ends) + np.timedelta64(1, 's'))
+        elif len(same_day_ends) > 0 and np.timedelta64(pd.Timedelta(day_end_time)) <= max(same_day_ends):
+            raise ValueError('[SessionCalendar] day_end_time %s must be after the close of every session that starts '
+                             'on the trading day' % day_end_time)
+        self.day_end_time = day_end_time
+        self.trading_days = np.unique(np.asarray(trading_days, dtype='datetime64[D]')).astype('datetime64[ns]')
+        if len(self.trading_days) == 0:
+            raise ValueError('[SessionCalendar] trading_days must not be empty')
+
+        self.day_end = self.trading_days + np.timedelta64(pd.Timedelta(self.day_end_time))
+        # the first day has no previous trading day in the list, take the previous business day
+        first_prev_day = (pd.Timestamp(self.trading_days[0]) - pd.offsets.BDay(1)).to_datetime64()
+        self.day_start = np.concatenate([
+            np.array([first_prev_day + np.timedelta64(pd.Timedelta(self.day_end_time))], dtype='datetime64[ns]'),
+            self.day_end[:-1]])
+
+        # absolute session windows of every trading day, flattened and sorted by start
+        prev_days = np.concatenate([np.array([first_prev_day], dtype='datetime64[ns]'), self.trading_days[:-1]])
+        starts = []
+        ends = []
+        session_ids = []
+        for i, (name, start, end, on_prev_day) in enumerate(self.sessions):
+            base = prev_days if on_prev_day else self.trading_days
+            start_delta, end_delta = session_deltas(start, end)
+            starts.append(base + start_delta)
+            ends.append(base + end_delta)
+            session_ids.append(np.full(len(base), i))
+        starts = np.concatenate(starts)
+        order = np.argsort(starts, kind='stable')
+        self.session_start = starts[order]
+        self.session_end = np.concatenate(ends)[order]
+        self.session_id = np.concatenate(session_ids)[order]
+
+    def with_days(self, trading_days):
+        """
+        Same sessions on another list of trading days.
+        """
+        return SessionCalendar(trading_days, self.sessions, self.day_end_time)
+
+    def trading_day_index(self, times):
+        """
+        :return: position in trading_days of the trading day of each timestamp (len(trading_days) if after the last day)
+        """
+        return np.searchsorted(self.day_end, np.asarray(times, dtype='datetime64[ns]'), side='left')
+
+    def trading_day(self, times):
+        """
+        :return: trading day of each timestamp (NaT if after the last trading day)
+        """
+        idx = self.trading_day_index(times)
+        res = np.full(len(idx), np.datetime64('NaT'), dtype='datetime64[ns]')
+        inside = idx < len(self.trading_days)
+        res[inside] = self.trading_days[idx[inside]]
+        return res
+
+    def session_index(self, times):
+        """
+        :return: index in sessions of the session each timestamp falls in (-1 if outside all sessions)
+        """
+        times = np.asarray(times, dtype='datetime64[ns]')
+        idx = np.searchsorted(self.session_start, times, side='right') - 1
+        res = np.full(len(times), -1, dtype=np.int64)
+        inside = idx >= 0
+        inside[inside] = times[inside] <= self.session_end[idx[inside]]
+        res[inside] = self.session_id[idx[inside]]
+        return res
+
+    def session_name(self, times):
+        names = np.array([s[0] for s in self.sessions] + [''], dtype=object)
+        return names[self.session_index(times)]
@@ -1,7 +1,8 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import datetime, os, configparser, time, math, calendar, warnings, sys
+import datetime, os, configparser, time, math, calendar, warnings
+from session_calendar import SessionCalendar
 # from generate_html import GenerateHTML
 
 pd.set_option('display.max_columns', 500)
@@ -14,11 +15,12 @@ class StrategyMonitory:
                               FUTURES_LETTER_MONTH_MAP[datetime.datetime.now().month] +
                               str(datetime.datetime.now().year)[3]}
 
-    def __init__(self, root_path, trades_root_path, today_date_list, source):
+    def __init__(self, root_path, trades_root_path, today_date_list, source, sessions=None):
         self.root_path = root_path
         self.trades_root_path = trades_root_path
         self.today_date_list = today_date_list if isinstance(today_date_list, list) else [today_date_list]
         self.source = source
+        self.sessions = sessions  # trading sessions for SessionCalendar, None -> HSI day + after-hours sessions
 
     def run(self):
         for today_date in self.today_date_list:
@@ -441,9 +443,17 @@ class StrategyMonitory:
                 dt_format = '%d/%m/%Y %H:%M:%S'
                 recs.to_csv(p, index=None, date_format=dt_format)
 
-        new_time = pd.Timestamp(year=today_date.year, month=today_date.month, day=today_date.day, hour=3)
+        # last night's after-hours (T+1) session belongs to today's trading day. Trades keep their real time so they
+        # stay in order across midnight; the opening positions are put at the start of today's trading day.
+        session_calendar = SessionCalendar(sorted(set(end_of_day_price.keys()) | {today_date}), sessions=self.sessions)
+        today_start = pd.Timestamp(
+            session_calendar.day_start[session_calendar.trading_day_index([today_date])[0]])
         if data_len > 0:
-            data['Trade Time'] = data.apply(lambda x: x['Trade Time'] if x['Trade Time'] > today_date else new_time, axis=1)
+            trade_day = session_calendar.trading_day(data['Trade Time'].values)
+            not_today = trade_day != np.datetime64(today_date)
+            if not_today.any():
+                warnings.warn('%d trade(s) do not belong to trading day %s, first one at %s' % (
+                    not_today.sum(), today_date.strftime('%Y-%m-%d'), data['Trade Time'][not_today].iloc[0]))
         # data = data.sort_values(by=['Trade Time'], ascending=True)
         # print(data)
 
@@ -462,7 +472,7 @@ class StrategyMonitory:
             # print(rec)
             if len(rec) > 0:
                 # if len(data_this_strategy) > 0:
-                rec.loc[:, 'Trade Time'] = today_date   # actually the time is not very important
+                rec.loc[:, 'Trade Time'] = today_start   # before any trade of today's trading day
                 rec.loc[:, 'ID'] = self.UNDERLYING_DICT[strategy_config_dict[s]['underlying']]
                 rec.loc[:, 'Multiplier'] = contract_multiplier[
                     self.UNDERLYING_DICT[strategy_config_dict[s]['underlying']]
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+from calculate_custom_metrics import CalculateCustomMetrics
+from metrics_registry import BATCH_METRICS, compute_metrics
+
+TRADE_METRICS = ['Expectancy', 'HHI Trade 10', 'HHI Trade 5']
+
+
+def test_strategies_table_same_as_single_strategy(tmp_path):
+    rng = np.random.default_rng(1)
+    strategy_paths = []
+    for i, n_trades in enumerate([40, 12, 60]):
+        strategy_path = tmp_path / ('strategy_%d' % i)
+        strategy_path.mkdir()
+        dates = pd.bdate_range('2019-01-01', periods=300 - 20 * i)
+        pd.DataFrame({'Date': dates.strftime('%Y-%m-%d'), 'PnL': rng.normal(5, 100, len(dates))}).to_csv(
+            strategy_path / 'daily_pnl.csv', index=None)
+        pd.DataFrame({'Profit': rng.normal(10, 200, n_trades)}).to_csv(strategy_path / 'trades.csv', index=None)
+        strategy_paths.append(str(strategy_path))
+
+    default_table = CalculateCustomMetrics.cal_metrics_strategies(strategy_paths)
+    table = CalculateCustomMetrics.cal_metrics_strategies(strategy_paths, metrics=BATCH_METRICS + TRADE_METRICS)
+    assert list(default_table.columns) == BATCH_METRICS
+    pd.testing.assert_frame_equal(default_table, table[BATCH_METRICS])
+
+    pnl_matrix = CalculateCustomMetrics.read_daily_pnl_matrix(strategy_paths)
+    for strategy_path, (strategy, row) in zip(strategy_paths, table.iterrows()):
+        trade_pnl = pd.read_csv(strategy_path + '/trades.csv')['Profit'].values
+        # same days as the table, 0 where the strategy has no pnl
+        metrics = compute_metrics(BATCH_METRICS + TRADE_METRICS, daily_pnl=pnl_matrix[strategy].values,
+                                  dates=pnl_matrix.index.values, trade_pnl=trade_pnl)
+        assert np.allclose([metrics[name] for name in table.columns], row.values.astype(float))
+        assert np.isclose(row['Expectancy'], CalculateCustomMetrics.cal_expectancy(trade_pnl))
@@ -0,0 +1,22 @@
+import os
+import numpy as np
+import pandas as pd
+from calculate_custom_metrics import CalculateCustomMetrics
+from mc_cache import MonteCarloCache
+
+
+def test_only_seeded_runs_are_cached(tmp_path):
+    dates = pd.bdate_range('2015-01-01', periods=300)
+    pd.DataFrame({'Date': dates.strftime('%Y-%m-%d'), 'PnL': np.random.default_rng(0).normal(5, 100, len(dates))}
+                 ).to_csv(tmp_path / 'daily_pnl.csv', index=None)
+    cache_dir = tmp_path / 'mc_cache'
+
+    CalculateCustomMetrics.cal_monte_carlo_one_strategy(str(tmp_path), mc_times=200, cache=MonteCarloCache(cache_dir))
+    assert not cache_dir.exists() or os.listdir(cache_dir) == []
+    sheets = pd.read_excel(tmp_path / 'MonteCarlo2' / 'daily.xlsx', sheet_name=None, index_col=0)
+    assert list(sheets) == ['All year', '2015', '2016']
+    assert 'MDD' in sheets['All year'].index
+
+    CalculateCustomMetrics.cal_monte_carlo_one_strategy(
+        str(tmp_path), mc_times=200, seed=1, cache=MonteCarloCache(cache_dir))
+    assert len(os.listdir(cache_dir)) > 0
@@ -0,0 +1,21 @@
+import numpy as np
+import monte_carlo_kernel
+from monte_carlo_kernel import MC_COLUMNS, simulate_monte_carlo, simulate_portfolio_monte_carlo
+
+
+def test_portfolio_result_independent_of_other_candidates(monkeypatch):
+    # small chunks, so 500 paths take several of them
+    monkeypatch.setattr(monte_carlo_kernel, 'MAX_CHUNK_CELLS', 250 * 120)
+    pnl_matrix = np.random.default_rng(0).normal(5, 100, (250, 3))
+    weights = [[1, 0, 0], [0, 1, 0], [0, 0, 1], [0.5, 0.5, 0]]
+    for method in ['shuffle', 'stationary']:
+        alone = simulate_portfolio_monte_carlo(pnl_matrix, weights[:1], times=500, seed=7, method=method)[0]
+        together = simulate_portfolio_monte_carlo(pnl_matrix, weights, times=500, seed=7, method=method)[0]
+        for name in MC_COLUMNS:
+            assert np.array_equal(alone[name], together[name], equal_nan=True)
+
+    # and the shuffled paths are the ones of the single series Monte Carlo of the portfolio pnl
+    single = simulate_monte_carlo(pnl_matrix[:, 0], times=500, seed=7)
+    alone = simulate_portfolio_monte_carlo(pnl_matrix, weights[:1], times=500, seed=7)[0]
+    for name in MC_COLUMNS:
+        assert np.array_equal(single[name], alone[name], equal_nan=True)
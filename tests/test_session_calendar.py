@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+import pytest
+from session_calendar import SessionCalendar
+
+# a market with a single 08:45 - 13:45 day session and an evening session traded for the next trading day
+NIGHT_AND_DAY_SESSIONS = [('Night', '15:00:00', '05:00:00', True),
+                          ('Day', '08:45:00', '13:45:00', False)]
+TRADING_DAYS = ['2024-03-04', '2024-03-05', '2024-03-06']
+
+
+def test_hsi_day_end_by_default():
+    calendar = SessionCalendar(TRADING_DAYS)
+    assert calendar.trading_day_index(np.array(['2024-03-04T16:30:00', '2024-03-04T16:30:02'],
+                                               dtype='datetime64[ns]')).tolist() == [0, 1]
+
+
+def test_day_end_derived_from_custom_sessions():
+    calendar = SessionCalendar(TRADING_DAYS, sessions=NIGHT_AND_DAY_SESSIONS)
+    times = pd.to_datetime(['2024-03-04 13:45:00', '2024-03-04 15:30:00', '2024-03-05 02:00:00',
+                            '2024-03-05 10:00:00']).values
+    assert calendar.trading_day(times).astype('datetime64[D]').astype(str).tolist() == \
+        ['2024-03-04', '2024-03-05', '2024-03-05', '2024-03-05']
+    assert [calendar.sessions[i][0] for i in calendar.session_index(times)] == ['Day', 'Night', 'Night', 'Day']
+
+
+def test_day_end_time_before_a_session_close():
+    with pytest.raises(ValueError):
+        SessionCalendar(TRADING_DAYS, sessions=NIGHT_AND_DAY_SESSIONS, day_end_time='13:00:00')